@@ -0,0 +1,97 @@
+"""
+控件缓存，缓存项记录控件的RuntimeId和所属窗口的代数（generation）
+登录、重新绑定会话窗口、关闭提示框等状态变化时增加对应窗口的代数，旧代数的缓存项自动失效，不需要手动逐个清理
+读取缓存时只读取一次RuntimeId进行校验，控件已经销毁时会立即抛出异常，不会像 Exists(1, 1) 一样阻塞等待
+"""
+import threading
+
+from base.log import logger
+
+MAIN_WINDOW = 'main'   # 主窗口
+CONVERSATION_WINDOW = 'conversation'   # 会话窗口，QQ使用独立的会话窗口
+
+
+def read_runtime_id(control) -> tuple | None:
+    # 读取控件的RuntimeId，控件已经失效时返回None
+    try:
+        runtime_id = control.GetRuntimeId()
+    except Exception:
+        return None
+    return tuple(runtime_id) if runtime_id else None
+
+
+class ControlCacheEntry(object):
+    __slots__ = ('control', 'runtime_id', 'window', 'generation')
+
+    def __init__(self, control, runtime_id: tuple, window: str, generation: int):
+        self.control = control
+        self.runtime_id = runtime_id
+        self.window = window
+        self.generation = generation
+
+
+class ControlCache(object):
+
+    def __init__(self):
+        self.entries = {}   # tag -> ControlCacheEntry
+        self.generations = {}   # window -> generation
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0   # 缓存项存在但已经失效的次数
+        self.bump_count = 0   # bump次数，依赖界面状态的其他缓存（如索引快照）据此判断是否需要丢弃
+
+    def get(self, tag):
+        """
+        获取缓存控件，窗口代数变化或者RuntimeId变化时视为失效并移除
+        :return: 有效的缓存控件，没有缓存或者已经失效返回None
+        """
+        with self.lock:
+            entry = self.entries.get(tag)
+            if not entry:
+                self.misses += 1
+                return None
+            is_current = entry.generation == self.generations.get(entry.window, 0)
+        # 读取RuntimeId是跨进程调用，不放在锁内
+        if is_current and read_runtime_id(entry.control) == entry.runtime_id:
+            with self.lock:
+                self.hits += 1
+            return entry.control
+        with self.lock:
+            self.stale += 1
+            if self.entries.get(tag) is entry:
+                self.entries.pop(tag)
+        logger.info('cached control is stale: {}'.format(tag))
+        return None
+
+    def put(self, tag, control, window=MAIN_WINDOW):
+        runtime_id = read_runtime_id(control)
+        if not runtime_id:
+            # 没有RuntimeId的控件无法校验，不缓存
+            return
+        with self.lock:
+            self.entries[tag] = ControlCacheEntry(control, runtime_id, window, self.generations.get(window, 0))
+
+    def bump(self, *windows: str):
+        """
+        窗口状态变化时增加代数，该窗口下的缓存全部失效，不传参数时所有窗口都失效
+        """
+        with self.lock:
+            self.bump_count += 1
+            for window in windows or set(self.generations.keys()) | {x.window for x in self.entries.values()}:
+                self.generations[window] = self.generations.get(window, 0) + 1
+
+    def invalidate(self, tag):
+        with self.lock:
+            self.entries.pop(tag, None)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'generations': dict(self.generations),
+                'bumpCount': self.bump_count,
+            }
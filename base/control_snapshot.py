@@ -0,0 +1,515 @@
+"""
+控件树快照，一次批量获取整棵子树的控件属性，避免逐层 GetChildren 和逐个读取属性带来的跨进程COM调用
+Windows下使用UIA的CacheRequest一次性缓存 Name、ClassName、ControlType、RuntimeId、BoundingRectangle，
+Linux下可以使用纯Python的FakeSnapshotBackend来运行整个快照引擎，方便调试和压测
+快照节点实现了 GetChildren、GetParentControl、ControlTypeName 等接口，可以直接用于 base.selector 的选择器查找
+"""
+import threading
+import time
+import timeit
+from abc import ABC, abstractmethod
+
+from base.selector import compile_selector
+
+# UIA属性id，参考 uiautomation.PropertyId
+UIA_RUNTIME_ID_PROPERTY = 30000
+UIA_BOUNDING_RECTANGLE_PROPERTY = 30001
+UIA_CONTROL_TYPE_PROPERTY = 30003
+UIA_NAME_PROPERTY = 30005
+UIA_CLASS_NAME_PROPERTY = 30012
+# UIA缓存范围，参考 UIAutomationCore TreeScope
+TREE_SCOPE_ELEMENT_AND_CHILDREN = 3
+TREE_SCOPE_SUBTREE = 7
+
+
+class SnapshotNode(object):
+    """
+    快照节点，只保存查找时需要的属性，访问属性不会产生跨进程调用
+    """
+    __slots__ = ('name', 'class_name', 'control_type', 'control_type_name', 'runtime_id', 'rect',
+                 'depth', 'parent', 'children', 'element', 'backend')
+
+    def __init__(self, name='', class_name='', control_type=0, control_type_name='', runtime_id=None,
+                 rect=(0, 0, 0, 0), depth=0, parent=None, element=None, backend=None):
+        self.name = name
+        self.class_name = class_name
+        self.control_type = control_type
+        self.control_type_name = control_type_name
+        self.runtime_id = runtime_id   # 控件运行时id，同一控件存活期间不变
+        self.rect = rect   # (left, top, right, bottom)
+        self.depth = depth   # 相对快照根节点的深度
+        self.parent = parent
+        self.children = []
+        self.element = element   # 后端原始元素，用于还原为可交互的控件
+        self.backend = backend
+
+    # 兼容 uiautomation.Control 的只读接口，方便选择器和原有代码直接使用
+    @property
+    def Name(self) -> str:
+        return self.name
+
+    @property
+    def ClassName(self) -> str:
+        return self.class_name
+
+    @property
+    def ControlTypeName(self) -> str:
+        return self.control_type_name
+
+    def GetChildren(self) -> list:
+        return self.children
+
+    def GetParentControl(self):
+        return self.parent
+
+    def GetFirstChildControl(self):
+        return self.children[0] if self.children else None
+
+    def GetLastChildControl(self):
+        return self.children[-1] if self.children else None
+
+    @property
+    def control(self):
+        """
+        还原为可交互的控件，比如需要点击、输入时使用
+        """
+        return self.backend.to_control(self) if self.backend else None
+
+    def __repr__(self):
+        return 'SnapshotNode({}, name={!r}, class_name={!r}, depth={})'.format(
+            self.control_type_name, self.name, self.class_name, self.depth)
+
+
+class SnapshotBackend(ABC):
+    """
+    快照后端，负责批量获取控件树并构建快照节点
+    """
+
+    @abstractmethod
+    def fetch(self, root_control, max_depth=None) -> SnapshotNode | None:
+        """
+        批量获取控件子树
+        :param root_control: 根控件
+        :param max_depth: 最大深度，为空表示整棵子树，1表示只取直接子节点，超过 max_depth 的节点不能被获取
+        :return: 快照根节点
+        """
+
+    @abstractmethod
+    def to_control(self, node: SnapshotNode):
+        """将快照节点还原为可交互控件"""
+
+
+class UIASnapshotBackend(SnapshotBackend):
+    """
+    基于UIA CacheRequest的快照后端，一次跨进程调用获取整棵子树的属性
+    限制深度时 CacheRequest 不支持按深度截断，改为逐层获取，每个不在最底层的节点一次跨进程调用
+    """
+
+    def __init__(self):
+        import uiautomation as auto
+        self.auto = auto
+        self.client = auto.uiautomation._AutomationClient.instance()
+        self.cache_requests = {}
+
+    def _get_cache_request(self, tree_scope: int):
+        # CacheRequest 可以复用，按缓存范围创建一次
+        if tree_scope not in self.cache_requests:
+            cache_request = self.client.IUIAutomation.CreateCacheRequest()
+            for property_id in [UIA_NAME_PROPERTY, UIA_CLASS_NAME_PROPERTY, UIA_CONTROL_TYPE_PROPERTY,
+                                UIA_RUNTIME_ID_PROPERTY, UIA_BOUNDING_RECTANGLE_PROPERTY]:
+                cache_request.AddProperty(property_id)
+            cache_request.TreeScope = tree_scope
+            # uiautomation 使用 RawViewWalker 遍历，快照和 GetChildren 保持一致
+            cache_request.TreeFilter = self.client.IUIAutomation.RawViewCondition
+            self.cache_requests[tree_scope] = cache_request
+        return self.cache_requests[tree_scope]
+
+    def fetch(self, root_control, max_depth=None) -> SnapshotNode | None:
+        if not root_control:
+            return None
+        if max_depth is None:
+            cached_element = root_control.Element.BuildUpdatedCache(self._get_cache_request(TREE_SCOPE_SUBTREE))
+            return self._build_node(cached_element, None, 0)
+        # 子树很大时（比如主窗口的消息列表）整棵获取再截断代价很高，逐层只获取 max_depth 以内的节点
+        cached_element = root_control.Element.BuildUpdatedCache(
+            self._get_cache_request(TREE_SCOPE_ELEMENT_AND_CHILDREN))
+        return self._build_level_node(cached_element, None, 0, max_depth)
+
+    def _create_node(self, element, parent, depth) -> SnapshotNode:
+        rect = element.CachedBoundingRectangle
+        control_type = element.CachedControlType
+        runtime_id = element.GetCachedPropertyValue(UIA_RUNTIME_ID_PROPERTY)
+        node = SnapshotNode(name=element.CachedName,
+                            class_name=element.CachedClassName,
+                            control_type=control_type,
+                            control_type_name=self.auto.ControlTypeNames.get(control_type, ''),
+                            runtime_id=tuple(runtime_id) if runtime_id else None,
+                            rect=(rect.left, rect.top, rect.right, rect.bottom),
+                            depth=depth, parent=parent, element=element, backend=self)
+        return node
+
+    def _build_node(self, element, parent, depth) -> SnapshotNode:
+        # 元素缓存了整棵子树
+        node = self._create_node(element, parent, depth)
+        children = element.GetCachedChildren()
+        if children:
+            for index in range(children.Length):
+                node.children.append(self._build_node(children.GetElement(index), node, depth + 1))
+        return node
+
+    def _build_level_node(self, element, parent, depth, max_depth) -> SnapshotNode:
+        # 元素缓存了自身和直接子节点，子节点不在最底层时再获取一次它的直接子节点
+        node = self._create_node(element, parent, depth)
+        if depth >= max_depth:
+            return node
+        children = element.GetCachedChildren()
+        if not children:
+            return node
+        children_cache_request = self._get_cache_request(TREE_SCOPE_ELEMENT_AND_CHILDREN)
+        for index in range(children.Length):
+            child_element = children.GetElement(index)
+            if depth + 1 >= max_depth:
+                node.children.append(self._create_node(child_element, node, depth + 1))
+                continue
+            try:
+                child_element = child_element.BuildUpdatedCache(children_cache_request)
+            except Exception:
+                # 获取过程中控件已经销毁，只保留已经缓存的属性
+                node.children.append(self._create_node(child_element, node, depth + 1))
+                continue
+            node.children.append(self._build_level_node(child_element, node, depth + 1, max_depth))
+        return node
+
+    def to_control(self, node: SnapshotNode):
+        # CacheRequest 默认是 Full 模式，缓存的元素本身就是可交互的元素
+        return self.auto.Control.CreateControlFromElement(node.element)
+
+
+class FakeControl(object):
+    """
+    模拟 uiautomation.Control 的纯Python控件，用于在非Windows环境运行快照引擎和压测
+    每次 GetChildren、读取属性都计数，并可以模拟跨进程调用的延时
+    """
+    CONTROL_TYPES = {'PaneControl': 50033, 'WindowControl': 50032, 'ButtonControl': 50000, 'EditControl': 50004,
+                     'ListControl': 50008, 'ListItemControl': 50007, 'TextControl': 50020, 'ToolBarControl': 50021,
+                     'MenuItemControl': 50011, 'ImageControl': 50006}
+
+    def __init__(self, control_type_name='PaneControl', name='', class_name='', children=None,
+                 rect=(0, 0, 0, 0), latency=0.0):
+        self._name = name
+        self._class_name = class_name
+        self._control_type_name = control_type_name
+        self.rect = rect
+        self.latency = latency   # 模拟每次跨进程调用的耗时，单位秒
+        self.parent = None
+        self.children = []
+        self.runtime_id = (42, id(self))
+        self.call_count = 0
+        for child in children or []:
+            self.append(child)
+
+    def append(self, child: 'FakeControl') -> 'FakeControl':
+        child.parent = self
+        self.children.append(child)
+        return child
+
+    def _round_trip(self):
+        self.call_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def Name(self) -> str:
+        self._round_trip()
+        return self._name
+
+    @property
+    def ClassName(self) -> str:
+        self._round_trip()
+        return self._class_name
+
+    @property
+    def ControlTypeName(self) -> str:
+        self._round_trip()
+        return self._control_type_name
+
+    @property
+    def ControlType(self) -> int:
+        self._round_trip()
+        return self.CONTROL_TYPES.get(self._control_type_name, 0)
+
+    def GetRuntimeId(self):
+        self._round_trip()
+        return list(self.runtime_id)
+
+    def GetChildren(self) -> list:
+        self._round_trip()
+        return list(self.children)
+
+    def GetParentControl(self):
+        self._round_trip()
+        return self.parent
+
+    def GetFirstChildControl(self):
+        self._round_trip()
+        return self.children[0] if self.children else None
+
+    def GetLastChildControl(self):
+        self._round_trip()
+        return self.children[-1] if self.children else None
+
+    def Exists(self, maxSearchSeconds=0, searchIntervalSeconds=0):
+        self._round_trip()
+        return True
+
+    def __repr__(self):
+        return 'FakeControl({}, name={!r})'.format(self._control_type_name, self._name)
+
+
+class FakeSnapshotBackend(SnapshotBackend):
+    """
+    纯Python快照后端，批量读取 FakeControl 树，整棵获取只模拟一次跨进程调用，
+    限制深度时和UIA后端一样逐层获取，每个不在最底层的节点模拟一次跨进程调用
+    """
+
+    def fetch(self, root_control: FakeControl, max_depth=None) -> SnapshotNode | None:
+        if not root_control:
+            return None
+        root_control._round_trip()
+        return self._build_node(root_control, None, 0, max_depth)
+
+    def _build_node(self, control: FakeControl, parent, depth, max_depth) -> SnapshotNode:
+        node = SnapshotNode(name=control._name, class_name=control._class_name,
+                            control_type=FakeControl.CONTROL_TYPES.get(control._control_type_name, 0),
+                            control_type_name=control._control_type_name, runtime_id=control.runtime_id,
+                            rect=control.rect, depth=depth, parent=parent, element=control, backend=self)
+        if max_depth is None or depth < max_depth:
+            if max_depth is not None and depth > 0:
+                control._round_trip()
+            node.children = [self._build_node(child, node, depth + 1, max_depth) for child in control.children]
+        return node
+
+    def to_control(self, node: SnapshotNode):
+        return node.element
+
+
+_default_backend: SnapshotBackend | None = None
+
+
+def get_snapshot_backend() -> SnapshotBackend:
+    """
+    获取默认快照后端，有uiautomation时使用UIA后端，否则使用纯Python后端
+    """
+    global _default_backend
+    if _default_backend is None:
+        try:
+            _default_backend = UIASnapshotBackend()
+        except (ImportError, AttributeError, OSError):
+            _default_backend = FakeSnapshotBackend()
+    return _default_backend
+
+
+def set_snapshot_backend(backend: SnapshotBackend):
+    # 替换默认快照后端
+    global _default_backend
+    _default_backend = backend
+
+
+# 索引查找统计，key为 (控件类型, 属性名, 属性值)，记录命中次数、未命中次数和命中节点深度
+control_index_stats = {}
+_control_index_stats_lock = threading.Lock()
+
+
+def record_control_index_stat(key: tuple, depth: int | None):
+    with _control_index_stats_lock:
+        stat = control_index_stats.setdefault(key, {'hits': 0, 'misses': 0, 'depth': None})
+        if depth is None:
+            stat['misses'] += 1
+        else:
+            stat['hits'] += 1
+            stat['depth'] = depth
+
+
+def get_control_index_stats() -> list:
+    """
+    获取索引查找统计，按照命中深度倒序，深度越大表示原来的深度搜索越耗时
+    """
+    with _control_index_stats_lock:
+        stats = [{'controlType': key[0], 'property': key[1], 'value': key[2], **stat}
+                 for key, stat in control_index_stats.items()]
+    return sorted(stats, key=lambda x: -1 if x['depth'] is None else x['depth'], reverse=True)
+
+
+class ControlIndex(object):
+    """
+    快照上的控件索引，按照 (ControlType, Name) 和 (ControlType, ClassName) 建立索引，查找复杂度O(1)
+    同一个key有多个节点时按照先序遍历顺序保存，和uiautomation的深度优先搜索结果一致
+    """
+
+    def __init__(self, snapshot: 'ControlTreeSnapshot'):
+        self.name_index = {}
+        self.class_name_index = {}
+        for node in snapshot.iter_nodes():
+            if node is snapshot.root:
+                # uiautomation的搜索不包含根节点本身
+                continue
+            self.name_index.setdefault((node.control_type_name, node.name), []).append(node)
+            self.class_name_index.setdefault((node.control_type_name, node.class_name), []).append(node)
+
+    def lookup(self, control_type_name: str, name: str = None, class_name: str = None,
+               max_depth: int = None) -> SnapshotNode | None:
+        """
+        查找第一个匹配的节点，同时指定name和class_name时两者都需要匹配
+        :param control_type_name: 控件类型，如 ButtonControl
+        :param name: 控件名称
+        :param class_name: 控件类名
+        :param max_depth: 最大搜索深度，对应uiautomation的searchDepth
+        """
+        if name is not None:
+            key = (control_type_name, 'Name', name)
+            nodes = self.name_index.get((control_type_name, name), [])
+        else:
+            key = (control_type_name, 'ClassName', class_name)
+            nodes = self.class_name_index.get((control_type_name, class_name), [])
+        for node in nodes:
+            if (class_name is None or node.class_name == class_name) and (max_depth is None or node.depth <= max_depth):
+                record_control_index_stat(key, node.depth)
+                return node
+        record_control_index_stat(key, None)
+        return None
+
+
+class ControlTreeSnapshot(object):
+    """
+    控件树快照，创建时批量获取控件子树，之后的查找都在快照中完成
+    快照不会自动更新，界面变化后需要重新创建
+    """
+
+    def __init__(self, root: SnapshotNode | None, backend: SnapshotBackend = None, fetch_seconds: float = 0):
+        self.root = root
+        self.backend = backend
+        self.fetch_seconds = fetch_seconds   # 获取快照耗时
+        self.created_time = time.time()
+        self._runtime_id_nodes = None
+        self._index = None
+
+    @staticmethod
+    def capture(root_control, max_depth=None, backend: SnapshotBackend = None) -> 'ControlTreeSnapshot':
+        """
+        抓取控件树快照
+        :param root_control: 根控件，为空时返回空快照
+        :param max_depth: 最大深度，为空表示整棵子树一次获取，指定时逐层获取，不会获取更深的节点
+        :param backend: 快照后端，默认使用 get_snapshot_backend
+        """
+        if isinstance(root_control, ControlTreeSnapshot):
+            return root_control
+        if not backend:
+            backend = FakeSnapshotBackend() if isinstance(root_control, FakeControl) else get_snapshot_backend()
+        begin_time = time.time()
+        root = backend.fetch(root_control, max_depth)
+        return ControlTreeSnapshot(root, backend, time.time() - begin_time)
+
+    def __bool__(self):
+        return self.root is not None
+
+    def iter_nodes(self):
+        """
+        按照先序遍历所有节点
+        """
+        if not self.root:
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def select(self, selector: str, anchor: SnapshotNode = None) -> SnapshotNode | None:
+        """
+        在快照中按选择器查找节点，语法同 base.control_util.select_control
+        :param selector: 选择器
+        :param anchor: 基准节点，默认是快照根节点
+        """
+        return compile_selector(selector).resolve(anchor if anchor else self.root)
+
+    def find_all(self, predicate) -> list:
+        # 查找所有满足条件的节点
+        return [node for node in self.iter_nodes() if predicate(node)]
+
+    def find_first(self, predicate) -> SnapshotNode | None:
+        for node in self.iter_nodes():
+            if predicate(node):
+                return node
+        return None
+
+    def find_node(self, control) -> SnapshotNode | None:
+        """
+        通过RuntimeId查找控件对应的快照节点，用于从实时控件定位到快照中
+        """
+        if not control:
+            return None
+        if isinstance(control, SnapshotNode):
+            return control
+        if self._runtime_id_nodes is None:
+            self._runtime_id_nodes = {node.runtime_id: node for node in self.iter_nodes() if node.runtime_id}
+        runtime_id = control.GetRuntimeId()
+        return self._runtime_id_nodes.get(tuple(runtime_id)) if runtime_id else None
+
+    @property
+    def index(self) -> ControlIndex:
+        # 索引在第一次使用时构建
+        if self._index is None:
+            self._index = ControlIndex(self)
+        return self._index
+
+    def __len__(self):
+        return sum(1 for _ in self.iter_nodes())
+
+
+def build_fake_wechat_tree(latency=0.0, message_count=200) -> FakeControl:
+    """
+    构建一棵结构类似微信主窗口的模拟控件树，用于压测
+    """
+    def pane(*children, name=''):
+        return FakeControl('PaneControl', name, children=list(children), latency=latency)
+
+    message_list = FakeControl('ListControl', '消息', latency=latency)
+    for index in range(message_count):
+        message_list.append(FakeControl('ListItemControl', 'message-{}'.format(index), latency=latency,
+                                        children=[pane(pane(), pane(FakeControl('TextControl', 'sender')))]))
+    input_edit = FakeControl('EditControl', '输入', latency=latency)
+    emotion_button = FakeControl('ButtonControl', '表情', latency=latency)
+    navigation = FakeControl('ToolBarControl', '导航', latency=latency,
+                             children=[FakeControl('ButtonControl', 'login-user', latency=latency)])
+    title = pane(pane(pane(FakeControl('TextControl', 'active-conversation', latency=latency))))
+    main_window = FakeControl('WindowControl', '微信', 'WeChatMainWndForPC', latency=latency, children=[
+        pane(),
+        pane(navigation,
+             pane(pane(pane(pane(pane(pane(title, pane(message_list),
+                                           pane(pane(emotion_button), pane(input_edit))))))))),
+    ])
+    return main_window
+
+
+def benchmark_test(latency=0.0005, number=20):
+    # 模拟每次跨进程调用 0.5ms，对比实时逐层查找和快照查找
+    main_window = build_fake_wechat_tree(latency)
+    selectors = ['pane:1>pane-9>text', 'pane:1>toolbar>button',
+                 'pane:1>pane-6>pane:2>pane:1>edit', 'pane:1>pane-6>pane:1>list']
+
+    def live_select():
+        return [compile_selector(x).resolve(main_window) for x in selectors]
+
+    def snapshot_select():
+        snapshot = ControlTreeSnapshot.capture(main_window, backend=FakeSnapshotBackend())
+        return [snapshot.select(x) for x in selectors]
+
+    assert [x._name for x in live_select()] == [x.name for x in snapshot_select()]
+    live_seconds = timeit.timeit(live_select, number=number)
+    snapshot_seconds = timeit.timeit(snapshot_select, number=number)
+    print('live select: {:.2f}ms/op'.format(live_seconds * 1000 / number))
+    print('snapshot select: {:.2f}ms/op'.format(snapshot_seconds * 1000 / number))
+
+
+if __name__ == '__main__':
+    benchmark_test()
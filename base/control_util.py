@@ -1,61 +1,25 @@
 import random
-import re
 import time
 from typing import List
 
 import uiautomation as auto
 from uiautomation import Control
 
+from base.control_cache import read_runtime_id
+from base.control_snapshot import ControlTreeSnapshot, SnapshotNode
 from base.exception import ControlInvalidException
 from base.log import logger
+from base.metrics import observe_latency
+from base.selector import compile_selector, parse_select_item, resolve_steps
+from base.window_registry import get_window_registry
 
 
 def select_control_by_tree(root_control: Control, select_items: list) -> Control | None:
     """
-    递归获取control，示例：pane.pane.pane:2.edit
+    按已拆分的选择项查找control，示例：['pane', 'pane', 'pane:2', 'edit']，不会修改传入的选择项列表
     """
-    # root为空则没找到
-    if not root_control:
-        return None
-
-    # root不为空，且查询数量为0，则返回
-    if len(select_items) == 0:
-        return root_control
-
-    select_item = select_items.pop(0)
-
-    # 查找父节点
-    if select_item == 'p' or select_item == '.':
-        return select_control_by_tree(root_control.GetParentControl(), select_items)
-
-    # 没有子节点返回空
-    if not root_control.GetChildren():
-        return None
-
-    child_control_index = 0
-    if ':' in select_item:
-        # 子节点索引解析
-        split_select_items = select_item.split(':')
-        child_control_name = split_select_items[0]
-        child_control_index = int(split_select_items[1])
-    else:
-        child_control_name = select_item
-
-    # child_control_name 控件简化信息补全
-    child_control_name = child_control_name.strip().lower() + 'control'
-
-    same_control_index = 0
-    for control in root_control.GetChildren():
-        if control.ControlTypeName.lower() == child_control_name or child_control_name == 'control':
-            # 和索引相同则命中，递归查找
-            if child_control_index == same_control_index:
-                # logger.info('attach control. sub_select_items: {}, control: {}'
-                #             .format(child_select_items, control.ControlTypeName))
-                return select_control_by_tree(control, select_items)
-
-            # 相同的control类型计数 +1
-            same_control_index += 1
-    return None
+    steps = tuple(parse_select_item(select_item) for select_item in select_items)
+    return resolve_steps(root_control, steps)
 
 
 def select_control(root_control: Control, selector: str) -> Control | None:
@@ -66,21 +30,44 @@ def select_control(root_control: Control, selector: str) -> Control | None:
     - 后面跟数字，表示重复多少次下一个节点查找，pane-2表示查找当前节点下的PaneControl子节点下的PaneControl子节点重复2次
     : 后面跟数字，表示查找第几个字节点，索引从0开始，pane:1表示查找当前节点下的第2个PaneControl子节点
     示例： select_control(wechat_window, 'pane:1>pane>pane>edit')
+    选择器只会解析一次，编译结果缓存在 base.selector 中
+    基准control也可以是控件树快照或者快照节点，此时在快照中查找，不会产生跨进程调用，返回可交互的控件
     :param root_control 基准control
     :param selector 选择器
     """
-    child_select_items = re.split(r' *> *', selector)
-    # 处理多级简写
-    expend_items = []
-    for item in child_select_items:
-        # 重复标识，p-4 处理为 [p, p, p, p]
-        if '-' in item:
-            item, times = item.split('-')
-            for i in range(int(times)):
-                expend_items.append(item)
-        else:
-            expend_items.append(item)
-    return select_control_by_tree(root_control, expend_items)
+    if isinstance(root_control, ControlTreeSnapshot):
+        root_control = root_control.root
+    find_control = compile_selector(selector).resolve(root_control)
+    if isinstance(find_control, SnapshotNode):
+        return find_control.control
+    return find_control
+
+
+def search_control(root_control: Control, control_type: str, snapshot: ControlTreeSnapshot = None,
+                   **search_properties) -> Control:
+    """
+    按控件类型和属性查找后代控件，优先使用快照索引O(1)查找，索引未命中时才回退为实时深度搜索
+    示例： search_control(wechat_window, 'ButtonControl', snapshot, Name='表情')
+    :param root_control 搜索根控件
+    :param control_type 控件类型，如 ButtonControl、ListControl
+    :param snapshot 以root_control为根的控件树快照，为空时直接实时搜索
+    :param search_properties 搜索属性，索引只支持 Name、ClassName、searchDepth，包含其他属性时直接实时搜索
+    """
+    if snapshot and set(search_properties) <= {'Name', 'ClassName', 'searchDepth'} \
+            and ('Name' in search_properties or 'ClassName' in search_properties):
+        find_node = snapshot.index.lookup(control_type, search_properties.get('Name'),
+                                          search_properties.get('ClassName'), search_properties.get('searchDepth'))
+        if find_node:
+            find_control = find_node.control
+            # 快照可能已经过期，RuntimeId不一致说明控件已经销毁或者被重建，回退为实时搜索
+            if find_node.runtime_id and read_runtime_id(find_control) == find_node.runtime_id:
+                return find_control
+            logger.info('indexed control is stale, search live. control_type: {}, properties: {}'
+                        .format(control_type, search_properties))
+            return getattr(root_control, control_type)(**search_properties)
+        logger.info('control index miss, search live. control_type: {}, properties: {}'
+                    .format(control_type, search_properties))
+    return getattr(root_control, control_type)(**search_properties)
 
 
 def select_parent_control(root_control: Control, level: int) -> Control | None:
@@ -98,13 +85,18 @@ def select_parent_control(root_control: Control, level: int) -> Control | None:
 
 
 # 控件点击，需要加入随机演示，会提前确保窗口 active
-def control_click(control: Control, right_click=False, with_exception_message='', check_name=''):
+def control_click(control: Control, right_click=False, with_exception_message='', check_name='',
+                  wait_predicate=None, wait_timeout=3.0, wait_name='click', random_wait=False):
     """
     点击某个空间
     :params control: 控件，可为空
     :params right_click: 鼠标右键点击
     :params exception_message: 控件为空时输出的异常信息，如果为空则不抛出异常
     :params check_name: 检查名称是否匹配，只适用于非空检查
+    :params wait_predicate: 点击后等待的条件，条件满足立即返回
+    :params wait_timeout: 等待条件的超时秒
+    :params wait_name: 等待统计名称
+    :params random_wait: 没有等待条件时是否随机等待一小段时间，默认不等待，Click本身已经有操作后的等待
     """
     if not control or not control.Exists(1, 1) or (check_name and control.Name != check_name):
         logger.error('The control is not exist, can not click.')
@@ -118,7 +110,10 @@ def control_click(control: Control, right_click=False, with_exception_message=''
         control.RightClick()
     else:
         control.Click()
-    time.sleep(random.uniform(0.1, 0.3))
+    if wait_predicate:
+        wait_until(wait_predicate, wait_timeout, name=wait_name)
+    elif random_wait:
+        time.sleep(random.uniform(0.1, 0.3))
     return True
 
 
@@ -146,6 +141,29 @@ def check_control_exist(control: Control | None, with_exception_message=''):
     return True
 
 
+def find_top_window_nodes(name='', class_name='', root_control=None, process_id: int = None) -> list:
+    """
+    查找顶层窗口节点列表，节点的 Name、ClassName 读取不会产生跨进程调用，control 属性返回可交互控件
+    根控件为桌面时直接查询窗口注册表，否则批量获取根控件的直接子节点
+    :params name: 匹配窗口控件名称，如果为空则不匹配
+    :params class_name: 匹配窗口控件类名称，如果为空则不匹配
+    :params root_control: 根控件，默认是桌面
+    :params process_id: 匹配窗口所属进程，只在根控件为桌面时支持
+    :return 符合条件的窗口节点列表
+    """
+    if not root_control:
+        return get_window_registry().find(name, class_name, process_id)
+    snapshot = ControlTreeSnapshot.capture(root_control, max_depth=1)
+    if not snapshot:
+        return []
+    top_window_nodes = []
+    for app_node in snapshot.root.children:
+        # 匹配微信主窗口，不通版本可能是PaneControl，可能是WindowControl
+        if (not name or app_node.name == name) and (not class_name or class_name in app_node.class_name):
+            top_window_nodes.append(app_node)
+    return top_window_nodes
+
+
 def find_top_window_controls(name='', class_name='', with_exception_message='',
                              root_control=None) -> List[Control]:
     """
@@ -155,19 +173,123 @@ def find_top_window_controls(name='', class_name='', with_exception_message='',
     :params root_control: 根控件，默认是桌面
     :return 符合条件的窗口控件列表
     """
-    if not root_control:
-        root_control = auto.GetRootControl()
-    top_window_controls = []
-    for app_control in root_control.GetChildren():
-        # 匹配微信主窗口，不通版本可能是PaneControl，可能是WindowControl
-        if (not name or app_control.Name == name) and (not class_name or class_name in app_control.ClassName):
-            top_window_controls.append(app_control)
+    top_window_controls = [x.control for x in find_top_window_nodes(name, class_name, root_control)]
     logger.info('查找到当前顶层窗口数量为：{}，name: {}, class_name: {}'.format(len(top_window_controls), name, class_name))
     if with_exception_message and not top_window_controls:
         raise ControlInvalidException(with_exception_message)
     return top_window_controls
 
 
+def wait_until(predicate, timeout=5.0, interval=0.05, backoff=1.5, max_interval=0.5, name='wait',
+               with_exception_message='', sleep=time.sleep):
+    """
+    条件等待，代替固定时长的sleep，条件满足后立即返回，轮询间隔按backoff倍数逐步增加
+    每次等待的耗时记录在 wait.{name} 耗时统计中
+    :params predicate: 无参函数，返回真值表示条件满足，抛出的LookupError视为条件不满足
+    :params timeout: 超时秒
+    :params interval: 首次轮询间隔秒
+    :params backoff: 轮询间隔增长倍数
+    :params max_interval: 最大轮询间隔秒
+    :params name: 等待名称，用于统计
+    :params with_exception_message: 超时异常消息，如果为空则超时不抛出异常
+    :params sleep: 轮询间隔的等待函数，传入 WindowWatcher.sleep 时窗口有变化会提前结束等待
+    :return: 条件满足时返回predicate的返回值，超时返回None
+    """
+    begin_time = time.time()
+    while True:
+        try:
+            result = predicate()
+        except LookupError:
+            result = None
+        elapsed = time.time() - begin_time
+        if result:
+            observe_latency('wait.' + name, elapsed)
+            return result
+        if elapsed >= timeout:
+            break
+        sleep(min(interval, max_interval, timeout - elapsed))
+        interval *= backoff
+    observe_latency('wait.' + name, time.time() - begin_time, success=False)
+    logger.warning('wait until timeout. name: {}, timeout: {}'.format(name, timeout))
+    if with_exception_message:
+        raise ControlInvalidException(with_exception_message)
+    return None
+
+
+def control_exists(control_or_getter):
+    """
+    等待条件：控件存在，参数可以是控件，也可以是返回控件的无参函数
+    """
+    def predicate():
+        control = control_or_getter() if callable(control_or_getter) else control_or_getter
+        return control if control and control.Exists(0, 0) else None
+    return predicate
+
+
+def control_in_tree(root_control: Control, control_type: str, name: str, search_depth: int):
+    """
+    等待条件：根控件下出现指定类型和名称的控件，每次检查只抓取 search_depth 层的快照并查索引，满足时返回可交互控件
+    根控件应该尽量小（比如弹出的菜单），search_depth 必须指定，避免每次轮询都抓取整个主窗口
+    """
+    def predicate():
+        find_node = ControlTreeSnapshot.capture(root_control, search_depth).index.lookup(control_type, name)
+        return find_node.control if find_node else None
+    return predicate
+
+
+def control_name_equals(control_or_getter, name: str = None):
+    """
+    等待条件：控件名称等于指定名称，name为空时表示名称不为空
+    """
+    def predicate():
+        control = control_or_getter() if callable(control_or_getter) else control_or_getter
+        if not control:
+            return None
+        control_name = control.Name
+        return control if (control_name == name if name is not None else control_name) else None
+    return predicate
+
+
+def child_count_changed(control: Control, old_count: int = None):
+    """
+    等待条件：子节点数量相对创建条件时发生变化，比如消息列表增加了新消息
+    """
+    old_count = old_count if old_count is not None else len(control.GetChildren())
+
+    def predicate():
+        return len(control.GetChildren()) != old_count
+    return predicate
+
+
+def window_appeared(name='', class_name='', root_control=None):
+    """
+    等待条件：出现匹配的顶层窗口，name可以是窗口名称或者判断名称的函数，满足时返回窗口控件
+    """
+    def predicate():
+        match_name = name if callable(name) else ''
+        for window_node in find_top_window_nodes('' if callable(name) else name, class_name, root_control):
+            if not match_name or match_name(window_node.name):
+                return window_node.control
+        return None
+    return predicate
+
+
+def tree_stable(root_control: Control, max_depth: int):
+    """
+    等待条件：连续两次检查控件树的结构和名称没有变化，用于等待界面加载完成
+    每次检查都会抓取快照，根控件应该是需要等待的最小区域，max_depth 必须指定
+    """
+    last_signature = []
+
+    def predicate():
+        snapshot = ControlTreeSnapshot.capture(root_control, max_depth)
+        signature = [(x.control_type, x.name, x.depth) for x in snapshot.iter_nodes()]
+        stable = bool(last_signature) and signature == last_signature[0]
+        last_signature[:] = [signature]
+        return stable
+    return predicate
+
+
 def active_window(window_control: Control, force=False, wait_time=0.5):
     """
     激活窗口
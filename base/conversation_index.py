@@ -0,0 +1,98 @@
+"""
+会话位置索引，记录会话名称（原名称和备注名称）在会话列表中最后一次出现的位置和滚动偏移
+切换会话时选择代价最小的方式：当前可见直接点击，记录过位置则滚动后点击，否则搜索
+"""
+import threading
+import time
+
+from base.metrics import observe_latency
+
+ROUTE_VISIBLE = 'visible'   # 会话列表中可见，直接点击
+ROUTE_SCROLL = 'scroll'   # 滚动会话列表到记录的位置后点击
+ROUTE_SEARCH = 'search'   # 搜索切换
+
+CONVERSATION_POSITION_TTL_SECONDS = 30 * 60  # 位置记录有效时间，会话列表按最近消息排序，位置会变化
+
+
+class ConversationPosition(object):
+    __slots__ = ('display_name', 'position', 'scroll_offset', 'observed_time')
+
+    def __init__(self, display_name: str, position: int, scroll_offset: int):
+        self.display_name = display_name   # 会话列表中显示的名称，有备注时为备注名称
+        self.position = position   # 在可见列表中的位置
+        self.scroll_offset = scroll_offset   # 观察到时会话列表的滚动偏移，单位为滚轮格数
+        self.observed_time = time.time()
+
+
+class ConversationIndex(object):
+
+    def __init__(self, ttl_seconds=CONVERSATION_POSITION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.positions = {}   # 显示名称 -> ConversationPosition
+        self.aliases = {}   # 原名称、备注名称 -> 显示名称
+        self.scroll_offset = 0   # 当前会话列表的滚动偏移
+        self.route_counts = {}   # (route, success) -> 次数
+        self.lock = threading.Lock()
+
+    def observe(self, display_names: list):
+        # 根据当前可见的会话列表刷新位置
+        with self.lock:
+            for position, display_name in enumerate(display_names):
+                if display_name:
+                    self.positions[display_name] = ConversationPosition(display_name, position, self.scroll_offset)
+
+    def add_alias(self, display_name: str, *names: str):
+        # 切换成功后记录原名称、备注名称对应的显示名称
+        with self.lock:
+            for name in names:
+                if name and name != display_name:
+                    self.aliases[name] = display_name
+
+    def scroll(self, wheel_times: int):
+        # 记录滚动，正数向下，负数向上
+        with self.lock:
+            self.scroll_offset = max(self.scroll_offset + wheel_times, 0)
+
+    def reset_scroll(self):
+        # 搜索切换等操作后会话列表回到顶部
+        with self.lock:
+            self.scroll_offset = 0
+
+    def lookup(self, conversation: str) -> ConversationPosition | None:
+        with self.lock:
+            position = self.positions.get(self.aliases.get(conversation, conversation))
+            if position and time.time() - position.observed_time > self.ttl_seconds:
+                self.positions.pop(position.display_name)
+                position = None
+            return position
+
+    def get_display_name(self, conversation: str) -> str:
+        with self.lock:
+            return self.aliases.get(conversation, conversation)
+
+    def choose_route(self, conversation: str, visible_names: list) -> (str, ConversationPosition | None):
+        """
+        选择切换方式
+        :return: 切换方式和记录的位置
+        """
+        position = self.lookup(conversation)
+        if conversation in visible_names or self.get_display_name(conversation) in visible_names:
+            return ROUTE_VISIBLE, position
+        if position and position.scroll_offset != self.scroll_offset:
+            return ROUTE_SCROLL, position
+        return ROUTE_SEARCH, position
+
+    def record_route(self, route: str, seconds: float, success: bool):
+        observe_latency('switch_conversation.' + route, seconds, success)
+        with self.lock:
+            self.route_counts[(route, success)] = self.route_counts.get((route, success), 0) + 1
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.positions),
+                'aliasSize': len(self.aliases),
+                'scrollOffset': self.scroll_offset,
+                'routes': {'{}.{}'.format(route, 'success' if success else 'fail'): count
+                           for (route, success), count in self.route_counts.items()},
+            }
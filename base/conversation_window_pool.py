@@ -0,0 +1,109 @@
+"""
+会话窗口池，记录已经打开的会话所在的窗口和匹配名称，再次发送时直接激活，不需要从主窗口搜索
+打开的会话数量达到上限时，打开新会话之前按最近使用淘汰，淘汰项由调用方关闭
+"""
+import threading
+from collections import OrderedDict
+
+from base.control_cache import read_runtime_id
+
+CONVERSATION_WINDOW_POOL_SIZE = 8  # 最多保持打开的会话数量
+
+
+class PooledConversation(object):
+    __slots__ = ('conversation', 'window', 'runtime_id', 'match_names')
+
+    def __init__(self, conversation: str, window, runtime_id: tuple, match_names: list):
+        self.conversation = conversation
+        self.window = window   # 会话所在的窗口，多个会话合并时是同一个窗口的不同标签
+        self.runtime_id = runtime_id
+        self.match_names = match_names   # 备注、昵称、QQ号，用于匹配会话标题和标签
+
+
+class ConversationWindowPool(object):
+
+    def __init__(self, max_size=CONVERSATION_WINDOW_POOL_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()   # conversation -> PooledConversation，按最近使用排序
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0   # 窗口已经关闭的次数
+        self.evict_count = 0
+
+    def get(self, conversation: str) -> PooledConversation | None:
+        """
+        :return: 窗口仍然有效的会话，没有打开或者窗口已经关闭返回None
+        """
+        with self.lock:
+            entry = self.entries.get(conversation)
+            if not entry:
+                self.misses += 1
+                return None
+        # 读取RuntimeId是跨进程调用，不放在锁内
+        is_valid = read_runtime_id(entry.window) == entry.runtime_id
+        with self.lock:
+            if is_valid:
+                self.hits += 1
+                if conversation in self.entries:
+                    self.entries.move_to_end(conversation)
+                return entry
+            self.stale += 1
+            # 同一个窗口中的会话全部失效
+            for key in [k for k, v in self.entries.items() if v.runtime_id == entry.runtime_id]:
+                self.entries.pop(key)
+            return None
+
+    def reserve(self, conversation: str) -> list:
+        """
+        打开新会话之前调用，为新会话腾出位置
+        :return: 按最近使用淘汰的会话列表，需要调用方在打开新会话之前关闭
+        """
+        with self.lock:
+            evict_entries = []
+            while conversation not in self.entries and self.entries and len(self.entries) >= self.max_size:
+                evict_entries.append(self.entries.popitem(last=False)[1])
+                self.evict_count += 1
+            return evict_entries
+
+    def put(self, conversation: str, window, match_names: list) -> list:
+        """
+        记录打开的会话，打开前应该先调用 reserve 关闭超过上限的会话
+        :return: 仍然超过上限被淘汰的会话列表，需要调用方关闭
+        """
+        runtime_id = read_runtime_id(window)
+        if not runtime_id:
+            return []
+        with self.lock:
+            self.entries.pop(conversation, None)
+            self.entries[conversation] = PooledConversation(conversation, window, runtime_id, match_names)
+            evict_entries = []
+            while len(self.entries) > self.max_size:
+                evict_entries.append(self.entries.popitem(last=False)[1])
+                self.evict_count += 1
+            return evict_entries
+
+    def remove(self, conversation: str):
+        with self.lock:
+            self.entries.pop(conversation, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            request_count = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxSize': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / request_count, 3) if request_count else 0,
+                'stale': self.stale,
+                'evictCount': self.evict_count,
+                'conversations': list(self.entries.keys()),
+            }
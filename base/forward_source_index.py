@@ -0,0 +1,88 @@
+"""
+转发源消息索引，记录最近发送到中转会话的消息，key为内容hash（文件摘要或者文本hash）
+相同内容再次批量发送时直接转发已有的消息，不需要重新上传文件并等待上传完成
+索引项有过期时间，使用时还需要在中转会话的最近消息中找到该消息，找不到则失效
+"""
+import os
+import threading
+import time
+
+from base.log import logger
+from base.util import md5_encrypt, md5_file
+
+FORWARD_SOURCE_TTL_SECONDS = 6 * 3600  # 转发源消息有效时间，微信文件一段时间后会过期
+
+
+def file_source_key(filepath: str) -> str:
+    # 文件名也参与key，相同内容不同文件名时转发出去的文件名不一样
+    return 'file:{}:{}'.format(md5_file(filepath), md5_encrypt(os.path.basename(filepath)))
+
+
+def text_source_key(text: str) -> str:
+    return 'text:{}'.format(md5_encrypt(text))
+
+
+def link_source_key(link: str) -> str:
+    return 'link:{}'.format(md5_encrypt(link))
+
+
+class ForwardSource(object):
+    __slots__ = ('key', 'message_type', 'match_value', 'create_time')
+
+    def __init__(self, key: str, message_type: str, match_value: str):
+        self.key = key
+        self.message_type = message_type   # 消息类型，file、text 或 link
+        self.match_value = match_value   # 在消息列表中匹配消息的值，文件为文件名，文本为文本内容，链接卡片为卡片文字
+        self.create_time = time.time()
+
+
+class ForwardSourceIndex(object):
+
+    def __init__(self, ttl_seconds=FORWARD_SOURCE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.sources = {}   # key -> ForwardSource
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+
+    def get(self, key: str) -> ForwardSource | None:
+        with self.lock:
+            source = self.sources.get(key)
+            if source and time.time() - source.create_time > self.ttl_seconds:
+                self.sources.pop(key)
+                self.expired += 1
+                source = None
+            if not source:
+                self.misses += 1
+            return source
+
+    def put(self, key: str, message_type: str, match_value: str):
+        with self.lock:
+            # 消息列表中按匹配值查找最近的消息，相同匹配值的旧索引项会匹配到新消息，需要移除
+            for old_key in [k for k, v in self.sources.items()
+                            if v.message_type == message_type and v.match_value == match_value]:
+                self.sources.pop(old_key)
+            self.sources[key] = ForwardSource(key, message_type, match_value)
+
+    def hit(self, key: str):
+        with self.lock:
+            self.hits += 1
+        logger.info('reuse forward source: {}'.format(key))
+
+    def invalidate(self, key: str):
+        with self.lock:
+            if self.sources.pop(key, None):
+                self.invalidated += 1
+        logger.info('forward source not found in message list, invalidate: {}'.format(key))
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.sources),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'invalidated': self.invalidated,
+            }
@@ -0,0 +1,125 @@
+"""
+历史消息指纹存储，每个会话只保存固定数量的64位内容hash，配合计数字典O(1)判断消息是否已经处理过
+会话数量超过上限时按最近使用淘汰，可选持久化到本地文件，重启后不需要再从界面读取历史消息
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+
+from base.log import logger
+
+HISTORY_RING_SIZE = 200  # 每个会话保存的消息指纹数量
+HISTORY_MAX_CONVERSATIONS = 1000  # 最多保存的会话数量
+
+
+def content_fingerprint(content: str) -> int:
+    # 64位内容hash，不使用内置hash，内置hash每次启动随机，不能持久化
+    return int.from_bytes(hashlib.blake2b((content or '').encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class ConversationHistory(object):
+    """
+    单个会话的消息指纹环，超过容量时淘汰最早的指纹
+    """
+    __slots__ = ('ring', 'counts')
+
+    def __init__(self, ring_size=HISTORY_RING_SIZE):
+        self.ring = deque(maxlen=ring_size)
+        self.counts = {}   # 指纹 -> 环中出现次数，重复消息淘汰一条时不能直接删除
+
+    def add(self, fingerprint: int):
+        if len(self.ring) == self.ring.maxlen:
+            evict = self.ring[0]
+            if self.counts[evict] == 1:
+                del self.counts[evict]
+            else:
+                self.counts[evict] -= 1
+        self.ring.append(fingerprint)
+        self.counts[fingerprint] = self.counts.get(fingerprint, 0) + 1
+
+    def __contains__(self, fingerprint: int):
+        return fingerprint in self.counts
+
+    def __len__(self):
+        return len(self.ring)
+
+
+class HistoryStore(object):
+
+    def __init__(self, ring_size=HISTORY_RING_SIZE, max_conversations=HISTORY_MAX_CONVERSATIONS,
+                 persist_path: str = None):
+        self.ring_size = ring_size
+        self.max_conversations = max_conversations
+        self.persist_path = persist_path
+        self.conversations = OrderedDict()   # conversation -> ConversationHistory，按最近使用排序
+        self.lock = threading.Lock()
+        self.evict_count = 0
+        if persist_path:
+            self.load()
+
+    def _touch(self, conversation: str, create=False) -> ConversationHistory | None:
+        history = self.conversations.get(conversation)
+        if history is not None:
+            self.conversations.move_to_end(conversation)
+        elif create:
+            history = self.conversations[conversation] = ConversationHistory(self.ring_size)
+            while len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+                self.evict_count += 1
+        return history
+
+    def contains_conversation(self, conversation: str) -> bool:
+        with self.lock:
+            return conversation in self.conversations
+
+    def add(self, conversation: str, contents: list):
+        # 记录消息，会话不存在时创建，contents为空时也会创建会话，表示已经记录过
+        with self.lock:
+            history = self._touch(conversation, create=True)
+            for content in contents:
+                history.add(content_fingerprint(content))
+
+    def contains(self, conversation: str, content: str) -> bool:
+        with self.lock:
+            history = self._touch(conversation)
+            return history is not None and content_fingerprint(content) in history
+
+    def size(self, conversation: str) -> int:
+        with self.lock:
+            history = self.conversations.get(conversation)
+            return len(history) if history else 0
+
+    def load(self):
+        if not self.persist_path or not os.path.isfile(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (ValueError, OSError):
+            logger.error('load history store failed: {}'.format(self.persist_path), exc_info=True)
+            return
+        with self.lock:
+            for conversation, fingerprints in data.items():
+                history = self._touch(conversation, create=True)
+                for fingerprint in fingerprints:
+                    history.add(fingerprint)
+        logger.info('load history store: {}, conversation size: {}'.format(self.persist_path, len(data)))
+
+    def save(self):
+        if not self.persist_path:
+            return
+        with self.lock:
+            data = {conversation: list(history.ring) for conversation, history in self.conversations.items()}
+        with open(self.persist_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'conversationCount': len(self.conversations),
+                'fingerprintCount': sum(len(x) for x in self.conversations.values()),
+                'evictCount': self.evict_count,
+                'persistPath': self.persist_path,
+            }
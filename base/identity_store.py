@@ -0,0 +1,88 @@
+"""
+会话身份表，按账号记录备注、昵称、号码到唯一号码的映射，从搜索结果中学习并持久化到本地文件
+再次搜索时使用唯一号码搜索，只会有一个精确的结果，避免名称相似的联系人和群聊匹配错误
+"""
+import json
+import os
+import threading
+
+from base.log import logger
+
+
+class IdentityStore(object):
+
+    def __init__(self, persist_path: str = None):
+        self.persist_path = persist_path
+        self.aliases = {}   # 备注、昵称、号码 -> 唯一号码
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidate_count = 0
+        if persist_path:
+            self.load()
+
+    def lookup(self, alias: str) -> str | None:
+        with self.lock:
+            number = self.aliases.get(alias)
+            if number:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return number
+
+    def learn(self, number: str, names: list):
+        """
+        记录一次搜索匹配结果，有变化时持久化
+        :param number: 唯一号码
+        :param names: 搜索使用的名称和结果中的备注、昵称
+        """
+        with self.lock:
+            changed = False
+            for name in [number] + [x for x in names if x]:
+                if self.aliases.get(name) != number:
+                    self.aliases[name] = number
+                    changed = True
+        if changed:
+            logger.info('learn conversation identity. number: {}, names: {}'.format(number, names))
+            self.save()
+
+    def invalidate(self, alias: str):
+        # 使用号码搜索不到或者不匹配时移除，比如改了备注、退出了群聊
+        with self.lock:
+            if self.aliases.pop(alias, None) is None:
+                return
+            self.invalidate_count += 1
+        logger.info('invalidate conversation identity: {}'.format(alias))
+        self.save()
+
+    def load(self):
+        if not self.persist_path or not os.path.isfile(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (ValueError, OSError):
+            logger.error('load identity store failed: {}'.format(self.persist_path), exc_info=True)
+            return
+        with self.lock:
+            self.aliases.update(data)
+        logger.info('load identity store: {}, alias size: {}'.format(self.persist_path, len(data)))
+
+    def save(self):
+        if not self.persist_path:
+            return
+        with self.lock:
+            data = dict(self.aliases)
+        with open(self.persist_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'aliasCount': len(self.aliases),
+                'numberCount': len(set(self.aliases.values())),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidateCount': self.invalidate_count,
+                'persistPath': self.persist_path,
+            }
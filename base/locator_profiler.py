@@ -0,0 +1,186 @@
+"""
+控件定位学习，深度搜索成功后记录控件到根控件的父节点链，生成等价的 select_control 路径，并按应用名称和版本持久化
+后续优先使用学习到的路径快速定位，校验控件类型、类名和名称，校验失败再回退到深度搜索
+命中和未命中统计可以看出节省了多少搜索时间
+"""
+import json
+import os
+import threading
+import time
+
+from base.control_snapshot import ControlTreeSnapshot, SnapshotNode
+from base.log import logger
+from base.selector import compile_selector
+from base.util import get_cache_path
+
+
+def derive_selector(root_node: SnapshotNode, target_node: SnapshotNode) -> str | None:
+    """
+    根据快照中的父节点链生成选择器，如 pane:1>pane>pane-2>list，目标节点不在根节点下时返回None
+    """
+    items = []
+    node = target_node
+    while node is not root_node:
+        parent = node.parent
+        if parent is None or not node.control_type_name:
+            return None
+        same_type_index = 0
+        for sibling in parent.children:
+            if sibling is node:
+                break
+            if sibling.control_type_name == node.control_type_name:
+                same_type_index += 1
+        item = node.control_type_name[:-len('Control')].lower()
+        items.append(item + (':{}'.format(same_type_index) if same_type_index else ''))
+        node = parent
+    if not items:
+        return None
+    items.reverse()
+    # 合并连续相同的选择项，pane>pane>pane 简写为 pane-3
+    merge_items = []
+    for item in items:
+        if merge_items and merge_items[-1][0] == item and ':' not in item:
+            merge_items[-1][1] += 1
+        else:
+            merge_items.append([item, 1])
+    return '>'.join(x[0] if x[1] == 1 else '{}-{}'.format(x[0], x[1]) for x in merge_items)
+
+
+class LearnedLocator(object):
+
+    def __init__(self, selector: str, control_type_name: str, class_name: str, name: str | None):
+        self.selector = selector
+        self.control_type_name = control_type_name
+        self.class_name = class_name
+        self.name = name   # 控件名称，为None表示名称会变化（如会话标题），不校验名称
+        self.hits = 0   # 快速路径命中次数
+        self.misses = 0   # 快速路径校验失败次数
+        self.search_count = 0   # 深度搜索次数
+        self.search_seconds = 0.0   # 深度搜索总耗时
+        self.fast_seconds = 0.0   # 快速路径总耗时
+
+    def to_dict(self) -> dict:
+        return {
+            'selector': self.selector,
+            'controlTypeName': self.control_type_name,
+            'className': self.class_name,
+            'name': self.name,
+        }
+
+    def stats_to_dict(self) -> dict:
+        avg_search_seconds = self.search_seconds / self.search_count if self.search_count else 0
+        avg_fast_seconds = self.fast_seconds / (self.hits + self.misses) if self.hits + self.misses else 0
+        return {
+            **self.to_dict(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'searchCount': self.search_count,
+            'avgSearchSeconds': round(avg_search_seconds, 3),
+            'avgFastSeconds': round(avg_fast_seconds, 3),
+            'savedSeconds': round(self.hits * max(avg_search_seconds - avg_fast_seconds, 0), 3),
+        }
+
+
+class LocatorProfiler(object):
+    """
+    按应用名称和版本保存学习到的定位路径，不同版本的控件树结构可能不同，所以分开保存
+    """
+
+    def __init__(self, app_name: str, app_version: str):
+        self.app_name = app_name
+        self.app_version = app_version
+        self.locators = {}   # tag -> LearnedLocator
+        self.lock = threading.Lock()
+        self.cache_path = get_cache_path('locator-{}-{}.json'.format(app_name, app_version or 'unknown'))
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                for tag, item in json.load(f).items():
+                    if 'name' not in item:
+                        # 旧版本没有记录名称，重新学习
+                        continue
+                    self.locators[tag] = LearnedLocator(item['selector'], item['controlTypeName'], item['className'],
+                                                        item['name'])
+            logger.info('load learned locators: {}, size: {}'.format(self.cache_path, len(self.locators)))
+        except (ValueError, KeyError, OSError):
+            logger.error('load learned locators failed: {}'.format(self.cache_path), exc_info=True)
+
+    def save(self):
+        with self.lock:
+            data = {tag: x.to_dict() for tag, x in self.locators.items() if x.selector}
+        with open(self.cache_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+
+    def locate(self, tag: str, root_control):
+        """
+        使用学习到的路径快速定位，并校验控件类型、类名和名称，同类型的兄弟控件位置变化时名称不同
+        :return: 校验通过的控件，没有学习过或者校验失败返回None
+        """
+        locator = self.locators.get(tag)
+        if not locator or not locator.selector or not root_control:
+            return None
+        begin_time = time.time()
+        find_control = compile_selector(locator.selector).resolve(root_control)
+        is_valid = find_control is not None and find_control.ControlTypeName == locator.control_type_name \
+            and find_control.ClassName == locator.class_name \
+            and (locator.name is None or find_control.Name == locator.name)
+        locator.fast_seconds += time.time() - begin_time
+        if is_valid:
+            locator.hits += 1
+            return find_control
+        locator.misses += 1
+        logger.info('learned locator invalid, fallback to search. tag: {}, selector: {}'.format(tag, locator.selector))
+        return None
+
+    def learn(self, tag: str, root_control, find_control, search_seconds: float):
+        """
+        记录一次深度搜索结果，路径有变化时重新生成并持久化
+        :param tag: 控件标识
+        :param root_control: 根控件，路径相对该控件
+        :param find_control: 深度搜索找到的控件
+        :param search_seconds: 深度搜索耗时
+        """
+        locator = self.locators.get(tag)
+        if locator:
+            locator.search_count += 1
+            locator.search_seconds += search_seconds
+        snapshot = ControlTreeSnapshot.capture(root_control)
+        target_node = snapshot.find_node(find_control)
+        selector = derive_selector(snapshot.root, target_node) if target_node else None
+        if not selector:
+            logger.info('can not derive selector, control is not under root. tag: {}'.format(tag))
+            return None
+        if locator and locator.selector == selector and locator.name is not None and locator.name != target_node.name:
+            # 路径相同但名称不同，说明名称会变化，之后不再校验名称
+            locator.name = None
+            logger.info('learn locator with dynamic name. tag: {}, selector: {}'.format(tag, selector))
+            self.save()
+        if not locator or locator.selector != selector:
+            new_locator = LearnedLocator(selector, target_node.control_type_name, target_node.class_name,
+                                         target_node.name)
+            if locator:
+                # 保留原有统计
+                new_locator.__dict__.update({k: v for k, v in locator.__dict__.items()
+                                             if k not in ['selector', 'control_type_name', 'class_name', 'name']})
+            else:
+                new_locator.search_count, new_locator.search_seconds = 1, search_seconds
+            with self.lock:
+                self.locators[tag] = new_locator
+            logger.info('learn locator. app: {} {}, tag: {}, selector: {}'
+                        .format(self.app_name, self.app_version, tag, selector))
+            self.save()
+        return selector
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            locators = {tag: x.stats_to_dict() for tag, x in self.locators.items()}
+        return {
+            'appName': self.app_name,
+            'appVersion': self.app_version,
+            'savedSeconds': round(sum(x['savedSeconds'] for x in locators.values()), 3),
+            'locators': locators,
+        }
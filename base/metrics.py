@@ -0,0 +1,137 @@
+"""
+性能统计，记录各个步骤的耗时直方图，用于观察等待、查找、上传等步骤的耗时分布
+以及按实际观察到的耗时估计吞吐量，用于计算等待超时时间
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# 直方图桶上界，单位秒，最后一个桶表示超过最大上界
+LATENCY_BUCKETS = (0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30)
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, name: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0   # 总次数
+        self.fail_count = 0   # 失败次数，比如等待超时
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float, success=True):
+        with self.lock:
+            index = 0
+            while index < len(self.buckets) and seconds > self.buckets[index]:
+                index += 1
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.fail_count += 0 if success else 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            bucket_names = ['<={}s'.format(x) for x in self.buckets] + ['>{}s'.format(self.buckets[-1])]
+            return {
+                'name': self.name,
+                'count': self.count,
+                'failCount': self.fail_count,
+                'totalSeconds': round(self.total_seconds, 3),
+                'avgSeconds': round(self.total_seconds / self.count, 3) if self.count else 0,
+                'maxSeconds': round(self.max_seconds, 3),
+                'buckets': dict(zip(bucket_names, self.bucket_counts)),
+            }
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def get_histogram(name: str) -> LatencyHistogram:
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = LatencyHistogram(name)
+        return _histograms[name]
+
+
+def observe_latency(name: str, seconds: float, success=True):
+    """
+    记录一次耗时
+    :param name: 统计名称，使用 . 分隔分组，如 wait.forward_menu
+    :param seconds: 耗时秒
+    :param success: 是否成功
+    """
+    get_histogram(name).observe(seconds, success)
+
+
+@contextmanager
+def latency_timer(name: str):
+    # 记录代码块耗时，代码块抛出异常时记为失败
+    begin_time = time.time()
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        observe_latency(name, time.time() - begin_time, success)
+
+
+def histograms_to_dict(prefix='') -> list:
+    """
+    导出耗时统计，按照总耗时倒序，方便看哪些步骤占用时间最多
+    :param prefix: 统计名称前缀过滤
+    """
+    with _histograms_lock:
+        histograms = [x for name, x in _histograms.items() if name.startswith(prefix)]
+    return sorted([x.to_dict() for x in histograms], key=lambda x: x['totalSeconds'], reverse=True)
+
+
+class ThroughputEstimator(object):
+    """
+    吞吐量估计，使用指数加权平均，比如根据文件大小和上传耗时估计上传速度，用于计算等待上传完成的超时时间
+    """
+
+    def __init__(self, name: str, initial_bytes_per_second: float, base_seconds=1.0, safety_factor=2.0,
+                 min_seconds=3.0, max_seconds=300.0, alpha=0.3):
+        self.name = name
+        self.bytes_per_second = initial_bytes_per_second
+        self.base_seconds = base_seconds   # 和大小无关的固定耗时
+        self.safety_factor = safety_factor   # 超时时间相对估计耗时的倍数
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.alpha = alpha
+        self.sample_count = 0
+        self.lock = threading.Lock()
+
+    def estimate_seconds(self, size: int) -> float:
+        # 估计耗时
+        with self.lock:
+            return self.base_seconds + size / self.bytes_per_second
+
+    def timeout_seconds(self, size: int) -> float:
+        # 等待超时时间
+        return min(max(self.estimate_seconds(size) * self.safety_factor, self.min_seconds), self.max_seconds)
+
+    def observe(self, size: int, seconds: float, success=True):
+        """
+        记录一次观察，超时的观察耗时是实际耗时的下限，同样用于更新估计，使下次的超时时间更长
+        """
+        observe_latency(self.name, seconds, success)
+        transfer_seconds = seconds - self.base_seconds
+        if size <= 0 or transfer_seconds <= 0:
+            return
+        with self.lock:
+            self.bytes_per_second = (1 - self.alpha) * self.bytes_per_second + self.alpha * size / transfer_seconds
+            self.sample_count += 1
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'name': self.name,
+                'bytesPerSecond': round(self.bytes_per_second),
+                'sampleCount': self.sample_count,
+            }
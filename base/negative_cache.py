@@ -0,0 +1,57 @@
+"""
+否定缓存，记录一段时间内确认不存在的key，比如搜索不到的会话名称，再次请求时直接失败，不需要重复操作界面
+"""
+import threading
+import time
+
+from base.log import logger
+
+
+class NegativeCache(object):
+
+    def __init__(self, name: str, ttl_seconds: float):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}   # key -> (reason, expire_time)
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, key: str) -> str | None:
+        """
+        :return: 未过期时返回记录的原因，否则返回None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] < time.time():
+                self.entries.pop(key)
+                entry = None
+            if entry:
+                self.hits += 1
+            return entry[0] if entry else None
+
+    def add(self, key: str, reason: str):
+        with self.lock:
+            self.entries[key] = (reason, time.time() + self.ttl_seconds)
+        logger.info('add negative cache: {}, key: {}, reason: {}'.format(self.name, key, reason))
+
+    def invalidate(self, keys: list = None) -> int:
+        """
+        移除缓存，keys为空时全部移除
+        :return: 移除的数量
+        """
+        with self.lock:
+            if not keys:
+                count = len(self.entries)
+                self.entries = {}
+                return count
+            return sum(1 for key in keys if self.entries.pop(key, None))
+
+    def to_dict(self) -> dict:
+        now = time.time()
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'entries': [{'key': key, 'reason': reason, 'ttlSeconds': round(expire_time - now)}
+                            for key, (reason, expire_time) in self.entries.items() if expire_time >= now],
+            }
@@ -0,0 +1,141 @@
+"""
+控件树路径选择器编译和解析，选择器语法参考 base.control_util.select_control
+选择器字符串只解析一次，编译结果为不可变的步骤元组，并按选择器字符串放入有界LRU缓存，热点路径上重复查找时不再重复解析
+解析器只依赖控件的 GetChildren、GetParentControl、ControlTypeName 三个接口，既可以作用于uiautomation的Control，也可以作用于快照节点
+"""
+import re
+import timeit
+from collections import namedtuple
+from functools import lru_cache
+
+SELECTOR_CACHE_SIZE = 256  # 编译后选择器的缓存数量
+PARENT_ITEMS = ('p', '.')  # 表示父节点的选择项
+
+# 选择器单步：is_parent 是否取父节点，control_type 匹配的控件类型（小写，如 panecontrol，为空匹配所有），index 同类型子节点索引
+SelectorStep = namedtuple('SelectorStep', ['is_parent', 'control_type', 'index'])
+
+
+class CompiledSelector(object):
+    """
+    编译后的选择器，创建后不再修改，可以在多个线程中安全复用
+    """
+    __slots__ = ('selector', 'steps')
+
+    def __init__(self, selector: str, steps: tuple):
+        self.selector = selector
+        self.steps = steps
+
+    def resolve(self, root_control):
+        """
+        从基准控件开始逐步迭代查找，任意一步找不到则返回None
+        :param root_control 基准control
+        :return 查找到的控件
+        """
+        return resolve_steps(root_control, self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return 'CompiledSelector({!r}, steps={})'.format(self.selector, len(self.steps))
+
+
+def parse_select_item(select_item: str) -> SelectorStep:
+    """
+    解析单个选择项，如 pane:1，p，:2，text
+    """
+    if select_item in PARENT_ITEMS:
+        return SelectorStep(True, '', 0)
+    index = 0
+    if ':' in select_item:
+        # 子节点索引解析
+        select_item, index = select_item.split(':')
+        index = int(index)
+    control_type = select_item.strip().lower()
+    # 控件简化信息补全，留空表示匹配所有子节点
+    control_type = control_type + 'control' if control_type else ''
+    return SelectorStep(False, control_type, index)
+
+
+def expand_selector_items(selector: str) -> list:
+    """
+    拆分选择器并展开重复简写，pane-4 展开为 [pane, pane, pane, pane]
+    """
+    expand_items = []
+    for item in re.split(r' *> *', selector):
+        if '-' in item:
+            item, times = item.split('-')
+            expand_items.extend([item] * int(times))
+        else:
+            expand_items.append(item)
+    return expand_items
+
+
+def parse_selector(selector: str) -> CompiledSelector:
+    """
+    解析选择器，不使用缓存
+    """
+    steps = tuple(parse_select_item(item) for item in expand_selector_items(selector))
+    return CompiledSelector(selector, steps)
+
+
+@lru_cache(maxsize=SELECTOR_CACHE_SIZE)
+def compile_selector(selector: str) -> CompiledSelector:
+    """
+    编译选择器，相同的选择器字符串直接返回缓存的编译结果
+    """
+    return parse_selector(selector)
+
+
+def selector_cache_info():
+    # 选择器缓存命中信息，用于观察缓存大小是否合适
+    return compile_selector.cache_info()
+
+
+def match_child_control(children, step: SelectorStep):
+    # 在子节点中按照控件类型和同类型索引匹配
+    same_control_index = 0
+    for control in children:
+        if not step.control_type or control.ControlTypeName.lower() == step.control_type:
+            # 和索引相同则命中
+            if step.index == same_control_index:
+                return control
+            # 相同的control类型计数 +1
+            same_control_index += 1
+    return None
+
+
+def resolve_steps(root_control, steps):
+    """
+    迭代查找控件，每一层只获取一次子节点列表
+    """
+    control = root_control
+    for step in steps:
+        # 中间节点为空则没找到
+        if not control:
+            return None
+        if step.is_parent:
+            control = control.GetParentControl()
+            continue
+        children = control.GetChildren()
+        # 没有子节点返回空
+        if not children:
+            return None
+        control = match_child_control(children, step)
+    return control if control else None
+
+
+def benchmark_test(number=100000):
+    # 对比每次重新解析和使用编译缓存的耗时
+    selectors = ['p>pane:1>pane-6>pane:1>pane-2', 'pane>pane:1>pane-6>text', '>:1>:2>:5>button:2',
+                 '.>.>pane>edit', 'p>p>p>:1>:1>>>>button', ':1>>:1>-4>text']
+    parse_seconds = timeit.timeit(lambda: [parse_selector(x) for x in selectors], number=number)
+    compile_seconds = timeit.timeit(lambda: [compile_selector(x) for x in selectors], number=number)
+    total = number * len(selectors)
+    print('parse selector every time: {:.3f}s, {:.2f}us/op'.format(parse_seconds, parse_seconds * 1e6 / total))
+    print('compiled selector cache: {:.3f}s, {:.2f}us/op'.format(compile_seconds, compile_seconds * 1e6 / total))
+    print('cache info: {}'.format(selector_cache_info()))
+
+
+if __name__ == '__main__':
+    benchmark_test()
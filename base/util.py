@@ -4,21 +4,26 @@
 import datetime
 import hashlib
 import os
+import queue
 import random
 import re
 import socket
 import sys
+import threading
 import time
 import ctypes
 import psutil
+from contextlib import contextmanager
 from ctypes import sizeof, c_uint, c_long, c_int, c_bool, Structure
 
 import mss
+import win32api
 import win32clipboard
 import win32con
 from PIL import Image
 
 from base.log import logger
+from base.metrics import observe_latency
 
 
 class DROPFILES(Structure):
@@ -63,6 +68,33 @@ def md5_encrypt(content: str):
     return md5_hash.hexdigest()
 
 
+# 文件内容hash，分块读取避免大文件占用内存
+def md5_file(filepath: str, chunk_size=1024 * 1024):
+    md5_hash = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5_hash.update(chunk)
+    return md5_hash.hexdigest()
+
+
+# 去掉换行符和忽略的短语后判断文本是否以suffix结尾，只从尾部截取有限长度进行规范化，不处理整个文本
+def normalized_endswith(text: str, suffix: str, ignore_phrases=()) -> bool:
+    def normalize(value: str) -> str:
+        for phrase in ignore_phrases:
+            value = value.replace(phrase, '')
+        return value.replace('\r', '').replace('\n', '')
+
+    suffix = normalize(suffix)
+    # 截取窗口的开头可能截断了忽略的短语，规范化后的长度需要多出最长的短语才能判断
+    margin = max((len(x) for x in ignore_phrases), default=0)
+    window = (len(suffix) + margin) * 2 + 16
+    while True:
+        tail = normalize(text[-window:])
+        if len(tail) >= len(suffix) + margin or window >= len(text):
+            return tail.endswith(suffix)
+        window *= 2
+
+
 def get_save_file_path(filename: str):
     # 处理特殊字符替换，windows不允许文件名出现这些特殊字符
     filename = re.sub(r"[\\/?*<>|\":]+", '-', filename)
@@ -111,30 +143,179 @@ def get_localhost_ip():
     return socket.gethostbyname(hostname)
 
 
+# 将文件路径转换为剪贴板CF_HDROP格式数据，参考：<https://blog.51cto.com/u_11866025/5833952>
+def build_drop_files_data(paths) -> bytes:
+    files = ("\0".join(paths)).replace("/", "\\")
+    return mate_data + files.encode("U16")[2:] + b"\0\0"
+
+
+class ClipboardService(object):
+    """
+    剪贴板服务，所有剪贴板操作提交到同一个线程串行执行，避免多个请求同时操作剪贴板
+    剪贴板被其他进程占用时，打开剪贴板会短暂退避重试，打开等待的耗时记录到 clipboard.open 统计中
+    """
+    OPEN_RETRY_TIMES = 8
+    OPEN_RETRY_INTERVAL = 0.01   # 首次重试间隔，之后每次翻倍
+    OPEN_RETRY_MAX_INTERVAL = 0.2
+
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.contention_count = 0   # 打开剪贴板需要重试的次数
+        self.session_lock = threading.RLock()   # 剪贴板会话锁，设置和粘贴之间不能被其他请求修改剪贴板
+
+    def _ensure_started(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, name='clipboard-owner', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            func, result = self.tasks.get()
+            try:
+                result['value'] = func()
+            except Exception as e:
+                result['exception'] = e
+            result['done'].set()
+
+    def call(self, func):
+        # 在剪贴板线程中执行，等待执行完成并返回结果
+        if threading.current_thread() is self.thread:
+            return func()
+        self._ensure_started()
+        result = {'done': threading.Event()}
+        self.tasks.put((func, result))
+        result['done'].wait()
+        if 'exception' in result:
+            raise result['exception']
+        return result.get('value')
+
+    def _open(self):
+        begin_time = time.time()
+        interval = self.OPEN_RETRY_INTERVAL
+        for retry_times in range(self.OPEN_RETRY_TIMES + 1):
+            try:
+                win32clipboard.OpenClipboard()
+                observe_latency('clipboard.open', time.time() - begin_time)
+                return
+            except win32clipboard.error:
+                if retry_times == 0:
+                    self.contention_count += 1
+                if retry_times == self.OPEN_RETRY_TIMES:
+                    observe_latency('clipboard.open', time.time() - begin_time, False)
+                    raise
+                time.sleep(interval)
+                interval = min(interval * 2, self.OPEN_RETRY_MAX_INTERVAL)
+
+    def transaction(self, func):
+        """
+        打开剪贴板执行操作后关闭，在剪贴板线程中执行
+        """
+        def run():
+            self._open()
+            try:
+                return func()
+            finally:
+                win32clipboard.CloseClipboard()
+        return self.call(run)
+
+    def set(self, text: str = None, paths: list = None):
+        """
+        在一次事务中设置文本和文件，两者都传时同时设置两种格式
+        """
+        def run():
+            win32clipboard.EmptyClipboard()
+            if text is not None:
+                win32clipboard.SetClipboardText(text, win32con.CF_UNICODETEXT)
+            if paths:
+                win32clipboard.SetClipboardData(win32clipboard.CF_HDROP, build_drop_files_data(paths))
+        self.transaction(run)
+
+    def read_text(self) -> str:
+        return self.transaction(lambda: win32clipboard.GetClipboardData(win32clipboard.CF_UNICODETEXT))
+
+    def save(self) -> dict:
+        """
+        保存当前剪贴板内容，只保存数据格式，位图句柄等格式无法保存会跳过
+        :return: 格式 -> 数据
+        """
+        def run():
+            saved_data = {}
+            clipboard_format = win32clipboard.EnumClipboardFormats(0)
+            while clipboard_format:
+                try:
+                    data = win32clipboard.GetClipboardData(clipboard_format)
+                    if isinstance(data, (bytes, str, tuple)):
+                        saved_data[clipboard_format] = data
+                except win32clipboard.error:
+                    pass
+                clipboard_format = win32clipboard.EnumClipboardFormats(clipboard_format)
+            return saved_data
+        return self.transaction(run)
+
+    def restore(self, saved_data: dict):
+        def run():
+            win32clipboard.EmptyClipboard()
+            for clipboard_format, data in saved_data.items():
+                if clipboard_format == win32clipboard.CF_HDROP:
+                    data = build_drop_files_data(data)
+                try:
+                    win32clipboard.SetClipboardData(clipboard_format, data)
+                except win32clipboard.error:
+                    logger.warning('restore clipboard format failed: {}'.format(clipboard_format))
+        self.transaction(run)
+
+    @contextmanager
+    def preserved(self):
+        """
+        剪贴板会话：期间独占剪贴板，设置内容、粘贴、读取等多步操作不会被其他请求打断，结束后恢复用户原来的剪贴板内容
+        """
+        with self.session_lock:
+            saved_data = self.save()
+            try:
+                yield self
+            finally:
+                self.restore(saved_data)
+
+    def to_dict(self) -> dict:
+        return {
+            'pendingCount': self.tasks.qsize(),
+            'contentionCount': self.contention_count,
+        }
+
+
+clipboard_service = ClipboardService()
+
+
 def win32_clipboard_text(text: str):
     # 复制文本内容到剪贴板
-    win32clipboard.OpenClipboard()
-    win32clipboard.EmptyClipboard()
-    win32clipboard.SetClipboardText(text, win32con.CF_UNICODETEXT)
-    win32clipboard.CloseClipboard()
+    clipboard_service.set(text=text)
 
 
 def win32_read_clipboard_text() -> str:
-    win32clipboard.OpenClipboard()
-    try:
-        return win32clipboard.GetClipboardData(win32clipboard.CF_UNICODETEXT)
-    finally:
-        win32clipboard.CloseClipboard()
+    return clipboard_service.read_text()
 
 
-# 将文件复制到剪贴板，参考：<https://blog.51cto.com/u_11866025/5833952>
+# 将文件复制到剪贴板
 def win32_clipboard_files(paths: list):
-    files = ("\0".join(paths)).replace("/", "\\")
-    data = files.encode("U16")[2:] + b"\0\0"
-    win32clipboard.OpenClipboard()
-    win32clipboard.EmptyClipboard()
-    win32clipboard.SetClipboardData(win32clipboard.CF_HDROP, mate_data + data)
-    win32clipboard.CloseClipboard()
+    clipboard_service.set(paths=paths)
+
+
+def win32_paste_text(control, text: str, clear=False):
+    """
+    通过剪贴板向控件粘贴文本，粘贴完成后恢复用户原来的剪贴板内容
+    :param control: 粘贴的目标控件，需要已经获得焦点
+    :param text: 粘贴的文本
+    :param clear: 粘贴前是否全选，替换控件中已有的内容
+    """
+    with clipboard_service.preserved():
+        clipboard_service.set(text=text)
+        if clear:
+            control.SendKeys('{Ctrl}a', waitTime=0)
+        # 等待应用处理完粘贴再恢复剪贴板，不能使用 waitTime=0
+        control.SendKeys('{Ctrl}v')
 
 
 # Pyinstaller 可以将资源文件一起bundle到exe中，当exe在运行时，会生成一个临时文件夹，程序可通过sys._MEIPASS访问临时文件夹中的资源
@@ -160,6 +341,28 @@ def get_current_dir():
         return os.path.dirname(os.path.abspath(sys.argv[0]))
 
 
+def get_cache_path(filename: str):
+    # 本地缓存文件路径，缓存目录不存在时创建
+    cache_dir = os.path.join(get_current_dir(), 'cache')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, filename)
+
+
+def get_process_file_version(process_id: int) -> str:
+    """
+    获取进程可执行文件的版本号，比如微信 3.9.6.33，获取失败返回空
+    """
+    try:
+        exe_path = psutil.Process(process_id).exe()
+        version_info = win32api.GetFileVersionInfo(exe_path, '\\')
+        ms, ls = version_info['FileVersionMS'], version_info['FileVersionLS']
+        return '{}.{}.{}.{}'.format(ms >> 16, ms & 0xFFFF, ls >> 16, ls & 0xFFFF)
+    except Exception as e:
+        logger.warning('get process file version failed. process_id: {}, error: {}'.format(process_id, e))
+        return ''
+
+
 # 使用命令行一次性打开多个应用程序客户端
 # 用于打开多个微信客户端时，需要没有已登录的微信
 def open_multi_app(path, count):
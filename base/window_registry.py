@@ -0,0 +1,326 @@
+"""
+进程级顶层窗口注册表，启动时枚举一次顶层窗口，之后通过窗口销毁、显示隐藏、名称变化事件保持更新
+事件只监听通过 track_process 登记的目标进程（微信、QQ），不监听整个桌面，回调中先过滤非窗口对象的事件
+没有登记进程或者事件监听失败时，按 POLL_INTERVAL_SECONDS 轮询刷新兜底，查找未命中时同步刷新一次，
+未监听进程的窗口信息可能过期，查找命中时重新读取一次窗口信息校验
+查找顶层窗口时只需要读取字典，不需要每次遍历桌面的所有子窗口
+同时记录被监听窗口内的名称变化和显示隐藏次数，供 WindowWatcher 等待界面变化，整个进程只有一个事件消息循环
+"""
+import ctypes
+import threading
+import time
+from ctypes import wintypes
+
+import win32gui
+import win32process
+
+from base.log import logger
+
+# 参考 WinUser.h
+EVENT_OBJECT_DESTROY = 0x8001
+EVENT_OBJECT_SHOW = 0x8002
+EVENT_OBJECT_HIDE = 0x8003
+EVENT_OBJECT_NAMECHANGE = 0x800C
+WINEVENT_OUTOFCONTEXT = 0x0000
+WINEVENT_SKIPOWNPROCESS = 0x0002
+OBJID_WINDOW = 0
+GA_ROOT = 2
+PM_NOREMOVE = 0x0000
+WM_TRACK_PROCESS = 0x8000 + 1  # WM_APP + 1，通知事件线程为新登记的进程安装监听
+# 只监听用到的事件：销毁、显示、隐藏维护注册表，名称变化更新窗口名称
+HOOK_EVENT_RANGES = [(EVENT_OBJECT_DESTROY, EVENT_OBJECT_HIDE), (EVENT_OBJECT_NAMECHANGE, EVENT_OBJECT_NAMECHANGE)]
+
+POLL_INTERVAL_SECONDS = 5  # 事件监听不可用时的轮询间隔
+MISS_REFRESH_SECONDS = 0.5  # 查找未命中时，距离上次刷新超过该秒数则同步刷新一次，避免事件延迟导致漏查
+
+WinEventProcType = ctypes.WINFUNCTYPE(None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND, wintypes.LONG,
+                                      wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+user32 = ctypes.windll.user32
+user32.SetWinEventHook.restype = wintypes.HANDLE
+user32.SetWinEventHook.argtypes = [wintypes.DWORD, wintypes.DWORD, wintypes.HMODULE, WinEventProcType,
+                                   wintypes.DWORD, wintypes.DWORD, wintypes.DWORD]
+user32.GetAncestor.restype = wintypes.HWND
+user32.GetAncestor.argtypes = [wintypes.HWND, wintypes.UINT]
+user32.UnhookWinEvent.argtypes = [wintypes.HANDLE]
+user32.PostThreadMessageW.argtypes = [wintypes.DWORD, wintypes.UINT, wintypes.WPARAM, wintypes.LPARAM]
+kernel32 = ctypes.windll.kernel32
+
+
+def get_native(module_name: str, name: str):
+    """
+    获取gevent monkey patch之前的原生对象，gevent patch后 threading.Thread 是协程，
+    GetMessageW 这类阻塞的系统调用会卡住整个进程，消息循环需要运行在原生线程中
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return getattr(__import__(module_name), name)
+    return monkey.get_original(module_name, name)
+
+
+class WindowInfo(object):
+    """
+    顶层窗口信息，属性命名兼容控件快照节点，可以直接代替 find_top_window_nodes 的返回结果
+    """
+    __slots__ = ('handle', 'name', 'class_name', 'process_id')
+
+    def __init__(self, handle: int, name: str, class_name: str, process_id: int):
+        self.handle = handle
+        self.name = name
+        self.class_name = class_name
+        self.process_id = process_id
+
+    @staticmethod
+    def from_handle(handle: int) -> 'WindowInfo | None':
+        try:
+            _, process_id = win32process.GetWindowThreadProcessId(handle)
+            return WindowInfo(handle, win32gui.GetWindowText(handle), win32gui.GetClassName(handle), process_id)
+        except win32gui.error:
+            # 窗口已经销毁
+            return None
+
+    @property
+    def Name(self) -> str:
+        return self.name
+
+    @property
+    def ClassName(self) -> str:
+        return self.class_name
+
+    @property
+    def control(self):
+        import uiautomation as auto
+        return auto.ControlFromHandle(self.handle)
+
+    def __repr__(self):
+        return 'WindowInfo(0x{:X}, name={!r}, class_name={!r}, pid={})'.format(
+            self.handle, self.name, self.class_name, self.process_id)
+
+
+def is_top_level_window(handle: int) -> bool:
+    return bool(handle) and win32gui.IsWindow(handle) and win32gui.IsWindowVisible(handle) \
+        and user32.GetAncestor(handle, GA_ROOT) == handle
+
+
+class WindowRegistry(object):
+
+    def __init__(self, poll_interval=POLL_INTERVAL_SECONDS):
+        self.windows = {}   # handle -> WindowInfo
+        # 事件回调运行在原生线程中，需要使用原生锁，临界区很短，协程中获取时不会长时间阻塞
+        self.lock = get_native('_thread', 'allocate_lock')()
+        self.change_counts = {}   # 被监听的窗口 -> 窗口内名称变化和显示隐藏的次数
+        self.process_ids = set()   # 登记的目标进程
+        self.hooks = {}   # 已经安装事件监听的进程 -> 监听句柄列表，只在事件线程中修改
+        self.poll_interval = poll_interval
+        self.last_refresh_time = 0
+        self.refresh_count = 0
+        self.event_count = 0
+        self._started = False
+        self._event_thread_id = None
+        self._event_proc = None   # 保持回调引用，避免被回收
+
+    @property
+    def event_hooked(self) -> bool:
+        # 至少一个目标进程安装了事件监听
+        return bool(self.hooks)
+
+    def is_process_hooked(self, process_id: int) -> bool:
+        return process_id in self.hooks
+
+    def start(self):
+        """
+        首次填充注册表，并启动事件监听线程，没有登记进程或者事件监听失败时只使用轮询刷新
+        """
+        with self.lock:
+            if self._started:
+                return
+            self._started = True
+        self.refresh()
+        get_native('_thread', 'start_new_thread')(self._event_loop, ())
+        threading.Thread(target=self._poll_loop, name='window-registry-poll', daemon=True).start()
+
+    def refresh(self):
+        # 全量枚举顶层窗口，只使用Win32接口，不产生UIA跨进程调用
+        windows = {}
+
+        def enum_callback(handle, _):
+            if win32gui.IsWindowVisible(handle):
+                window_info = WindowInfo.from_handle(handle)
+                if window_info:
+                    windows[handle] = window_info
+            return True
+
+        win32gui.EnumWindows(enum_callback, None)
+        with self.lock:
+            self.windows = windows
+            self.last_refresh_time = time.time()
+            self.refresh_count += 1
+
+    def track_process(self, process_id: int):
+        """
+        登记目标进程，只监听这些进程的窗口事件，可以在启动后调用
+        """
+        if not process_id:
+            return
+        if not self._started:
+            self.start()
+        with self.lock:
+            if process_id in self.process_ids:
+                return
+            self.process_ids.add(process_id)
+            event_thread_id = self._event_thread_id
+        # 事件线程已经启动时通知它安装监听，否则由事件线程启动时统一安装
+        if event_thread_id:
+            user32.PostThreadMessageW(event_thread_id, WM_TRACK_PROCESS, process_id, 0)
+
+    def _on_event(self, hook, event, handle, id_object, id_child, thread_id, event_time):
+        # 只处理窗口对象的事件，窗口内控件的事件直接忽略
+        if id_object != OBJID_WINDOW or not handle:
+            return
+        if self.change_counts:
+            root_handle = user32.GetAncestor(handle, GA_ROOT)
+            with self.lock:
+                if root_handle in self.change_counts:
+                    self.change_counts[root_handle] += 1
+        if id_child != 0:
+            return
+        with self.lock:
+            self.event_count += 1
+        if event in (EVENT_OBJECT_DESTROY, EVENT_OBJECT_HIDE):
+            with self.lock:
+                self.windows.pop(handle, None)
+            return
+        if not is_top_level_window(handle):
+            return
+        window_info = WindowInfo.from_handle(handle)
+        if window_info:
+            with self.lock:
+                self.windows[handle] = window_info
+
+    def _hook_process(self, process_id: int):
+        # 在事件线程中调用，回调投递到安装监听的线程
+        if process_id in self.hooks:
+            return
+        hooks = [user32.SetWinEventHook(event_min, event_max, 0, self._event_proc, process_id, 0,
+                                        WINEVENT_OUTOFCONTEXT | WINEVENT_SKIPOWNPROCESS)
+                 for event_min, event_max in HOOK_EVENT_RANGES]
+        if not all(hooks):
+            for hook in filter(None, hooks):
+                user32.UnhookWinEvent(hook)
+            logger.warning('窗口事件监听失败，该进程的窗口使用轮询刷新. process_id: {}'.format(process_id))
+            return
+        self.hooks[process_id] = hooks
+        logger.info('窗口事件监听成功. process_id: {}'.format(process_id))
+
+    def _event_loop(self):
+        self._event_proc = WinEventProcType(self._on_event)
+        message = wintypes.MSG()
+        # 先创建线程消息队列，之后 track_process 才能投递消息
+        user32.PeekMessageW(ctypes.byref(message), 0, 0, 0, PM_NOREMOVE)
+        with self.lock:
+            self._event_thread_id = kernel32.GetCurrentThreadId()
+            process_ids = list(self.process_ids)
+        for process_id in process_ids:
+            self._hook_process(process_id)
+        # 事件回调需要当前线程有消息循环
+        while user32.GetMessageW(ctypes.byref(message), 0, 0, 0) > 0:
+            if not message.hWnd and message.message == WM_TRACK_PROCESS:
+                self._hook_process(message.wParam)
+                continue
+            user32.TranslateMessage(ctypes.byref(message))
+            user32.DispatchMessageW(ctypes.byref(message))
+        with self.lock:
+            self._event_thread_id = None
+        self.hooks = {}
+
+    def _poll_loop(self):
+        # 没有任何进程安装事件监听时（未登记进程、安装失败或者事件线程退出），每 poll_interval 秒全量刷新一次，
+        # 配合 find 未命中时的同步刷新和命中时的窗口校验保证结果正确，只是新窗口最多延迟 MISS_REFRESH_SECONDS 被发现
+        # 有事件监听时降低轮询频率，仅用于纠正可能漏掉的事件和未监听进程的窗口
+        while True:
+            time.sleep(self.poll_interval if not self.event_hooked else self.poll_interval * 12)
+            try:
+                self.refresh()
+            except Exception:
+                logger.error('刷新窗口注册表异常', exc_info=True)
+
+    def watch(self, handle: int) -> int | None:
+        # 开始记录窗口内的名称变化和显示隐藏，同时监听窗口所属的进程，返回所属进程id
+        try:
+            _, process_id = win32process.GetWindowThreadProcessId(handle)
+        except win32gui.error:
+            process_id = None
+        self.track_process(process_id)
+        if not self._started:
+            self.start()
+        with self.lock:
+            self.change_counts.setdefault(handle, 0)
+        return process_id
+
+    def unwatch(self, handle: int):
+        with self.lock:
+            self.change_counts.pop(handle, None)
+
+    def get_change_count(self, handle: int) -> int:
+        with self.lock:
+            return self.change_counts.get(handle, 0)
+
+    def find(self, name='', class_name='', process_id: int = None) -> list:
+        """
+        查询顶层窗口
+        :param name: 窗口名称，为空时不匹配
+        :param class_name: 窗口类名包含的字符串，为空时不匹配
+        :param process_id: 所属进程id，为空时不匹配
+        :return: 匹配的窗口列表
+        """
+        if not self._started:
+            self.start()
+        match_windows = self._match(name, class_name, process_id)
+        if not match_windows and time.time() - self.last_refresh_time > MISS_REFRESH_SECONDS:
+            # 未命中时可能是事件还没送达，同步刷新一次
+            self.refresh()
+            match_windows = self._match(name, class_name, process_id)
+        return match_windows
+
+    def _match(self, name, class_name, process_id) -> list:
+        with self.lock:
+            windows = list(self.windows.values())
+        match_windows = []
+        for window_info in windows:
+            if not self._is_match(window_info, name, class_name, process_id):
+                continue
+            if window_info.process_id not in self.hooks:
+                # 未监听事件的进程，窗口可能已经关闭或者改名，只对命中的窗口重新读取，都是Win32调用
+                window_info = WindowInfo.from_handle(window_info.handle) \
+                    if is_top_level_window(window_info.handle) else None
+                if not window_info or not self._is_match(window_info, name, class_name, process_id):
+                    continue
+            match_windows.append(window_info)
+        return match_windows
+
+    @staticmethod
+    def _is_match(window_info: WindowInfo, name, class_name, process_id) -> bool:
+        return (not name or window_info.name == name) and (not class_name or class_name in window_info.class_name) \
+            and (process_id is None or window_info.process_id == process_id)
+
+    def to_dict(self) -> dict:
+        return {
+            'windowCount': len(self.windows),
+            'eventHooked': self.event_hooked,
+            'hookedProcesses': list(self.hooks.keys()),
+            'eventCount': self.event_count,
+            'watchCount': len(self.change_counts),
+            'refreshCount': self.refresh_count,
+        }
+
+
+_window_registry = None
+_window_registry_lock = threading.Lock()
+
+
+def get_window_registry() -> WindowRegistry:
+    global _window_registry
+    with _window_registry_lock:
+        if _window_registry is None:
+            _window_registry = WindowRegistry()
+    return _window_registry
@@ -0,0 +1,59 @@
+"""
+窗口变化监听，等待界面加载时窗口内有名称变化或者结构变化立即重新检查
+事件来自窗口注册表的事件消息循环，不会为每个窗口单独启动消息循环，窗口所属进程没有事件监听时按固定间隔轮询
+对调用方是同一个接口，配合 wait_until 的 sleep 参数使用
+"""
+import time
+
+from base.window_registry import get_window_registry
+
+POLL_INTERVAL_SECONDS = 0.1  # 事件监听不可用时的轮询间隔
+EVENT_CHECK_SECONDS = 0.02  # 有事件监听时检查变化次数的间隔，只读取计数，不产生跨进程调用
+EVENT_MAX_WAIT_SECONDS = 1  # 有事件监听时单次最长等待，避免漏掉事件时一直等到超时
+
+
+class WindowWatcher(object):
+
+    def __init__(self, handle: int):
+        self.handle = handle
+        self.registry = get_window_registry()
+        self.process_id = None   # 窗口所属进程，start 时登记到注册表进行事件监听
+        self.wait_count = 0
+        self.wake_count = 0   # 因为窗口变化提前结束等待的次数
+        self.wait_seconds = 0.0
+
+    def start(self):
+        self.process_id = self.registry.watch(self.handle)
+
+    def stop(self):
+        self.registry.unwatch(self.handle)
+
+    def sleep(self, seconds: float):
+        """
+        等待窗口变化，有变化时立即返回，没有事件监听时按轮询间隔返回
+        """
+        begin_time = time.time()
+        is_woken = False
+        if self.registry.is_process_hooked(self.process_id):
+            change_count = self.registry.get_change_count(self.handle)
+            deadline = begin_time + min(seconds, EVENT_MAX_WAIT_SECONDS)
+            while time.time() < deadline:
+                time.sleep(min(EVENT_CHECK_SECONDS, max(deadline - time.time(), 0)))
+                if self.registry.get_change_count(self.handle) != change_count:
+                    is_woken = True
+                    break
+        else:
+            time.sleep(min(seconds, POLL_INTERVAL_SECONDS))
+        self.wait_count += 1
+        self.wake_count += is_woken
+        self.wait_seconds += time.time() - begin_time
+
+    def to_dict(self) -> dict:
+        return {
+            'handle': self.handle,
+            'eventHooked': self.registry.is_process_hooked(self.process_id),
+            'changeCount': self.registry.get_change_count(self.handle),
+            'waitCount': self.wait_count,
+            'wakeCount': self.wake_count,
+            'waitSeconds': round(self.wait_seconds, 3),
+        }
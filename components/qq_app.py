@@ -14,44 +14,104 @@ QQ客户端托管代理
 首次启动或者登录QQ时绑定QQ主窗口，发送消息时有两种处理方式：
 1. 首次发送时打开发送对话窗口，并绑定该窗口，后续都基于该对话窗口来发送消息，可以缓存元素查询结果
    同一台机多个QQ号，如果首次发送给相同昵称的消息，则会绑定错误
+   打开过的会话保留在会话窗口池中，再次发送时直接激活，超过数量上限时关闭最久没有使用的会话
 2. 每次发送消息时都打开发送对话窗口，发送完成后立即关闭，这时每次都要查找
 
 适配PC QQ V9.4.6.27770版本，
 """
 import re
 import time
-from typing import List
+from typing import List, Iterator
 
 import uiautomation as auto
 from uiautomation import Control
 
+from base.control_cache import MAIN_WINDOW, CONVERSATION_WINDOW, read_runtime_id
+from base.conversation_window_pool import ConversationWindowPool, PooledConversation
+from base.identity_store import IdentityStore
 from base.control_util import select_control, control_click, check_control_exist, find_top_window_controls, \
-    active_window, check_controls_exist
+    active_window, check_controls_exist, find_top_window_nodes, wait_until, window_appeared
 from base.exception import ControlInvalidException, MessageSendException
 from base.log import logger
-from base.util import win32_clipboard_text, win32_read_clipboard_text
-from components.wechat_app import WechatApp, ControlTag, SendResult
+from base.metrics import observe_latency
+from base.window_watcher import WindowWatcher
+from base.util import win32_clipboard_text, win32_read_clipboard_text, win32_paste_text, clipboard_service, \
+    normalized_endswith, get_cache_path, md5_encrypt
+from components.wechat_app import WechatApp, ControlTag, SendResult, SendVerification
 
 auto.SetGlobalSearchTimeout(5)
 
+QQ_BATCH_SEND_WITH_FORWARD_COUNT = 3  # 批量发送时使用转发的最小会话数量
+QQ_FORWARD_MAX_CONVERSATION_COUNT = 9  # 每次转发选择的最大会话数量
+QQ_FORWARD_WINDOW_NAMES = ['转发', '选择好友', '选择联系人']  # 转发时的联系人选择窗口名称
+QQ_LAST_MESSAGE_OFFSET = (-90, -40)  # 自己发送的最后一条消息相对消息区域右下角的位置，QQ无法获取消息控件
+SEARCH_ITEM_REGEX = re.compile(r'^([^(]+)(\((.+)\))? (\d+)$')  # 搜索结果格式：备注(昵称) QQ号
+
+# 企业用户会话中的提示，检查消息时忽略
+TIM_COMMUNICATION_TIP = '正在和企业用户沟通，为了提供更好服务，企业可能会保存与你的沟通内容。'
+
+# 会话窗口中的控件
+CONVERSATION_WINDOW_TAGS = (ControlTag.CONVERSATION_SEARCH, ControlTag.CONVERSATION_SEARCH_RESULT,
+                            ControlTag.MESSAGE_LIST, ControlTag.MESSAGE_INPUT)
+
+
+def match_search_item(item_name: str, conversation: str, search_text: str) -> List[str] | None:
+    """
+    匹配一条搜索结果，备注、昵称、QQ号任意一个等于会话名称，或者QQ号等于搜索的号码时匹配
+    :return: 匹配时返回备注、昵称、QQ号列表，QQ号在最后，否则返回None
+    """
+    item_match_result = SEARCH_ITEM_REGEX.match(item_name)
+    if not item_match_result:
+        return None
+    remark_name, _, nickname, number = item_match_result.groups()
+    if conversation not in [remark_name, nickname, number] and number != search_text:
+        return None
+    return [x for x in [remark_name, nickname, number] if x]
+
+
+class QQSendVerification(SendVerification):
+    """
+    QQ无法获取消息控件，发送后读取消息区域的尾部文本，所有会话发送完成后再比较是否以发送的文本结尾
+    """
+    FAIL_MESSAGE = '校验发送消息失败请检查QQ状态'   # 可能离线状态就会发生失败
+
+    def __init__(self, to_conversation: str, text='', filepaths=None):
+        super().__init__(to_conversation, text, filepaths)
+        self.tail_text = ''
+
+    def verify(self) -> bool:
+        # 和原来一样只检查文本消息
+        return not self.text or normalized_endswith(self.tail_text, self.text, [TIM_COMMUNICATION_TIP])
+
 
 class QQApp(WechatApp):
+    APP_NAME = 'qq'
 
-    def __init__(self, main_window=None, is_retain_conversation_window=True, is_search_in_conversation_window=False):
+    def __init__(self, main_window=None, is_retain_conversation_window=True, is_search_in_conversation_window=False,
+                 forward_relay_conversation=''):
         self.qq_number = None
         self.conversation_window: Control = None   # 记录会话窗口
         self.is_retain_conversation_window: bool = is_retain_conversation_window        # 是否保持会话窗口存活而不关闭
         self.is_search_in_conversation_window: bool = is_search_in_conversation_window  # 是否在会话窗口中搜索
         self.open_conversations = set()     # 记录打开的会话列表
+        self.forward_relay_conversation: str = forward_relay_conversation   # 批量转发的中转会话，为空时不使用转发
+        self.conversation_watcher: WindowWatcher | None = None   # 会话窗口变化监听，等待会话标题加载
+        self.conversation_pool = ConversationWindowPool()   # 绑定模式下保持打开的会话，再次发送时直接激活
+        self.identity_store: IdentityStore | None = None   # 会话名称到QQ号的映射，登录后按账号持久化
         super().__init__(main_window)
+        if self.login_user_name:
+            self.identity_store = IdentityStore(persist_path=get_cache_path('identity-{}-{}.json'.format(
+                self.APP_NAME, md5_encrypt(self.login_user_name))))
 
     @staticmethod
-    def build_all_qq_apps(is_retain_conversation_window=True, is_search_in_conversation_window=False):
+    def build_all_qq_apps(is_retain_conversation_window=True, is_search_in_conversation_window=False,
+                          forward_relay_conversation=''):
         # 处理同时打开多个微信的情况，找到指定微信名称的微信窗口
         qq_apps = []
         qq_window_controls = find_top_window_controls('QQ', 'TXGuiFoundation')
         for qq_window_control in qq_window_controls:
-            qq_app = QQApp(qq_window_control, is_retain_conversation_window, is_search_in_conversation_window)
+            qq_app = QQApp(qq_window_control, is_retain_conversation_window, is_search_in_conversation_window,
+                           forward_relay_conversation)
             qq_apps.append(qq_app)
         logger.info('检测到当前打开QQ窗口个数： {}'.format(len(qq_apps)))
         return qq_apps
@@ -118,9 +178,9 @@ class QQApp(WechatApp):
 
     def check_skip_update(self):
         alert_control = None
-        for control in self.main_window.GetChildren():
-            if control.Name == '提示':
-                alert_control = control
+        for node in self._capture_snapshot(max_depth=1).root.children:
+            if node.Name == '提示':
+                alert_control = node.control
                 break
         if not alert_control:
             logger.info('没有任何提示框，不做处理')
@@ -129,6 +189,7 @@ class QQApp(WechatApp):
         close_button = select_control(alert_control, ':2>button')
         logger.info('点击关闭提示框按钮')
         control_click(close_button)
+        self.control_cache.bump(MAIN_WINDOW)
 
     def get_toolbar_qq_icon_controls(self, filter_name='') -> List[Control]:
         # 获取右下角任务栏QQ图标列表
@@ -206,6 +267,7 @@ class QQApp(WechatApp):
         confirm_button = alert_window.ButtonControl(Name='确定')
         control_click(confirm_button, '未找到【确定】按钮')
         logger.info('点击【确认】按钮关闭提示框')
+        self.control_cache.bump()
 
     def switch_account(self):
         self.exit_account(sub_menu='切换帐号')
@@ -249,156 +311,305 @@ class QQApp(WechatApp):
             qr_code_control = return_button.GetPreviousSiblingControl().GetPreviousSiblingControl().GetChildren()[0]
             control_click(qr_code_control)
 
-    def _search_control(self, tag: ControlTag, use_cache=True, with_check=True) -> Control | None:
-        if not self.is_retain_conversation_window and tag in [ControlTag.MESSAGE_LIST, ControlTag.MESSAGE_INPUT]:
-            # 非绑定模式下关于会话窗口的查找不能使用缓存
-            use_cache = False
-        return super()._search_control(tag, use_cache, with_check)
+    def _get_locator_root(self, tag: ControlTag) -> Control:
+        # 会话窗口中的控件路径相对会话窗口
+        return self.conversation_window if tag in CONVERSATION_WINDOW_TAGS else self.main_window
+
+    def _get_control_window(self, tag: ControlTag) -> str:
+        return CONVERSATION_WINDOW if tag in CONVERSATION_WINDOW_TAGS else MAIN_WINDOW
 
     def _search_control_by_tag(self, tag: ControlTag, use_cache=True, with_check=True):
         find_control = None
         if tag == ControlTag.MAIN_CONVERSATION_SEARCH:
-            find_control = self.main_window.EditControl(searchDepth=6, Name='搜索：联系人、群聊、企业')
+            find_control = self._index_search_control('EditControl', searchDepth=6, Name='搜索：联系人、群聊、企业')
         elif tag == ControlTag.MAIN_CONVERSATION_SEARCH_RESULT:
             anchor_control = self._search_control(ControlTag.MAIN_CONVERSATION_SEARCH, use_cache, with_check)
             if anchor_control:
                 find_control = select_control(anchor_control, 'p>p>:3>:1>>>:1')
         elif self.conversation_window:
             if tag == ControlTag.CONVERSATION_SEARCH:
-                find_control = self.conversation_window.EditControl(searchDepth=3, Name='搜索：联系人、群聊、企业')
+                find_control = self._index_search_control('EditControl', self.conversation_window,
+                                                          searchDepth=3, Name='搜索：联系人、群聊、企业')
             elif tag == ControlTag.CONVERSATION_SEARCH_RESULT:
                 find_control = select_control(self.conversation_window, ':5>>>>:1')
             elif tag == ControlTag.MESSAGE_LIST:
                 # 无法获取具体的消息控件列表
-                find_control = self.conversation_window.ListControl(Name='消息')
+                find_control = self._index_search_control('ListControl', self.conversation_window, Name='消息')
             elif tag == ControlTag.MESSAGE_INPUT:
-                find_control = self.conversation_window.EditControl(Name='输入')
+                find_control = self._index_search_control('EditControl', self.conversation_window, Name='输入')
         return find_control
 
     def _bind_conversation_control(self, window_control):
+        if self.conversation_window:
+            self.index_snapshots.pop(self.conversation_window, None)
         self.conversation_window = window_control
         self.open_conversations = set()  # 清空打开的会话列表
-        # 清空会话窗口的搜索换成
-        self.cached_control[ControlTag.MESSAGE_INPUT] = None
-        self.cached_control[ControlTag.MESSAGE_LIST] = None
-        self.cached_control[ControlTag.CONVERSATION_SEARCH] = None
-        self.cached_control[ControlTag.CONVERSATION_SEARCH_RESULT] = None
+        if self.conversation_watcher:
+            self.conversation_watcher.stop()
+        self.conversation_watcher = WindowWatcher(window_control.NativeWindowHandle)
+        self.conversation_watcher.start()
+        # 会话窗口的控件缓存失效
+        self.control_cache.bump(CONVERSATION_WINDOW)
+
+    def _read_conversation_active_title(self, conversation_window=None) -> str:
+        # 读取一次会话标题，不等待，标题还没加载时返回空
+        conversation_window = conversation_window if conversation_window else self.conversation_window
+        if not conversation_window:
+            return ''
+        conversation_title_node = self._capture_snapshot(conversation_window, 5).select(':1>>>>')
+        return conversation_title_node.Name if conversation_title_node else ''
+
+    def _wait_conversation_window_change(self, predicate, timeout: float, name: str):
+        # 会话窗口有名称变化或者结构变化时立即重新检查，没有事件监听时短间隔轮询
+        if not self.conversation_watcher:
+            return wait_until(predicate, timeout, name=name)
+        return wait_until(predicate, timeout, interval=1, max_interval=1, name=name,
+                          sleep=self.conversation_watcher.sleep)
 
     def _get_conversation_active_title(self, conversation_window=None):
-        # 默认使用缓存的会话窗口
-        conversation_window = conversation_window if conversation_window else self.conversation_window
-        title_selector = ':1>>>>'
-        conversation_title_control = select_control(conversation_window, title_selector)
-        if not conversation_title_control or not conversation_title_control.Name:
-            # 有时候切换比较慢，还没加载会导致title为空，此时尝试延时后二次获取
-            logger.info('延迟3秒重复查找会话标题控件')
-            time.sleep(3)
-            conversation_title_control = select_control(conversation_window, title_selector)
-            if not conversation_title_control:
-                # 首次从主窗口搜索切换过来时标题控件加载比较慢，如果为了效率可以关闭会话窗口驻留，跳过窗口校验
-                logger.info('延迟5秒再次重复查找会话标题控件')
-                time.sleep(5)
-                conversation_title_control = select_control(conversation_window, title_selector)
-        conversation_title = conversation_title_control.Name if conversation_title_control else '^^^^^^没查到会话标题'
-        return conversation_title
+        # 有时候切换比较慢，还没加载会导致title为空，首次从主窗口搜索切换过来时标题控件加载比较慢，标题出现后立即返回
+        conversation_title = self._wait_conversation_window_change(
+            lambda: self._read_conversation_active_title(conversation_window), timeout=8, name='qq_conversation_title')
+        return conversation_title if conversation_title else '^^^^^^没查到会话标题'
+
+    def _activate_pooled_conversation(self, conversation: str) -> bool:
+        # 会话已经打开时直接激活所在的窗口，当前标签不是该会话时点击标签切换，不需要搜索
+        pooled_conversation = self.conversation_pool.get(conversation)
+        if not pooled_conversation:
+            return False
+        if pooled_conversation.window is not self.conversation_window:
+            self._bind_conversation_control(pooled_conversation.window)
+        active_window(self.conversation_window)
+        if self._read_conversation_active_title() in pooled_conversation.match_names \
+                or self._click_conversation_tab(pooled_conversation):
+            logger.info('激活已经打开的会话: {}'.format(conversation))
+            return True
+        self.conversation_pool.remove(conversation)
+        return False
+
+    def _click_conversation_tab(self, pooled_conversation: PooledConversation) -> bool:
+        # 合并的会话窗口中，左侧标签的名称为备注或者昵称，在会话所在的窗口中点击，不一定是当前绑定的窗口
+        conversation_window = pooled_conversation.window
+        tab_node = self._capture_snapshot(conversation_window).find_first(
+            lambda x: x.name in pooled_conversation.match_names
+            and x.control_type_name in ['ListItemControl', 'TabItemControl', 'ButtonControl'])
+        if not tab_node:
+            return False
+        control_click(tab_node.control)
+        return bool(self._wait_conversation_window_change(
+            lambda: self._read_conversation_active_title(conversation_window) in pooled_conversation.match_names,
+            timeout=3, name='qq_conversation_tab'))
+
+    def _close_pooled_conversation(self, pooled_conversation: PooledConversation):
+        # 关闭最久没有使用的会话，需要先在该会话所在的窗口中切换到它的标签，Ctrl+W只关闭当前标签
+        if not read_runtime_id(pooled_conversation.window):
+            return
+        active_window(pooled_conversation.window)
+        if self._read_conversation_active_title(pooled_conversation.window) in pooled_conversation.match_names \
+                or self._click_conversation_tab(pooled_conversation):
+            logger.info('关闭最久没有使用的会话: {}'.format(pooled_conversation.conversation))
+            pooled_conversation.window.SendKeys('{Ctrl}w')
+            self.open_conversations.discard(pooled_conversation.conversation)
+            self.control_cache.bump(CONVERSATION_WINDOW)
 
     def _search_switch_conversation(self, conversation: str):
-        # 切换到指定会话窗口，有两种方式，一种是从QQ主窗口搜索切换，另一种是直接在对话框搜索切换
+        # 切换到指定会话窗口，已经打开的会话直接激活，否则有两种方式，一种是从QQ主窗口搜索切换，另一种是直接在对话框搜索切换
         logger.info('开始处理切换会话: {}'.format(conversation))
+        self._check_unknown_conversation(conversation)
+        if self.is_retain_conversation_window:
+            if self._activate_pooled_conversation(conversation):
+                return self.conversation_window
+            # 先关闭超过数量上限的会话再打开目标会话，关闭时会切换标签，之后不能再切走目标会话
+            for evict_conversation in self.conversation_pool.reserve(conversation):
+                self._close_pooled_conversation(evict_conversation)
+        if self.conversation_window and not read_runtime_id(self.conversation_window):
+            # 会话窗口已经被关闭，重新绑定
+            self.conversation_window = None
 
         # 搜索会话然后打开会话窗口，搜索结果中包含昵称、QQ号、备注
         match_names = self._search_switch_conversation_by_window(conversation)
+        # 同一个会话窗口切换到其他会话标签后，消息列表和输入框属于新的标签，旧标签的缓存控件可能仍然存活，按代数失效
+        self.control_cache.bump(CONVERSATION_WINDOW)
 
         # 查询会话窗口列表，多个QQ号时可能有多个会话窗口，校验和绑定会话窗口
-        for window_control in auto.GetRootControl().GetChildren():
+        for window_node in find_top_window_nodes(class_name='TXGuiFoundation'):
             # 通过一般属性过滤非会话窗口
-            if window_control.ClassName != 'TXGuiFoundation' or 'QQ' in window_control.Name:
+            if window_node.ClassName != 'TXGuiFoundation' or 'QQ' in window_node.Name:
                 continue
 
             # 会话窗口的Name一般为备注、昵称，单个会话窗口时匹配Name即可,，如果是多个会话堆叠的话，叫做xxx等x个会话
             # 注意：新版本可能需要使用 _get_conversation_active_title 来获取激活会话窗口标题
-            active_conversation_title_name = re.sub(r'等\d+个会话', '', window_control.Name)
+            active_conversation_title_name = re.sub(r'等\d+个会话', '', window_node.Name)
 
             if active_conversation_title_name in match_names:
                 if not self.conversation_window:
                     # 如果没有绑定过窗口（一般是首次打开会话窗口或者会话窗口非驻留模式），则需要绑定窗口
-                    self._bind_conversation_control(window_control)
+                    self._bind_conversation_control(window_node.control)
                     break
 
         if not self.conversation_window:
             raise ControlInvalidException('未找到匹配的会话窗口. match_names: {}'.format(match_names))
 
         self.open_conversations.add(conversation)
+        if self.is_retain_conversation_window:
+            evict_conversations = self.conversation_pool.put(conversation, self.conversation_window, match_names)
+            for evict_conversation in evict_conversations:
+                self._close_pooled_conversation(evict_conversation)
+            if evict_conversations:
+                # 关闭时切换过标签，重新激活目标会话
+                self._activate_pooled_conversation(conversation)
         return self.conversation_window
 
     def _search_switch_conversation_by_window(self, conversation: str) -> List[str]:
         logger.info('搜索和切换会话列表： {}'.format(conversation))
+        # 学习过的会话使用唯一号码搜索，只有一个精确的结果
+        number = self.identity_store.lookup(conversation) if self.identity_store else None
+        if number:
+            match_names, _ = self._search_open_conversation(conversation, number)
+            if match_names:
+                return match_names
+            # 号码搜索不到或者不匹配，可能已经删除好友或者退出群聊，重新按名称搜索
+            self.identity_store.invalidate(conversation)
+
+        match_names, fail_reason = self._search_open_conversation(conversation, conversation)
+        if not match_names:
+            raise ControlInvalidException(fail_reason)
+        return match_names
+
+    def _search_open_conversation(self, conversation: str, search_text: str) -> (List[str] | None, str):
+        """
+        搜索并打开会话，搜索结果的备注、昵称、QQ号任意一个等于会话名称，或者QQ号等于搜索的号码时匹配
+        :param conversation: 会话名称
+        :param search_text: 搜索内容，会话名称或者学习到的QQ号
+        :return: 匹配的名称列表，未匹配时返回None和原因
+        """
         # 打开会话框搜索并且已经打开多个会话框时才会在会话框中搜索
         search_in_conversation = len(self.open_conversations) > 2 if self.is_search_in_conversation_window else False
         active_window(self.conversation_window if search_in_conversation else self.main_window)
         search_control = self._search_control(ControlTag.CONVERSATION_SEARCH if search_in_conversation
                                               else ControlTag.MAIN_CONVERSATION_SEARCH)
-        control_click(search_control)
-        time.sleep(0.7)
-        search_control.SendKeys('{Ctrl}a')  # 避免还有旧的搜索
-        win32_clipboard_text(conversation)
-        search_control.SendKeys('{Ctrl}v')
+        control_click(search_control, wait_predicate=lambda: search_control.HasKeyboardFocus, wait_timeout=1,
+                      wait_name='qq_search_focus')
+        win32_paste_text(search_control, search_text, clear=True)  # 全选替换，避免还有旧的搜索
 
         # 检查搜索结果列表
         search_conversation_controls = []
         search_result_root_control = self._search_control(ControlTag.CONVERSATION_SEARCH_RESULT if search_in_conversation
                                                           else ControlTag.MAIN_CONVERSATION_SEARCH_RESULT)
-        for pane_control in search_result_root_control.GetChildren():
-            result_type_control = select_control(pane_control, '>')
+        search_result_snapshot = self._capture_snapshot(search_result_root_control, max_depth=3)
+        for pane_node in search_result_snapshot.root.children:
+            result_type_node = search_result_snapshot.select('>', pane_node)
             # 依次将每一项的搜索结果添加，比如好友、群聊
-            if result_type_control and result_type_control.Name in ['好友', '群聊']:
-                search_conversation_controls.extend(result_type_control.GetParentControl().GetChildren()[1:])
+            if result_type_node and result_type_node.Name in ['好友', '群聊']:
+                search_conversation_controls.extend(pane_node.GetChildren()[1:])
 
         if not search_conversation_controls:
-            raise ControlInvalidException('未搜索到该会话-搜索结果为空：{}'.format(conversation))
-
-        item_match_regex = re.compile(r'^([^(]+)(\((.+)\))? (\d+)$')
-        for item_control in search_conversation_controls:
-            # 匹配备注名、昵称、QQ号
-            item_name = item_control.GetFirstChildControl().Name
-            item_match_result = item_match_regex.match(item_name)
-            if (not item_match_result or not item_match_result.groups()) and item_name != self.login_user_name:
-                raise ControlInvalidException('未匹配的会话名称-未知匹配项： {}'.format(item_name))
-
-            # 分别匹配备注、昵称、QQ号
-            for match_item in item_match_result.groups():
-                # 分别匹配备注、昵称、QQ号
-                if not match_item:
-                    continue
-                if match_item == conversation:
-                    logger.info('匹配并切换会话，item_name: {}, conversation: {}'.format(item_name, conversation))
-                    item_control.DoubleClick()
-                    time.sleep(0.8)
-                    return list(item_match_result.groups())
-        raise ControlInvalidException('未搜索到该会话-未找到匹配项：{}'.format(conversation))
+            return None, '未搜索到该会话-搜索结果为空：{}'.format(conversation)
+
+        for item_node in search_conversation_controls:
+            item_name = item_node.GetFirstChildControl().Name if item_node.GetFirstChildControl() else ''
+            match_names = self._match_search_item(item_name, conversation, search_text)
+            if match_names:
+                logger.info('匹配并切换会话，item_name: {}, conversation: {}'.format(item_name, conversation))
+                item_node.control.DoubleClick()
+                self._wait_conversation_opened(match_names)
+                return match_names, ''
+        fail_reason = '未搜索到该会话-未找到匹配项：{}'.format(conversation)
+        if search_text == conversation:
+            # 只有按名称搜索、搜索结果已经显示并且没有匹配项时才记录，结果为空可能是还没显示
+            self._add_unknown_conversation(conversation, fail_reason)
+        return None, fail_reason
+
+    def _is_internal_conversation(self, conversation: str) -> bool:
+        return super()._is_internal_conversation(conversation) or conversation == self.forward_relay_conversation
+
+    def _match_search_item(self, item_name: str, conversation: str, search_text: str) -> List[str] | None:
+        """
+        匹配一条搜索结果，备注、昵称、QQ号任意一个等于会话名称，或者QQ号等于搜索的号码时匹配，匹配时记录会话的QQ号
+        :return: 匹配时返回备注、昵称、QQ号列表，否则返回None
+        """
+        if not SEARCH_ITEM_REGEX.match(item_name):
+            # 未知格式的结果跳过，比如当前登录的账号
+            logger.warning('未匹配的会话名称-未知匹配项： {}'.format(item_name))
+            return None
+        match_names = match_search_item(item_name, conversation, search_text)
+        if match_names and self.identity_store:
+            # 只记录本次请求的名称，相同昵称可能对应多个联系人
+            self.identity_store.learn(match_names[-1], [conversation])
+        return match_names
+
+    def _wait_conversation_opened(self, match_names: List[str], timeout=3):
+        # 双击搜索结果后等待会话打开，未绑定会话窗口时等待窗口出现，否则等待会话标题切换
+        if not self.conversation_window:
+            return wait_until(window_appeared(lambda x: re.sub(r'等\d+个会话', '', x) in match_names, 'TXGuiFoundation'),
+                              timeout, name='qq_conversation_window')
+        return self._wait_conversation_window_change(lambda: self._read_conversation_active_title() in match_names,
+                                                     timeout, name='qq_conversation_switch')
 
     def _get_message_item_controls(self, filter_time=True) -> List[Control]:
         # QQ获取消息列表暂时有问题
         return []
 
-    def check_last_message_match(self, message: str) -> bool:
-        # 点击聊天消息区域
+    def _iter_message_item_controls_reversed(self, filter_time=True) -> Iterator[Control]:
+        return iter([])
+
+    def _read_message_tail_text(self, message_list_control: Control, max_length: int) -> str | None:
+        """
+        通过TextPattern从消息区域末尾向前读取最多max_length个字符，不经过剪贴板
+        :return: 尾部文本，消息区域不支持TextPattern时返回None
+        """
+        try:
+            text_pattern = message_list_control.GetPattern(auto.PatternId.TextPattern)
+            if not text_pattern:
+                return None
+            document_range = text_pattern.DocumentRange
+            tail_range = document_range.Clone()
+            # 先收缩到文档末尾，再向前扩展max_length个字符
+            tail_range.MoveEndpointByRange(auto.TextPatternRangeEndpoint.Start, document_range,
+                                           auto.TextPatternRangeEndpoint.End, waitTime=0)
+            tail_range.MoveEndpointByUnit(auto.TextPatternRangeEndpoint.Start, auto.TextUnit.Character,
+                                          -max_length, waitTime=0)
+            return tail_range.GetText(max_length)
+        except Exception:
+            logger.warning('读取消息区域尾部文本失败，使用剪贴板复制', exc_info=True)
+            return None
+
+    def _read_last_message_text(self, message: str) -> (str, bool):
+        """
+        读取消息区域的文本用于检查最后一条消息
+        :return: 消息文本，以及是否只读取了尾部
+        """
         message_list_control = self._search_control(ControlTag.MESSAGE_LIST)
+        # 只读取尾部文本，预留换行符和提示语的长度，读取的文本长度和历史消息数量无关
+        max_length = (len(message) + len(TIM_COMMUNICATION_TIP)) * 2 + 64
+        message_text = self._read_message_tail_text(message_list_control, max_length)
+        if message_text is not None:
+            return message_text, True
+        # 点击聊天消息区域，Ctrl+A C复制所有消息
         control_click(message_list_control)
+        with clipboard_service.preserved():
+            message_list_control.SendKeys('{Ctrl}a')
+            message_list_control.SendKeys('{Ctrl}c')
+            return win32_read_clipboard_text(), False
 
-        # Ctrl+A C复制所有消息
-        message_list_control.SendKeys('{Ctrl}a')
-        message_list_control.SendKeys('{Ctrl}c')
-
-        # 读取剪贴板消息
-        all_message_text = win32_read_clipboard_text()
-        # 去掉Tim沟通提示
-        all_message_text = all_message_text.replace('正在和企业用户沟通，为了提供更好服务，企业可能会保存与你的沟通内容。', '')
-        # message_items = all_message_text.split('\r\n\r\n')[:-1]  # 拆分成每一条消息，最后一条消息为空
-        all_message_text = all_message_text.replace('\r\n', '').replace('\n', '')
-        # 去掉换行进行匹配
-        message = message.replace('\r\n', '').replace('\n', '')
-        return all_message_text.endswith(message)
+    def check_last_message_match(self, message: str) -> bool:
+        begin_time = time.time()
+        message_text, is_tail_read = self._read_last_message_text(message)
+        # 去掉Tim沟通提示和换行进行匹配，只规范化尾部
+        is_match = normalized_endswith(message_text, message, [TIM_COMMUNICATION_TIP])
+        observe_latency('qq_check_message.{}'.format('tail' if is_tail_read else 'clipboard'), time.time() - begin_time,
+                        is_match)
+        return is_match
+
+    # 发送后读取消息区域尾部文本，用于延后检查是否发送成功
+    def _capture_send_verification(self, to_conversation: str, text='', filepaths=None) -> QQSendVerification:
+        send_verification = QQSendVerification(to_conversation, text, filepaths)
+        self._read_send_verification_tail(send_verification)
+        return send_verification
+
+    def _read_send_verification_tail(self, send_verification: QQSendVerification):
+        if send_verification.text:
+            send_verification.tail_text = self._read_last_message_text(send_verification.text)[0]
 
     def close_conversation_window(self, force=False):
         if not check_control_exist(self.conversation_window):
@@ -407,12 +618,156 @@ class QQApp(WechatApp):
         if force:
             self.conversation_window.SendKeys('{Alt}{F4}')
             self.open_conversations.clear()
+            self.conversation_pool.clear()
+            # 会话窗口关闭后控件缓存全部失效
+            self.control_cache.bump()
+            self.index_snapshots = {}
         elif not self.is_retain_conversation_window:
             # 非绑定模式，关闭会话窗口
             self.conversation_window.SendKeys('{Ctrl}w')
             self.open_conversations.clear()
-        # 清空搜索换成
-        self.cached_control = {}
+            # 会话窗口关闭后控件缓存全部失效
+            self.control_cache.bump()
+            self.index_snapshots = {}
+
+    def _forward_send_message(self, to_conversations: list, text: str) -> (List[SendResult], List[str]):
+        """
+        将文本消息发送到中转会话，再分页转发到多个会话，转发后逐个会话校验最后一条消息
+        :return: 转发的发送结果，以及转发界面定位失败、需要逐个发送的会话列表
+        """
+        try:
+            self._search_switch_conversation(self.forward_relay_conversation)
+            self.send_text_message(text, check_send_success=False)
+            if not self.check_last_message_match(text):
+                raise ControlInvalidException('中转会话消息发送失败：{}'.format(self.forward_relay_conversation))
+        except ControlInvalidException:
+            logger.warning('发送到中转会话失败，改为逐个发送', exc_info=True)
+            return [], to_conversations
+        finally:
+            self._close_sent_conversation_window()
+
+        forward_conversations = []
+        fallback_conversations = []
+        page_size = QQ_FORWARD_MAX_CONVERSATION_COUNT
+        for page_begin in range(0, len(to_conversations), page_size):
+            page_to_conversations = to_conversations[page_begin:page_begin + page_size]
+            try:
+                self._search_switch_conversation(self.forward_relay_conversation)
+                forward_conversations.extend(self._forward_last_message(page_to_conversations, text))
+            except ControlInvalidException as exception:
+                # 点击发送前的异常，该页的会话都没有发送
+                logger.warning('转发消息失败，改为逐个发送. page_to_conversations: {}, exception: {}'
+                               .format(page_to_conversations, exception.message))
+                fallback_conversations.extend(page_to_conversations)
+            finally:
+                self._close_sent_conversation_window()
+
+        send_results = []
+        for to_conversation in to_conversations:
+            if to_conversation in fallback_conversations:
+                continue
+            if to_conversation not in forward_conversations:
+                send_results.append(SendResult.fail(to_conversation, '未搜索到该会话：' + to_conversation))
+                continue
+            try:
+                # 会话窗口池和号码搜索使校验时的切换较快
+                self._search_switch_conversation(to_conversation)
+                if self.check_last_message_match(text):
+                    send_results.append(SendResult.success(to_conversation))
+                else:
+                    send_results.append(SendResult.fail(to_conversation, '校验发送消息失败请检查QQ状态'))
+            except ControlInvalidException as exception:
+                send_results.append(SendResult.fail(to_conversation, exception.message))
+            finally:
+                self._close_sent_conversation_window()
+        return send_results, fallback_conversations
+
+    def _close_sent_conversation_window(self):
+        # 非绑定模式和逐个发送一样，每个会话处理完成后关闭会话窗口，避免窗口越来越多
+        if not self.is_retain_conversation_window and check_control_exist(self.conversation_window):
+            self.close_conversation_window()
+
+    def _open_last_message_menu(self, message_list_control: Control) -> Control:
+        # 右键自己发送的最后一条消息，返回消息右键菜单
+        message_list_control.RightClick(x=QQ_LAST_MESSAGE_OFFSET[0], y=QQ_LAST_MESSAGE_OFFSET[1])
+        menu_control = auto.MenuControl(searchDepth=1, Name='TXMenuWindow')
+        check_control_exist(menu_control, '未找到消息右键菜单')
+        return menu_control
+
+    def _check_last_message_menu(self, message_list_control: Control, text: str):
+        """
+        QQ无法获取消息控件，右键位置是固定偏移，可能点到其他消息或者空白处
+        先通过右键菜单的【复制】读取右键的消息，和中转会话刚发送的消息一致时才转发
+        """
+        menu_control = self._open_last_message_menu(message_list_control)
+        copy_item = menu_control.MenuItemControl(searchDepth=1, Name='复制')
+        if not check_control_exist(copy_item):
+            menu_control.SendKeys('{Esc}')
+            raise ControlInvalidException('右键位置不是中转会话发送的消息，未找到【复制】按钮')
+        with clipboard_service.preserved():
+            win32_clipboard_text('')
+            control_click(copy_item)
+            menu_text = win32_read_clipboard_text()
+        # 复制的文本换行符可能不同，去掉空白后比较
+        if not menu_text or re.sub(r'\s+', '', menu_text) != re.sub(r'\s+', '', text):
+            raise ControlInvalidException('右键位置不是中转会话发送的消息：{}'.format(menu_text))
+
+    def _forward_last_message(self, to_conversations: list, text: str) -> List[str]:
+        """
+        转发当前会话中自己发送的最后一条消息，在联系人选择窗口中逐个搜索并选中会话后发送
+        转发前先校验右键的消息是刚发送的text，点击发送之前定位失败会关闭转发窗口并抛出 ControlInvalidException，此时没有发送任何消息
+        :return: 转发成功的会话列表
+        """
+        message_list_control = self._search_control(ControlTag.MESSAGE_LIST)
+        self._check_last_message_menu(message_list_control, text)
+        menu_control = self._open_last_message_menu(message_list_control)
+        forward_item = menu_control.MenuItemControl(searchDepth=1, Name='转发')
+        if not check_control_exist(forward_item):
+            menu_control.SendKeys('{Esc}')
+            raise ControlInvalidException('未找到消息右键菜单中的【转发】按钮')
+        control_click(forward_item)
+
+        forward_window = wait_until(window_appeared(lambda x: x in QQ_FORWARD_WINDOW_NAMES, 'TXGuiFoundation'),
+                                    timeout=3, name='qq_forward_window', with_exception_message='未找到转发的联系人选择窗口')
+        is_sent = False
+        try:
+            search_node = self._capture_snapshot(forward_window).find_first(
+                lambda x: x.control_type_name == 'EditControl')
+            if not search_node:
+                raise ControlInvalidException('未找到转发窗口中的搜索框')
+            search_control = search_node.control
+
+            forward_conversations = []
+            for to_conversation in to_conversations:
+                search_text = self.identity_store.lookup(to_conversation) if self.identity_store else None
+                search_text = search_text if search_text else to_conversation
+                control_click(search_control)
+                win32_paste_text(search_control, search_text, clear=True)
+                item_node = wait_until(lambda: self._capture_snapshot(forward_window).find_first(
+                    lambda x: bool(self._match_search_item_name(x.name, to_conversation, search_text))),
+                    timeout=2, name='qq_forward_search')
+                if not item_node:
+                    logger.warning('转发窗口中未搜索到该会话：{}'.format(to_conversation))
+                    continue
+                control_click(item_node.control)
+                forward_conversations.append(to_conversation)
+
+            if not forward_conversations:
+                return []
+            send_button = forward_window.ButtonControl(RegexName='^(发送|确定)')
+            control_click(send_button, with_exception_message='未找到转发窗口中的【发送】按钮')
+            is_sent = True
+            logger.info('转发消息到会话: {}'.format(forward_conversations))
+            return forward_conversations
+        finally:
+            # 没有点击发送时关闭转发窗口，避免模态窗口一直打开阻塞后续逐个发送
+            if not is_sent and check_control_exist(forward_window):
+                forward_window.SendKeys('{Esc}')
+
+    def _match_search_item_name(self, item_name: str, conversation: str, search_text: str) -> bool:
+        # 快照中其他节点的名称不符合搜索结果格式，先用正则过滤，避免每个节点都输出告警日志
+        return bool(SEARCH_ITEM_REGEX.match(item_name)) and bool(self._match_search_item(item_name, conversation,
+                                                                                         search_text))
 
     def batch_send_message(self, to_conversations: list, text='', filepaths=None,
                            share_link='', check_pre_message='') -> List[SendResult]:
@@ -430,39 +785,51 @@ class QQApp(WechatApp):
         logger.info('批量发送消息。发送到: {}，文本: {}，文件: {}，链接：{}'.format(to_conversations, text, filepaths, share_link))
         if not text and not filepaths:
             raise MessageSendException('发送内容为空，请检查参数')
-        send_results = []
+        request_conversations = to_conversations
+        send_results, to_conversations = self._filter_unknown_conversations(to_conversations)
+        if not to_conversations:
+            raise MessageSendException('全部消息发送失败：{}...'
+                                       .format('、'.join([x.error_message for x in send_results[:2]])))
         self.active(force=True)
 
-        # 逐个发送，如果有一个发送失败，则全失败
-        for to_conversation in to_conversations:
+        send_conversations = to_conversations
+        if self.forward_relay_conversation and len(to_conversations) >= QQ_BATCH_SEND_WITH_FORWARD_COUNT \
+                and text and not filepaths and not check_pre_message:
+            # 超过 QQ_BATCH_SEND_WITH_FORWARD_COUNT 个会话时，先发送到中转会话再转发，转发界面定位失败的会话逐个发送
+            forward_results, send_conversations = self._forward_send_message(to_conversations, text)
+            send_results.extend(forward_results)
+
+        # 逐个发送，发送后只读取消息区域尾部，所有会话发送完成后再统一检查，检查失败的会话切换回去重新读取
+        pending_results = []   # SendResult 或者 QQSendVerification，保持会话顺序
+        for to_conversation in send_conversations:
             try:
                 self._search_switch_conversation(to_conversation)
                 # 首先检查前置消息是否匹配
                 if check_pre_message and not self.check_last_message_match(check_pre_message):
                     logger.error('前置消息不匹配. check_pre_message: {}'.format(check_pre_message))
-                    send_results.append(SendResult.fail(to_conversation, '前置消息不匹配：' + check_pre_message))
+                    pending_results.append(SendResult.fail(to_conversation, '前置消息不匹配：' + check_pre_message))
                     self.close_conversation_window()
                     continue
 
-                send_message_controls = []
                 if filepaths:
-                    send_message_controls.extend(self.send_file_message(filepaths, check_send_success=False))
+                    self.send_file_message(filepaths, check_send_success=False)
                 if text:
-                    send_message_controls.extend(self.send_text_message(text, check_send_success=False))
+                    self.send_text_message(text, check_send_success=False)
+                pending_results.append(self._capture_send_verification(to_conversation, text))
                 self.close_conversation_window()
-
-                # 严格判断是否发送成功
-                if text and not self.check_last_message_match(text):
-                    # 可能离线状态就会发生失败
-                    send_results.append(SendResult.fail(to_conversation, '校验发送消息失败请检查QQ状态'))
-                else:
-                    send_results.append(SendResult.success(to_conversation))
             except ControlInvalidException as exception:
                 logger.warning('conversation send exception. conversation: {}'.format(to_conversation), stack_info=True)
-                send_results.append(SendResult.fail(to_conversation, exception.message))
+                pending_results.append(SendResult.fail(to_conversation, exception.message))
+        send_results.extend(self._resolve_send_verifications(pending_results))
+        if [x for x in pending_results if isinstance(x, SendVerification) and x.is_rechecked]:
+            # 重新检查时打开的会话也需要关闭
+            self.close_conversation_window()
+        # 转发失败逐个发送的结果在最后，按请求的会话顺序返回
+        request_indexes = {x: i for i, x in reversed(list(enumerate(request_conversations)))}
+        send_results.sort(key=lambda x: request_indexes.get(x.to_conversation, len(request_indexes)))
 
         send_fail_results = [x for x in send_results if not x.is_success]
-        if send_fail_results and len(send_fail_results) == len(to_conversations):
+        if send_fail_results and len(send_fail_results) == len(send_results):
             # 全部发送失败，则直接抛出异常结束
             raise MessageSendException('全部消息发送失败：{}...'
                                        .format('、'.join([x.error_message for x in send_fail_results[:2]])))
@@ -512,7 +879,19 @@ def benchmark_test():
     qq_app_u.batch_send_message(['222222222'], '测试发送给非好友')
 
 
+def search_item_test():
+    # 搜索结果有 备注(昵称) QQ号 和 昵称 QQ号 两种格式
+    assert match_search_item('备注(昵称) 12345', '备注', '备注') == ['备注', '昵称', '12345']
+    assert match_search_item('备注(昵称) 12345', '昵称', '昵称') == ['备注', '昵称', '12345']
+    assert match_search_item('备注(昵称) 12345', '备注名', '12345') == ['备注', '昵称', '12345']
+    assert match_search_item('备注 12345', '备注', '备注') == ['备注', '12345']
+    assert match_search_item('备注 12345', '12345', '12345') == ['备注', '12345']
+    assert match_search_item('备注 12345', '备', '备') is None
+    assert match_search_item('咏春 叶问', '咏春 叶问', '咏春 叶问') is None
+
+
 # 按间距中的绿色按钮以运行脚本。
 if __name__ == '__main__':
     # simple_test()
+    # search_item_test()
     benchmark_test()
@@ -6,28 +6,50 @@
 方法三：鼠标右键微信图标，然后快速敲回车。打开多少个，取决于你的手速。
 方法四：左键点击微信，长按回车0.5秒。如果按的时间超过1秒，估计就要开了几十个微信。电脑马上会死机….慎用。
 """
+import hashlib
 import os.path
 import random
 import re
 import time
 from datetime import datetime
 from enum import unique, Enum
-from typing import List
+from itertools import islice
+from typing import List, Iterator
 
 import uiautomation as auto
 from uiautomation import Control
 
+from base.control_snapshot import ControlTreeSnapshot
+from base.window_registry import get_window_registry
 from base.control_util import select_control, control_click, check_control_exist, find_top_window_controls, \
-    active_window
+    active_window, search_control, wait_until, control_in_tree, window_appeared
 from base.exception import ControlInvalidException, MessageSendException
+from base.control_cache import ControlCache, MAIN_WINDOW, read_runtime_id
+from base.conversation_index import ConversationIndex, ROUTE_SCROLL, ROUTE_SEARCH
+from base.forward_source_index import ForwardSourceIndex, file_source_key, text_source_key, link_source_key
+from base.history_store import HistoryStore
+from base.locator_profiler import LocatorProfiler
+from base.negative_cache import NegativeCache
 from base.log import logger
-from base.util import win32_clipboard_text, win32_clipboard_files, get_screenshot
+from base.metrics import ThroughputEstimator, observe_latency
+from base.util import win32_paste_text, clipboard_service, get_screenshot, get_process_file_version, \
+    get_cache_path, md5_encrypt
 
 auto.SetGlobalSearchTimeout(5)
 BATCH_SEND_WITH_FORWARD_COUNT = 2  # 批量发送时使用转发的最小会话数量
 FORWARD_MAX_CONVERSATION_COUNT = 9  # 微信转发消息最大会话数量
 CHECK_SEND_SUCCESS_SIZE = 3  # 检查是否发送成功时获取的消息数量
+MESSAGE_WATERMARK_SIZE = 3  # 消息水位线记录的消息数量，连续多条消息匹配才认为是水位线，避免重复消息误判
+MESSAGE_TYPES = {'[文件]': 'file', '[链接]': 'link', '[图片]': 'image', '[视频]': 'video', '[动画表情]': 'emotion'}
 TEMP_CONVERSATION = '文件传输助手'   # 临时中转会话
+INDEX_SNAPSHOT_SECONDS = 3  # 控件索引快照的有效秒数，过期后重新抓取
+FORWARD_SOURCE_TAIL_SIZE = 20  # 复用转发源消息时，在中转会话最近多少条消息中查找，只复用其中可见的消息
+UNKNOWN_CONVERSATION_TTL_SECONDS = 30 * 60  # 搜索不到的会话缓存时间，群改名后可以通过接口清除
+UPLOAD_INITIAL_BYTES_PER_SECOND = 500 * 1024  # 初始上传速度估计，和原来固定等待的 500K/秒 一致
+LINK_BROWSER_ADDRESS_NAMES = ['地址和搜索栏', 'Address and search bar', '请输入链接']  # 内置浏览器地址栏名称
+CONVERSATION_LIST_MAX_ROLLS = 2  # 会话没有记录过位置时，搜索前最多向下滚动会话列表的次数
+LINK_BROWSER_SEARCH_DEPTH = 8  # 内置浏览器工具栏菜单的查找深度，不抓取页面内容
+MENU_ITEM_SEARCH_DEPTH = 4  # 右键菜单中菜单项相对菜单窗口的查找深度
 
 
 def parse_time_str(time_str: str):
@@ -54,6 +76,47 @@ def parse_time_str(time_str: str):
     return None
 
 
+def is_message_item_control(message_item_control: Control) -> bool:
+    # 时间分隔等提示项没有两层子节点，不是真正的消息
+    first_child_control = message_item_control.GetFirstChildControl()
+    return first_child_control is not None and first_child_control.GetFirstChildControl() is not None
+
+
+def normalize_link_address(address: str) -> str:
+    # 浏览器地址栏可能省略协议或者补全末尾的斜杠
+    address = (address or '').strip().rstrip('/')
+    return re.sub(r'^https?://', '', address)
+
+
+def link_card_text(message_control: Control) -> str:
+    # 链接卡片消息的名称都是【链接】，使用卡片中的标题和描述文字区分不同的卡片
+    snapshot = ControlTreeSnapshot.capture(message_control)
+    return '\n'.join(x.name for x in snapshot.iter_nodes() if x.control_type_name == 'TextControl' and x.name)
+
+
+def file_upload_completed(message_controls: List[Control], min_seconds: float = 0):
+    """
+    等待条件：文件消息上传完成，上传中的文件消息有进度条和【取消】按钮，上传完成后消失
+    所有消息都出现过上传中状态并且已经消失才立即返回，进度条可能还没显示，或者客户端版本不显示进度条，此时至少等待min_seconds
+    """
+    begin_time = time.time()
+    seen_uploading_indexes = set()   # 出现过上传中状态的消息序号
+
+    def predicate():
+        is_uploading = False
+        for index, message_control in enumerate(message_controls):
+            uploading_node = ControlTreeSnapshot.capture(message_control).find_first(
+                lambda x: x.control_type_name == 'ProgressBarControl'
+                or (x.control_type_name == 'ButtonControl' and x.name == '取消'))
+            if uploading_node:
+                seen_uploading_indexes.add(index)
+                is_uploading = True
+        if is_uploading:
+            return False
+        return len(seen_uploading_indexes) == len(message_controls) or time.time() - begin_time >= min_seconds
+    return predicate
+
+
 class SendResult(object):
 
     def __init__(self):
@@ -88,6 +151,30 @@ class SendResult(object):
         return f'SendResult: [to_conversation]: {self.to_conversation}, [error_message]: {self.error_message}'
 
 
+class SendVerification(object):
+    """
+    延后的发送检查，发送后立即读取消息列表尾部的内容和文件名，所有会话发送完成后再比较，不引用控件
+    """
+    FAIL_MESSAGE = '未发送成功需重试'
+
+    def __init__(self, to_conversation: str, text='', filepaths=None):
+        self.to_conversation = to_conversation
+        self.text = text.rstrip('\n') if text else ''   # 尾部的换行不会发送，比较时去掉
+        self.filenames = [os.path.basename(x) for x in filepaths] if filepaths else []
+        self.tail_items = []   # 消息列表尾部，最新的在前，[(内容, 文件名)]
+        self.is_rechecked = False   # 检查失败后是否重新切换到该会话读取过
+
+    def verify(self) -> bool:
+        filenames = list(self.filenames)
+        text_matched = not self.text
+        for content, filename in self.tail_items:
+            if filename and filename in filenames:
+                filenames.remove(filename)
+            elif not text_matched and content.rstrip('\n') == self.text:
+                text_matched = True
+        return text_matched and not filenames
+
+
 class MessageInfo(object):
 
     def __init__(self, message_control: Control):
@@ -116,6 +203,51 @@ class MessageInfo(object):
         return self.content == other.content and self.filepath == self.filepath
 
 
+class MessageRecord(object):
+    """
+    消息记录，只保存读取到的数据，不引用控件
+    """
+    __slots__ = ('sender', 'self_sender', 'time', 'content', 'content_hash', 'type')
+
+    def __init__(self, sender: str, self_sender: bool, content: str, message_time=''):
+        self.sender = sender
+        self.self_sender = self_sender
+        self.time = message_time
+        self.content = content
+        self.content_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
+        self.type = MESSAGE_TYPES.get(content, 'text')
+
+    @staticmethod
+    def from_control(message_item_control: Control, first_child_control: Control = None) -> 'MessageRecord':
+        first_child_control = first_child_control if first_child_control else message_item_control.GetFirstChildControl()
+        sender = first_child_control.GetFirstChildControl().Name
+        self_sender = False
+        if not sender:
+            # 自己发送的消息
+            self_sender = True
+            sender = first_child_control.GetLastChildControl().Name
+        return MessageRecord(sender, self_sender, message_item_control.Name)
+
+    @property
+    def key(self) -> tuple:
+        # 用于水位线比较
+        return self.sender, self.self_sender, self.content_hash
+
+    def to_dict(self) -> dict:
+        return {
+            'time': self.time,
+            'sender': self.sender,
+            'self': self.self_sender,
+            'content': self.content,
+            'contentHash': self.content_hash,
+            'type': self.type,
+        }
+
+    def __repr__(self):
+        return 'MessageRecord(sender={!r}, time={!r}, type={}, hash={})'.format(
+            self.sender, self.time, self.type, self.content_hash[:8])
+
+
 @unique
 class WechatAppState(str, Enum):
     INIT = 'INIT'  # 初始状态
@@ -145,11 +277,12 @@ class ControlTag(str, Enum):
 
 # 微信客户端封装
 class WechatApp(object):
+    APP_NAME = 'wechat'  # 应用名称，用于区分学习到的控件定位路径
 
     def __init__(self, main_window=None):
         self.main_window = main_window
-        # 微信中缓存控件map
-        self.cached_control = {}
+        # 微信中缓存控件，按窗口代数和RuntimeId校验
+        self.control_cache = ControlCache()
         # 微信当前状态
         self.state = 'INIT'
         # 当前登录的用户名称
@@ -158,9 +291,31 @@ class WechatApp(object):
         self.active_conversation = None
         # 当前激活聊天会话框备注名
         self.active_conversation_remark = None
-        self.history_message_map = {}
+        # 会话消息水位线，conversation -> (最后读取的消息key列表，最新消息时间)
+        self.message_watermarks = {}
+        # 中转会话中已经发送过的消息，相同内容批量发送时直接转发
+        self.forward_sources = ForwardSourceIndex()
+        # 发送链接卡片时保持打开的内置浏览器窗口，下一个链接直接在该窗口中打开
+        self.link_browser_window = None
+        # 会话在会话列表中的位置，用于选择切换会话的方式
+        self.conversation_index = ConversationIndex()
+        # 搜索不到的会话，缓存期间直接失败
+        self.unknown_conversations = NegativeCache('unknown_conversation', UNKNOWN_CONVERSATION_TTL_SECONDS)
+        # 文件上传速度估计，用于等待上传完成的超时时间
+        self.upload_estimator = ThroughputEstimator('upload.{}'.format(self.APP_NAME), UPLOAD_INITIAL_BYTES_PER_SECOND)
+        # 控件索引快照，key为快照根控件，value为 (快照, 抓取时控件缓存的bump次数)
+        self.index_snapshots = {}
         self._init_mian_window()
+        if self.main_window:
+            # 只监听应用进程的窗口事件，弹窗、转发窗口等都属于该进程
+            get_window_registry().track_process(self.main_window.ProcessId)
+        # 学习到的控件定位路径，按应用版本区分
+        self.locator_profiler = LocatorProfiler(self.APP_NAME, get_process_file_version(self.main_window.ProcessId)
+                                                if self.main_window else '')
         self._init_login_user_name()
+        # 历史消息指纹，登录后按账号持久化
+        self.history_store = HistoryStore(persist_path=get_cache_path('history-{}-{}.json'.format(
+            self.APP_NAME, md5_encrypt(self.login_user_name))) if self.login_user_name else None)
         self.check_skip_update()
 
     @staticmethod
@@ -212,16 +367,27 @@ class WechatApp(object):
         :param with_check: 是否坚持控件存在
         :return: 查询到的控件
         """
-        # 使用缓存，非空才使用
-        if use_cache and tag in self.cached_control and self.cached_control[tag]:
-            logger.info('search control with cache: {}'.format(tag))
-            return self.cached_control[tag]
+        # 使用缓存，校验有效才使用
+        if use_cache:
+            cached_control = self.control_cache.get(tag)
+            if cached_control:
+                logger.info('search control with cache: {}'.format(tag))
+                return cached_control
 
         if not self.main_window:
             logger.error('还未绑定主窗口')
             return None
 
+        # 优先使用学习到的定位路径，失败时再进行深度搜索
+        locator_root = self._get_locator_root(tag)
+        find_control = self.locator_profiler.locate(tag, locator_root)
+        if find_control:
+            logger.info('Attach control with learned locator: {}'.format(tag))
+            self.control_cache.put(tag, find_control, self._get_control_window(tag))
+            return find_control
+
         # 尝试查找控件
+        search_begin_time = time.time()
         try:
             find_control = self._search_control_by_tag(tag, use_cache, with_check)
         except LookupError as e:
@@ -239,17 +405,26 @@ class WechatApp(object):
                 return None
 
         logger.info('Attach control success: {}'.format(tag))
-        self.cached_control[tag] = find_control
-        return self.cached_control[tag]
+        self.locator_profiler.learn(tag, locator_root, find_control, time.time() - search_begin_time)
+        self.control_cache.put(tag, find_control, self._get_control_window(tag))
+        return find_control
+
+    def _get_locator_root(self, tag: ControlTag) -> Control:
+        # 学习定位路径时的根控件
+        return self.main_window
+
+    def _get_control_window(self, tag: ControlTag) -> str:
+        # 控件所属窗口，用于控件缓存按窗口代数失效
+        return MAIN_WINDOW
 
     def _search_control_by_tag(self, tag: ControlTag, use_cache=True, with_check=True):
         find_control = None
         if tag == ControlTag.CONVERSATION_LIST:
             # 会话列表控件
-            find_control = self.main_window.ListControl(Name='会话')
+            find_control = self._index_search_control('ListControl', Name='会话')
         elif tag == ControlTag.CONVERSATION_SEARCH:
             # 会话搜索控件
-            find_control = self.main_window.EditControl(Name='搜索')
+            find_control = self._index_search_control('EditControl', Name='搜索')
         elif tag == ControlTag.CONVERSATION_SEARCH_CLEAR:
             anchor_control = self._search_control(ControlTag.CONVERSATION_SEARCH, use_cache, with_check)
             if anchor_control:
@@ -258,16 +433,18 @@ class WechatApp(object):
             # 当前激活的会话，基于消息控件定位
             anchor_control = self._search_control(ControlTag.NAVIGATION, use_cache, with_check)
             if anchor_control:
-                find_control = select_control(anchor_control, 'p>pane:1>pane-6>pane:1>pane-2')
+                # 等价于 'p>pane:1>pane-6>pane:1>pane-2'，在父节点快照中查找
+                snapshot = self._capture_snapshot(anchor_control.GetParentControl())
+                find_control = select_control(snapshot, 'pane:1>pane-6>pane:1>pane-2')
         elif tag == ControlTag.CONVERSATION_SEARCH_RESULT:
             # 搜索会话结果
             # find_control = self.main_window.ListControl(Name='搜索结果')
-            find_control = self.main_window.ListControl(Name='@str:IDS_FAV_SEARCH_RESULT:3780')
+            find_control = self._index_search_control('ListControl', Name='@str:IDS_FAV_SEARCH_RESULT:3780')
         elif tag == ControlTag.MESSAGE_LIST:
             # 消息列表
             # message_list_selector = 'pane:1>pane:1>pane:2>pane>pane>pane>pane>pane:1>pane>pane>list'
             # list_control = select_control(self.__main_window, message_list_selector)
-            find_control = self.main_window.ListControl(Name='消息')
+            find_control = self._index_search_control('ListControl', Name='消息')
         elif tag == ControlTag.MESSAGE_INPUT:
             # 消息输入框
             # selector = 'pane:1>pane:2>pane>pane>pane>pane>pane:1>pane:1>pane:1>pane>pane>edit'
@@ -275,16 +452,42 @@ class WechatApp(object):
             # self.__message_input_control = select_control(self.__main_window, selector)
             # find_control = self.main_window.EditControl(Name='输入')
             # 通过表情按钮来定位
-            anchor_control = self.main_window.ButtonControl(Name='表情')
+            anchor_control = self._index_search_control('ButtonControl', Name='表情')
             if anchor_control:
                 find_control = select_control(anchor_control, '.>.>pane>edit')
         elif tag == ControlTag.MESSAGE_SEND_FILE:
             # 发送文件按钮
-            find_control = self.main_window.ButtonControl(Name='发送文件')
+            find_control = self._index_search_control('ButtonControl', Name='发送文件')
         elif tag == ControlTag.NAVIGATION:
-            find_control = self.main_window.ToolBarControl(Name='导航', searchDepth=3)
+            find_control = self._index_search_control('ToolBarControl', Name='导航', searchDepth=3)
         return find_control
 
+    def _capture_snapshot(self, root_control=None, max_depth=None) -> ControlTreeSnapshot:
+        """
+        批量抓取控件树快照，默认是主窗口，快照中的查找和属性读取都不会产生跨进程调用
+        :param root_control: 快照根控件，默认是主窗口
+        :param max_depth: 快照最大深度，为空表示整棵子树
+        """
+        return ControlTreeSnapshot.capture(root_control if root_control else self.main_window, max_depth)
+
+    def _index_search_control(self, control_type: str, root_control=None, **search_properties) -> Control:
+        """
+        通过快照索引查找控件，代替 main_window.ButtonControl(Name=...) 这类不限深度的搜索，索引未命中时回退为实时搜索
+        快照在有效期内被多个控件查找复用
+        :param control_type: 控件类型，如 ButtonControl
+        :param root_control: 搜索根控件，默认是主窗口
+        :param search_properties: 搜索属性
+        """
+        root_control = root_control if root_control else self.main_window
+        # 快照记录抓取时控件缓存的bump次数，界面状态变化（bump）后快照立即失效
+        snapshot, bump_count = self.index_snapshots.get(root_control, (None, None))
+        if not snapshot or bump_count != self.control_cache.bump_count \
+                or time.time() - snapshot.created_time > INDEX_SNAPSHOT_SECONDS:
+            bump_count = self.control_cache.bump_count
+            snapshot = self._capture_snapshot(root_control)
+            self.index_snapshots[root_control] = (snapshot, bump_count)
+        return search_control(root_control, control_type, snapshot, **search_properties)
+
     # 激活微信窗口窗口
     def active(self, force=False, wait_time=0.5):
         active_window(self.main_window, force, wait_time)
@@ -302,22 +505,28 @@ class WechatApp(object):
         logger.info('退出登录信息: {}'.format(info_control.Name))
         # 点击确定按钮
         control_click(confirm_button_control)
+        self.control_cache.bump()
         return True
 
     # 关闭提示框，避免卡住
     def close_alter_window(self):
         # 取消按钮
-        cancel_button = select_control(self.main_window, '>:1>:2>:5>button:2')
+        snapshot = self._capture_snapshot(max_depth=5)  # 按钮选择器最深到第5层
+        cancel_button = snapshot.select('>:1>:2>:5>button:2')
         if cancel_button and cancel_button.Name == '取消':
             logger.info('点击【取消】按钮关闭提示框')
-            control_click(cancel_button)
+            control_click(cancel_button.control)
+            self.control_cache.bump(MAIN_WINDOW)
+            # 关闭提示框后界面已经变化，需要重新获取快照
+            snapshot = self._capture_snapshot(max_depth=5)
 
         # 多选后不能转发提示框
-        i_known_button = select_control(self.main_window, '>:1>>:2>:1')
+        i_known_button = snapshot.select('>:1>>:2>:1')
         if i_known_button and i_known_button.Name == '我知道了':
             logger.info('点击【我知道了】按钮关闭微信提示框')
             # 点击【关闭多选】工具栏
-            control_click(i_known_button)
+            control_click(i_known_button.control)
+            self.control_cache.bump(MAIN_WINDOW)
             close_multi_button = select_control(self._search_control(ControlTag.MESSAGE_LIST), 'p>p>p>:1>:1>>:1')
             if close_multi_button and close_multi_button.Name == '关闭多选':
                 logger.info('点击【关闭多选】按钮关闭多选工具栏')
@@ -333,14 +542,15 @@ class WechatApp(object):
         logger.info('登录账号信息： {}'.format(login_account))
         # 点击登录按钮，等待手机确认登录
         control_click(login_control)
+        self.control_cache.bump()
         self.login_user_name = login_account
 
     # 检查并跳过强制更新
     def check_skip_update(self):
         update_control: Control = None
-        for control in self.main_window.GetChildren():
-            if control.Name == '升级':
-                update_control = control
+        for node in self._capture_snapshot(max_depth=1).root.children:
+            if node.Name == '升级':
+                update_control = node.control
                 break
         if not update_control:
             logger.info('没有更新窗口不需要操作.')
@@ -352,6 +562,7 @@ class WechatApp(object):
             return False
         logger.info('点击【忽略本次更新】按钮.')
         control_click(skip_update_button_control)
+        self.control_cache.bump(MAIN_WINDOW)
         return True
 
     # 登录时点击切换账号按钮
@@ -361,6 +572,7 @@ class WechatApp(object):
             logger.warning('未找到【切换账号】按钮')
             return False
         control_click(switch_account_control)
+        self.control_cache.bump()
         return True
 
     # 检查和发送登录二维码，登录二维码页面时返回Ture，否则返回False
@@ -381,16 +593,50 @@ class WechatApp(object):
         logger.info('conversation list size: {}'.format(len(conversation_item_controls)))
         return conversation_item_controls
 
-    def _roll_up_conversation_controls(self, roll_times):
+    def _roll_up_conversation_controls(self, roll_times, conversation: str = None, display_name: str = None) -> bool:
         """
-        滚动会话列表
-        :return:
+        滚动会话列表，每次滚动后刷新会话位置索引
+        :return: 是否切换到了查找的会话
         :param roll_times: 滚动次数
+        :param conversation: 查找的会话，不为空时滚动后出现该会话立即点击切换
+        :param display_name: 会话在列表中显示的名称
         """
         conversation_list_control = self._search_control(ControlTag.CONVERSATION_LIST)
         for i in range(roll_times):
-            time.sleep(0.5)
-            conversation_list_control.WheelDown(wheelTimes=3, waitTime=0.1 * i)
+            conversation_list_control.WheelDown(wheelTimes=3, waitTime=0.3)
+            self.conversation_index.scroll(3)
+            conversation_list_snapshot = self._observe_conversation_list()
+            if conversation and self._click_visible_conversation(conversation, conversation_list_snapshot,
+                                                                 display_name):
+                return True
+        return False
+
+    # 读取当前可见的会话列表，并刷新会话位置索引
+    def _observe_conversation_list(self) -> ControlTreeSnapshot:
+        conversation_list_snapshot = self._capture_snapshot(self._search_control(ControlTag.CONVERSATION_LIST), 1)
+        self.conversation_index.observe([x.Name for x in conversation_list_snapshot.root.children])
+        return conversation_list_snapshot
+
+    # 点击会话列表中可见的会话，返回是否切换成功
+    def _click_visible_conversation(self, conversation: str, conversation_list_snapshot: ControlTreeSnapshot,
+                                    display_name: str = None) -> bool:
+        for conversation_node in conversation_list_snapshot.root.children:
+            if conversation_node.Name in (conversation, display_name):
+                control_click(conversation_node.control, wait_timeout=1, wait_name='switch_conversation',
+                              wait_predicate=lambda: self._is_match_current_conversation(conversation))
+                # 需要检查是否切换成功，一般显示10个会话，可能因为屏幕原因未显示
+                return self._is_match_current_conversation(conversation)
+        return False
+
+    # 滚动会话列表到记录的位置
+    def _scroll_conversation_list(self, scroll_offset: int):
+        wheel_times = scroll_offset - self.conversation_index.scroll_offset
+        conversation_list_control = self._search_control(ControlTag.CONVERSATION_LIST)
+        if wheel_times > 0:
+            conversation_list_control.WheelDown(wheelTimes=wheel_times, waitTime=0.1)
+        else:
+            conversation_list_control.WheelUp(wheelTimes=-wheel_times, waitTime=0.1)
+        self.conversation_index.scroll(wheel_times)
 
     def _attach_active_conversation(self):
         """
@@ -399,7 +645,9 @@ class WechatApp(object):
         """
         # 激活会话标题控件
         conversation_title_control = self._search_control(ControlTag.CONVERSATION_ACTIVE_TITLE, with_check=False)
-        conversation_remark_control = select_control(conversation_title_control, 'pane > text')
+        # 标题控件层级很浅，一次获取快照后读取名称
+        conversation_title_snapshot = ControlTreeSnapshot.capture(conversation_title_control, max_depth=2)
+        conversation_remark_control = conversation_title_snapshot.select('pane > text')
         if not conversation_remark_control:
             logger.warning('Can not find active conversation title control.')
             # 重置激活会话信息，避免缓存数据
@@ -409,7 +657,7 @@ class WechatApp(object):
         self.active_conversation_remark = conversation_remark_control.Name
         # 替换群聊后面的人数，注意这儿取的是备注名称
         self.active_conversation_remark = re.sub(r' \(\d+\)', '', self.active_conversation_remark)
-        source_conversation_control = select_control(conversation_title_control, 'text')
+        source_conversation_control = conversation_title_snapshot.select('text')
         if source_conversation_control:
             # 有原会话名称节点的case，取原会话名称
             self.active_conversation = source_conversation_control.Name
@@ -429,55 +677,86 @@ class WechatApp(object):
         message_list_control = self._search_control(ControlTag.MESSAGE_LIST)
         message_item_controls = []
         for message_item_control in message_list_control.GetChildren():
-            if filter_time and (message_item_control.GetFirstChildControl() is None
-                                or message_item_control.GetFirstChildControl().GetFirstChildControl() is None):
+            if filter_time and not is_message_item_control(message_item_control):
                 # logger.info('filter message: ' + message_item_control.Name)
                 continue
             message_item_controls.append(message_item_control)
         logger.info('message list size: {}'.format(len(message_item_controls)))
         return message_item_controls
 
-    # 获取当前激活对话的消息列表
-    def get_conversation_messages(self, conversation: str = None):
+    # 从最后一条消息开始向前遍历消息控件，不获取整个消息列表
+    def _iter_message_item_controls_reversed(self, filter_time=True) -> Iterator[Control]:
+        message_item_control = self._search_control(ControlTag.MESSAGE_LIST).GetLastChildControl()
+        while message_item_control:
+            if not filter_time or is_message_item_control(message_item_control):
+                yield message_item_control
+            message_item_control = message_item_control.GetPreviousSiblingControl()
+
+    # 获取最后几条消息控件，最新的消息在前，耗时只和获取的数量有关，和历史消息数量无关
+    def _get_last_message_item_controls(self, count=CHECK_SEND_SUCCESS_SIZE, filter_time=True) -> List[Control]:
+        return list(islice(self._iter_message_item_controls_reversed(filter_time), count))
+
+    # 从最后一条消息开始向前读取消息，遇到上次读取的水位线时停止，按时间顺序返回新消息
+    def iter_conversation_messages(self, conversation: str = None, only_new=True) -> Iterator['MessageRecord']:
         """
-        获取某个对话中加载的消息列表
+        流式读取某个对话中加载的消息，每个会话记录最后读取的几条消息作为水位线，重复调用时只返回新消息
         :param conversation: 指定会话，如果未指定，则使用当前激活的会话，否则会切换到指定会话
-        :return: 消息列表
+        :param only_new: 是否只返回水位线之后的新消息
+        :return: 消息记录，不引用控件，控件失效后仍然可以使用
         """
         if conversation:
             self._search_switch_conversation(conversation)
-        messages = []
-        message_item_controls = self._search_control(ControlTag.MESSAGE_LIST).GetChildren()
-        base_time = datetime.now()  # 消息基准时间
-        for message_item_control in message_item_controls:
-            if message_item_control.GetFirstChildControl() is None:
+        conversation = conversation if conversation else self.active_conversation
+        watermark_keys, watermark_time = self.message_watermarks.get(conversation, ([], None)) if only_new \
+            else ([], None)
+        records = []   # 最新的消息在前
+        pending_records = []   # 还没有确定时间的消息
+        for message_item_control in self._iter_message_item_controls_reversed(filter_time=False):
+            first_child_control = message_item_control.GetFirstChildControl()
+            if first_child_control is None:
                 continue
-            if message_item_control.GetFirstChildControl().GetFirstChildControl() is None:
+            if first_child_control.GetFirstChildControl() is None:
+                # 时间分隔项，之后的消息都是这个时间
                 base_time = parse_time_str(message_item_control.Name)
-                # logger.info('parse base time: {}'.format(base_time))
-            elif message_item_control.Name == '以下为新消息':
-                base_time = datetime.now()
-            elif message_item_control.Name == '查看更多消息':
+                for record in pending_records:
+                    record.time = base_time.strftime('%Y-%m-%d %H:%M:%S') if base_time else ''
+                pending_records = []
                 continue
-            else:
-                sender = message_item_control.GetFirstChildControl().GetFirstChildControl().Name
-                self_sender = False
-                if not sender:
-                    # 自己发送的消息
-                    self_sender = True
-                    sender = message_item_control.GetFirstChildControl().GetLastChildControl().Name
-                message_content = message_item_control.Name
-                message = {
-                    'time': base_time.strftime("%Y-%m-%d %H:%M:%S"),
-                    'sender': sender,
-                    'self': self_sender,
-                    'content': message_content,
-                    'control': message_item_control
-                }
-                messages.append(message)
-                logger.info('message: {}'.format(message))
-        logger.info('message list size: {}'.format(len(messages)))
-        return messages
+            if message_item_control.Name == '以下为新消息':
+                for record in pending_records:
+                    record.time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                pending_records = []
+                continue
+            if message_item_control.Name == '查看更多消息':
+                continue
+            record = MessageRecord.from_control(message_item_control, first_child_control)
+            records.append(record)
+            pending_records.append(record)
+            if watermark_keys and [x.key for x in records[-len(watermark_keys):]] == watermark_keys:
+                # 读取到水位线，水位线之后没有时间分隔的消息和水位线的时间相同
+                records = records[:-len(watermark_keys)]
+                for record in pending_records:
+                    record.time = watermark_time
+                pending_records = []
+                break
+        for record in pending_records:
+            # 没有时间分隔项的消息，使用当前时间
+            record.time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if records:
+            newest_records = records[:MESSAGE_WATERMARK_SIZE]
+            self.message_watermarks[conversation] = ([x.key for x in newest_records], newest_records[0].time)
+        logger.info('conversation: {}, new message size: {}'.format(conversation, len(records)))
+        yield from reversed(records)
+
+    # 获取当前激活对话的消息列表
+    def get_conversation_messages(self, conversation: str = None, only_new=False) -> List[dict]:
+        """
+        获取某个对话中加载的消息列表
+        :param conversation: 指定会话，如果未指定，则使用当前激活的会话，否则会切换到指定会话
+        :param only_new: 是否只返回上次读取之后的新消息
+        :return: 消息列表
+        """
+        return [x.to_dict() for x in self.iter_conversation_messages(conversation, only_new)]
 
     def _load_more_message(self, n=0.1):
         """
@@ -494,41 +773,95 @@ class WechatApp(object):
         anchor_control = anchor_control if anchor_control else self.main_window
         anchor_control.SendKeys('{Ctrl}f', waitTime=0.5)
 
+    # 中转会话等内部使用的会话，偶尔搜索失败不能记录到否定缓存，否则之后的批量发送全部失败
+    def _is_internal_conversation(self, conversation: str) -> bool:
+        return conversation == TEMP_CONVERSATION
+
+    # 记录确认搜索不到的会话，只有搜索结果已经显示并且没有匹配项时才调用，超时或者结果为空不记录
+    def _add_unknown_conversation(self, conversation: str, reason: str):
+        if self._is_internal_conversation(conversation):
+            logger.warning('内部会话搜索失败，不记录到否定缓存: {}'.format(conversation))
+            return
+        self.unknown_conversations.add(conversation, reason)
+
     # 切换到指定对话
+    # 检查会话是否在最近搜索不到的会话中，是的话直接抛出异常
+    def _check_unknown_conversation(self, conversation: str):
+        unknown_reason = self.unknown_conversations.get(conversation)
+        if unknown_reason:
+            raise ControlInvalidException(unknown_reason)
+
+    # 过滤最近搜索不到的会话，直接返回失败结果，不操作界面
+    def _filter_unknown_conversations(self, to_conversations: list) -> (List[SendResult], list):
+        fail_results, send_conversations = [], []
+        for to_conversation in to_conversations:
+            unknown_reason = self.unknown_conversations.get(to_conversation)
+            if unknown_reason:
+                fail_results.append(SendResult.fail(to_conversation, unknown_reason))
+            else:
+                send_conversations.append(to_conversation)
+        if fail_results:
+            logger.info('跳过最近搜索不到的会话: {}'.format([x.to_conversation for x in fail_results]))
+        return fail_results, send_conversations
+
     def _search_switch_conversation(self, conversation: str):
         logger.info('开始处理切换会话: {}'.format(conversation))
+        self._check_unknown_conversation(conversation)
         self.active()  # 先置顶窗口
         # 检查当前激活会话窗口，如果匹配则不需要切换【对于相同名称对话不能处理】
         if self._is_match_current_conversation(conversation):
             # 会话窗口没有变化则不进行切换
             logger.info('当前会话已经打开，无需进行切换: {}'.format(conversation))
             return True
-
-        # 先检查当前会话列表中是否有匹配，避免搜索，对于有备注的会话，此处只能匹配备注名称
-        for conversation_control in self._get_conversation_item_controls():
-            if conversation_control.Name == conversation:
-                control_click(conversation_control)
-                # 需要检查是否切换成功，一般显示10个会话，可能因为屏幕原因未显示
-                if self._is_match_current_conversation(conversation):
-                    logger.info('会话列表中有需要切换的会话，直接点击切换无需搜索: {}'.format(conversation))
-                    return True
+        # 切换会话后消息列表等控件会重建，之前的索引快照不再可用
+        self.index_snapshots = {}
+
+        # 先检查当前会话列表中是否有匹配，避免搜索，有备注的会话通过位置索引记录的显示名称匹配
+        conversation_list_snapshot = self._observe_conversation_list()
+        route, position = self.conversation_index.choose_route(
+            conversation, [x.Name for x in conversation_list_snapshot.root.children])
+        display_name = self.conversation_index.get_display_name(conversation)
+        if route != ROUTE_SEARCH:
+            begin_time = time.time()
+            if route == ROUTE_SCROLL:
+                logger.info('滚动会话列表到记录的位置: {}, offset: {}'.format(conversation, position.scroll_offset))
+                self._scroll_conversation_list(position.scroll_offset)
+                conversation_list_snapshot = self._observe_conversation_list()
+            is_switched = self._click_visible_conversation(conversation, conversation_list_snapshot, display_name)
+            self.conversation_index.record_route(route, time.time() - begin_time, is_switched)
+            if is_switched:
+                logger.info('会话列表中有需要切换的会话，直接点击切换无需搜索: {}, route: {}'.format(conversation, route))
+                return True
+        elif not position:
+            # 没有记录过位置，向下滚动几页查找，同时记录滚动时看到的会话位置，之后可以直接滚动到该位置
+            begin_time = time.time()
+            is_switched = self._roll_up_conversation_controls(CONVERSATION_LIST_MAX_ROLLS, conversation, display_name)
+            self.conversation_index.record_route(ROUTE_SCROLL, time.time() - begin_time, is_switched)
+            if is_switched:
+                logger.info('滚动会话列表找到需要切换的会话，无需搜索: {}'.format(conversation))
+                return True
 
         # 搜索会话，同时支持备注名称和原名称
         logger.info('搜索会话列表： {}'.format(conversation))
+        search_begin_time = time.time()
         self._send_search_shortcut()
         search_control = self._search_control(ControlTag.CONVERSATION_SEARCH)
         # self.control_click(search_control)  # 使用快捷键更快，不需要移动鼠标指针
-        search_control.SendKeys('{Ctrl}a')  # 避免还有旧的搜索
-        win32_clipboard_text(conversation)
-        search_control.SendKeys('{Ctrl}v')
+        win32_paste_text(search_control, conversation, clear=True)  # 全选替换，避免还有旧的搜索
 
-        # 检查搜索结果列表
+        # 检查搜索结果列表，等待出现结果分类标签，说明搜索结果已经显示
         search_list_control = self._search_control(ControlTag.CONVERSATION_SEARCH_RESULT)
+        search_list_snapshot = wait_until(lambda: self._capture_rendered_search_result(search_list_control),
+                                          timeout=2, name='conversation_search_result')
+        is_rendered = search_list_snapshot is not None
+        if not is_rendered:
+            search_list_snapshot = self._capture_snapshot(search_list_control, max_depth=5)
+        is_matched = False
         result_type = ''
-        for search_item in search_list_control.GetChildren():
+        for search_node in search_list_snapshot.root.children:
             # result_type表示当前匹配的标签，比如 '联系人', '群聊', '聊天记录'
-            if search_item.ControlTypeName == 'PaneControl' and search_item.GetFirstChildControl():
-                result_type = search_item.GetFirstChildControl().Name
+            if search_node.ControlTypeName == 'PaneControl' and search_node.GetFirstChildControl():
+                result_type = search_node.GetFirstChildControl().Name
                 continue
 
             # 暂时只匹配联系人、群聊、公众号
@@ -536,13 +869,14 @@ class WechatApp(object):
                 continue
 
             # 匹配备注名称
-            if conversation == search_item.Name:
+            if conversation == search_node.Name:
                 logger.info('搜索到会话： {}, 类型： {}'.format(conversation, result_type))
-                control_click(search_item)
+                is_matched = True
+                control_click(search_node.control)
                 break
 
             # 匹配原名称
-            source_conversation_node = select_control(search_item, 'pane>pane>pane>text')
+            source_conversation_node = search_list_snapshot.select('pane>pane>pane>text', search_node)
             if not source_conversation_node:
                 continue
             # 提取匹配内容
@@ -550,9 +884,10 @@ class WechatApp(object):
             match_conversation = re.sub(r'^群聊名称: ', '', match_conversation)
             match_conversation = re.sub(r'<em>([^<]*)</em>', r'\1', match_conversation)
             if match_conversation == conversation:
-                target_conversation_control = search_item
+                target_conversation_control = search_node.control
                 logger.info('搜索到会话： {}, 类型： {}'.format(conversation, result_type))
-                control_click(search_item)
+                is_matched = True
+                control_click(target_conversation_control)
 
                 # 检查是否切换成功，有时候点击切换会不生效，所以重试第二次
                 if not self._is_match_current_conversation(conversation):
@@ -568,30 +903,53 @@ class WechatApp(object):
             logger.error('切换会话失败: {}'.format(conversation))
             # 未搜索到会话，退出搜索，抛出异常
             control_click(self._search_control(ControlTag.CONVERSATION_SEARCH_CLEAR, with_check=False))
+            if is_rendered and not is_matched:
+                # 搜索到会话但切换失败，或者搜索结果还没显示，可能是偶然的失败，不记录
+                self._add_unknown_conversation(conversation, '未搜索到该私聊名称或者群聊名称：' + conversation)
+            self.conversation_index.record_route(ROUTE_SEARCH, time.time() - search_begin_time, False)
+            self.conversation_index.reset_scroll()
             raise ControlInvalidException('未搜索到该私聊名称或者群聊名称：' + conversation)
+        self.conversation_index.record_route(ROUTE_SEARCH, time.time() - search_begin_time, True)
+        # 搜索后会话列表回到顶部
+        self.conversation_index.reset_scroll()
+        # 搜索切换后会话会移到会话列表顶部，记录显示名称，下次可以直接在会话列表中点击
+        self.conversation_index.add_alias(self.active_conversation_remark, conversation, self.active_conversation)
         logger.info('切换会话成功: {}'.format(conversation))
         return True
 
+    # 搜索结果中出现分类标签时返回快照，否则返回None
+    def _capture_rendered_search_result(self, search_list_control: Control) -> ControlTreeSnapshot | None:
+        snapshot = self._capture_snapshot(search_list_control, max_depth=5)  # 从第1层的结果节点再向下选择4层文本
+        for search_node in snapshot.root.children:
+            if search_node.ControlTypeName == 'PaneControl' and search_node.GetFirstChildControl():
+                return snapshot
+        return None
+
     # 首次切换到新对话，需要记录历史消息，避免重复回答，可设置保留最近消息并处理，用于首次启动继续回复
     def record_history_message(self, conversation_name: str, keep_recent_count=1):
-        if conversation_name in self.history_message_map:
+        if self.history_store.contains_conversation(conversation_name):
             # 非首次启动，已经有历史消息记录，不处理
             return
         # 初始化，避免新对话没有任何消息，最后一条消息留用，后续会判断是否是自己发的消息，如果是对面发的消息，则可以回复
-        self.history_message_map[conversation_name] = self.history_message_map.get(conversation_name, [])
         history_message_controls = self._get_message_item_controls()
         history_message_controls = history_message_controls[:-1 * keep_recent_count] if keep_recent_count > 0 \
             else history_message_controls
-        for message_control in history_message_controls:
-            self.history_message_map[conversation_name].append(message_control.Name)
+        self.history_store.add(conversation_name, [x.Name for x in history_message_controls])
+        self.history_store.save()
         logger.info('conversation: {}, history message size: {}, record size: {}'
                     .format(conversation_name, len(history_message_controls),
-                            len(self.history_message_map.get(conversation_name))))
-        # logger.info('history message: {}'.format(self.__history_message_map.get(conversation_name)))
+                            self.history_store.size(conversation_name)))
 
-    def _send_clipboard_messages(self, click_input_control=True, clear=False):
+    # 是否是已经记录过的历史消息
+    def is_history_message(self, conversation_name: str, content: str) -> bool:
+        return self.history_store.contains(conversation_name, content)
+
+    def _send_clipboard_messages(self, text: str = None, paths: list = None, click_input_control=True, clear=False):
         """
-        发送剪贴板内容到输入框，需要确保当前输入框是focus的
+        通过剪贴板粘贴文件和文本到输入框并发送，需要确保当前输入框是focus的
+        文件和文本在同一个剪贴板会话中先后粘贴，一次回车发送，保持先文件后文本的顺序，发送后恢复用户原来的剪贴板
+        :param text: 发送的文本
+        :param paths: 发送的文件绝对路径列表
         :param click_input_control: 是否点击一下消息输入框，默认False
         :param clear: 是否清空当前输入框内容，默认False
         :return:
@@ -603,30 +961,36 @@ class WechatApp(object):
         if clear:
             # 清空输入框的内容
             input_control.SendKeys('{Ctrl}a', waitTime=0)
-        input_control.SendKeys('{Ctrl}v')
-        # 使用快捷键Enter发送消息，而不是点击，查找元素消耗0.5秒左右
-        # send_button_control = wechat_windows.ButtonControl(Name='sendBtn', Depth=14).Click()
-        time.sleep(random.uniform(0.3, 0.5))
-        input_control.SendKeys('{Enter}')
-
-    def send_text_message(self, message, check_send_success=True) -> List[Control]:
+        with clipboard_service.preserved():
+            if paths:
+                clipboard_service.set(paths=paths)
+                input_control.SendKeys('{Ctrl}v')
+            if text:
+                clipboard_service.set(text=text)
+                input_control.SendKeys('{Ctrl}v')
+            # 使用快捷键Enter发送消息，而不是点击，查找元素消耗0.5秒左右
+            # send_button_control = wechat_windows.ButtonControl(Name='sendBtn', Depth=14).Click()
+            time.sleep(random.uniform(0.3, 0.5))
+            input_control.SendKeys('{Enter}')
+
+    def send_text_message(self, message, check_send_success=True, defer_check=False) -> List[Control]:
         """
         向当前聊天窗口发送文本消息，支持换行
         :param message: 文本消息
         :param check_send_success: 检测是否发送成功，通过聊天消息列表中看是否有刚才发送的消息来确认，并不十分准确，比如重复消息
+        :param defer_check: 延后检查，发送后不读取消息列表，由调用方通过 _capture_send_verification 检查
         :return: 发送的消息控件
         """
         logger.info('send text message: {}'.format(message))
         # 使用粘贴板输入更快，还能处理换行符的问题
         # input_control.SendKeys(message)  # 换行符输入有问题，不能使用这种方式
-        win32_clipboard_text(message)
-        self._send_clipboard_messages()
+        self._send_clipboard_messages(text=message)
+        if defer_check:
+            return []
 
-        # 获取最后5条消息，比较是否已经发送
+        # 获取最后几条消息，比较是否已经发送
         send_message_controls = []
-        check_message_controls = self._get_message_item_controls()[-CHECK_SEND_SUCCESS_SIZE:]
-        check_message_controls.reverse()
-        for message_control in check_message_controls:
+        for message_control in self._get_last_message_item_controls():
             # 发送文本消息，尾部的换行不会发送，比较时去掉尾部的换行符
             if MessageInfo(message_control).content.rstrip('\n') == message.rstrip('\n'):
                 send_message_controls.append(message_control)
@@ -653,17 +1017,19 @@ class WechatApp(object):
         file_name_edit_control = file_select_window.ComboBoxControl(RegexName='文件名').EditControl(Depth=1)
         check_control_exist(file_name_edit_control, '未找到【文件名】编辑窗口')
         # 直接复制粘贴文件绝对路径并发送即可
-        win32_clipboard_text(image_path)
-        file_name_edit_control.SendKeys('{Ctrl}v')
+        win32_paste_text(file_name_edit_control, image_path)
         file_name_edit_control.SendKeys('{Enter}')
         self.main_window.SendKeys('{Enter}')
 
     # 发送文件消息
-    def send_file_message(self, filepaths: list, check_send_success=True) -> List[Control]:
+    def send_file_message(self, filepaths: list, check_send_success=True, defer_check=False,
+                          append_text='') -> List[Control]:
         """
         向当前聊天窗口发送文件
         :param filepaths: 要发送文件的绝对路径列表
         :param check_send_success: 强制检查是否发送成功
+        :param defer_check: 延后检查，发送后不读取消息列表，由调用方通过 _capture_send_verification 检查
+        :param append_text: 附加的文本消息，和文件一起粘贴发送，排在文件之后，需要配合 defer_check 由调用方检查
         :return: 发送的消息控件
         """
         valid_paths = []
@@ -680,15 +1046,14 @@ class WechatApp(object):
             logger.error('发送文件全部无效: {}'.format(filepaths))
             raise MessageSendException('发送文件为空: {}'.format(filepaths))
         logger.info('send file message: {}'.format(filepaths))
-        win32_clipboard_files(valid_paths)
-        self._send_clipboard_messages()
+        self._send_clipboard_messages(text=append_text, paths=valid_paths)
+        if defer_check:
+            return []
 
-        # 获取最后5条消息，比较是否已经发送
+        # 获取最后几条消息，比较是否已经发送
         send_message_controls = []
         filenames = [os.path.basename(x) for x in filepaths]
-        check_message_controls = self._get_message_item_controls()[-CHECK_SEND_SUCCESS_SIZE:]
-        check_message_controls.reverse()
-        for message_control in check_message_controls:
+        for message_control in self._get_last_message_item_controls():
             message_info = MessageInfo(message_control)
             if message_info.filepath in filenames:
                 filenames.remove(message_info.filepath)  # 避免转发时重复
@@ -698,6 +1063,48 @@ class WechatApp(object):
             raise MessageSendException('消息发送失败，请重试')
         return send_message_controls
 
+    # 发送后读取消息列表尾部的内容和文件名，用于延后检查是否发送成功
+    def _capture_send_verification(self, to_conversation: str, text='', filepaths=None) -> SendVerification:
+        send_verification = SendVerification(to_conversation, text, filepaths)
+        self._read_send_verification_tail(send_verification)
+        return send_verification
+
+    def _read_send_verification_tail(self, send_verification: SendVerification):
+        count = max(len(send_verification.filenames) + (1 if send_verification.text else 0), CHECK_SEND_SUCCESS_SIZE)
+        send_verification.tail_items = []
+        for message_control in self._get_last_message_item_controls(count):
+            # 每条消息一次获取整个子树，文件消息从快照中读取文件名，避免逐层跨进程查找
+            message_snapshot = ControlTreeSnapshot.capture(message_control)
+            filename_node = message_snapshot.select('pane>pane:1>pane-6>text') \
+                if message_snapshot.root.name == '[文件]' else None
+            send_verification.tail_items.append((message_snapshot.root.name, filename_node.name if filename_node else ''))
+
+    # 检查延后的发送结果，检查失败时切换回该会话重新读取一次消息列表尾部，发送时消息可能还没显示
+    def _resolve_send_verifications(self, pending_results: list) -> List[SendResult]:
+        send_results = []
+        for pending_result in pending_results:
+            if isinstance(pending_result, SendResult):
+                send_results.append(pending_result)
+                continue
+            to_conversation = pending_result.to_conversation
+            is_success = pending_result.verify()
+            if not is_success:
+                try:
+                    self._search_switch_conversation(to_conversation)
+                    pending_result.is_rechecked = True
+                    self._read_send_verification_tail(pending_result)
+                    is_success = pending_result.verify()
+                except ControlInvalidException as exception:
+                    logger.warning('recheck send verification exception. conversation: {}, exception: {}'
+                                   .format(to_conversation, exception.message))
+            if is_success:
+                send_results.append(SendResult.success(to_conversation))
+            else:
+                logger.warning('send verification fail. conversation: {}, tail: {}'
+                               .format(to_conversation, pending_result.tail_items))
+                send_results.append(SendResult.fail(to_conversation, pending_result.FAIL_MESSAGE))
+        return send_results
+
     def _batch_forward_message(self, from_conversation: str,
                                to_conversations: list,
                                forward_message_controls: list) -> List[str]:
@@ -711,6 +1118,8 @@ class WechatApp(object):
         # 切换到需要转发消息的会话，并定位消息，选择转发
         logger.info('批量转发消息，消息来源： {}, 转发到： {}, 转发消息数量： {}'
                     .format(from_conversation, to_conversations, len(forward_message_controls)))
+        begin_time = time.time()
+        # 已经在来源会话时不会重新搜索切换
         self._search_switch_conversation(from_conversation)
         logger.info('搜索并切换到会话: {}'.format(from_conversation))
         if not forward_message_controls:
@@ -726,18 +1135,23 @@ class WechatApp(object):
             self._select_multi_forward_message(forward_message_controls)
 
         # 查找转发的联系人选择窗口
-        select_contact_window = find_top_window_controls(class_name='SelectContactWnd',
-                                                         with_exception_message='未找到转发的联系人选择窗口',
-                                                         root_control=self.main_window)[0]
-        # 选中需要转发到哪些会话
+        select_contact_window = wait_until(window_appeared(class_name='SelectContactWnd', root_control=self.main_window),
+                                           timeout=3, name='select_contact_window',
+                                           with_exception_message='未找到转发的联系人选择窗口')
+        select_begin_time = time.time()
+        # 选中需要转发到哪些会话，确认搜索不到的会话在选择时记录到 unknown_conversations
         real_forward_conversations = self._select_forward_conversations(select_contact_window, to_conversations)
         if len(real_forward_conversations) == 0:
             raise ControlInvalidException('未搜索到需要发送的群聊: {}'.format(to_conversations))
 
         # 点击发送按钮
+        send_begin_time = time.time()
         logger.info('点击【分别发送】按钮')
         send_button_control: Control = select_contact_window.ButtonControl(RegexName='分别发送')
         control_click(send_button_control, with_exception_message='未定位到发送按钮，消息来源: {}'.format(from_conversation))
+        observe_latency('forward.page_setup', select_begin_time - begin_time)
+        observe_latency('forward.page_select', send_begin_time - select_begin_time)
+        observe_latency('forward.page_send', time.time() - send_begin_time)
         return real_forward_conversations
 
     def _open_link_browser_by_link(self, link: str):
@@ -747,10 +1161,10 @@ class WechatApp(object):
 
         # 点击链接，注意需要点击到消息体部分
         select_control(link_message_controls[0], 'pane>pane:1').Click()
-        time.sleep(1)
 
         # 检查浏览窗口是否打开
-        return find_top_window_controls('微信', 'Chrome_WidgetWin', '未找到微信内置浏览器窗口')[0]
+        return wait_until(window_appeared('微信', 'Chrome_WidgetWin'), timeout=5, name='link_browser_window',
+                          with_exception_message='未找到微信内置浏览器窗口')
 
     def _open_link_browser_by_account(self, link: str):
         # 首先搜索并去到 创金科技研发部
@@ -769,20 +1183,107 @@ class WechatApp(object):
         link_input_control = link_browser_window.EditControl(Name='请输入链接')
         # 复制粘贴链接，进入页面
         control_click(link_input_control, with_exception_message='未找到微信内置浏览器中的链接输入框')
-        win32_clipboard_text(link)
+        win32_paste_text(link_input_control, link)
         # link_browser_window.SendKeys('Enter')
 
         # 确定按钮
         control_click(select_control(link_input_control, 'p>button'))
         return link_browser_window
 
+    # 在保持打开的内置浏览器窗口中打开链接，窗口已经关闭、找不到地址栏或者页面没有加载到该链接时返回None
+    def _navigate_link_browser(self, link: str):
+        link_browser_window = self.link_browser_window
+        if not link_browser_window or not read_runtime_id(link_browser_window):
+            self.link_browser_window = None
+            return None
+        begin_time = time.time()
+        # 按名称定位地址栏，页面中的输入框也是EditControl，不能取第一个，只抓取工具栏所在的层级
+        address_node = ControlTreeSnapshot.capture(link_browser_window, LINK_BROWSER_SEARCH_DEPTH).find_first(
+            lambda x: x.control_type_name == 'EditControl' and x.name in LINK_BROWSER_ADDRESS_NAMES)
+        address_control = address_node.control if address_node else None
+        # 快照中的地址栏可能已经销毁，RuntimeId一致才复用
+        if not address_control or read_runtime_id(address_control) != address_node.runtime_id:
+            logger.info('内置浏览器中未找到地址栏，重新打开链接')
+            observe_latency('link_browser.reuse', time.time() - begin_time, False)
+            return None
+        control_click(address_control)
+        win32_paste_text(address_control, link, clear=True)
+        address_control.SendKeys('{Enter}')
+        # 地址栏是该链接并且页面文档已经是该链接才转发，避免转发上一个页面
+        is_loaded = wait_until(lambda: normalize_link_address(address_control.GetValuePattern().Value) == normalize_link_address(link),
+                               timeout=5, interval=0.3, name='link_browser_address') \
+            and wait_until(lambda: self._find_link_browser_document(link_browser_window, link),
+                           timeout=5, interval=0.3, name='link_browser_navigate')
+        observe_latency('link_browser.reuse', time.time() - begin_time, bool(is_loaded))
+        if not is_loaded:
+            logger.info('内置浏览器未加载到链接，重新打开链接：{}'.format(link))
+            return None
+        return link_browser_window
+
+    # 查找内置浏览器中已经加载该链接、并且有标题的页面文档，文档的Value是页面地址
+    @staticmethod
+    def _find_link_browser_document(link_browser_window: Control, link: str) -> Control | None:
+        document_node = ControlTreeSnapshot.capture(link_browser_window, LINK_BROWSER_SEARCH_DEPTH).find_first(
+            lambda x: x.control_type_name == 'DocumentControl' and x.name)
+        if not document_node:
+            return None
+        document_control = document_node.control
+        return document_control \
+            if normalize_link_address(document_control.GetValuePattern().Value) == normalize_link_address(link) else None
+
+    # 关闭内置浏览器窗口
+    def _close_link_browser(self):
+        link_browser_window = self.link_browser_window
+        self.link_browser_window = None
+        if link_browser_window and read_runtime_id(link_browser_window):
+            link_browser_window.SendKeys('{Alt}{F4}')
+
+    # 获取打开链接的内置浏览器窗口，同一批次中优先复用已经打开的窗口，复用失败时关闭该窗口并通过文件传输助手打开
+    def _get_link_browser(self, link: str):
+        try:
+            link_browser_window = self._navigate_link_browser(link)
+        except Exception:
+            logger.warning('复用内置浏览器窗口失败，重新打开链接', exc_info=True)
+            link_browser_window = None
+        if not link_browser_window:
+            # 关闭复用失败的窗口，避免重新打开时找到的是旧窗口
+            self._close_link_browser()
+            begin_time = time.time()
+            link_browser_window = self._open_link_browser_by_link(link)
+            observe_latency('link_browser.open', time.time() - begin_time)
+            self.link_browser_window = link_browser_window
+        return link_browser_window
+
+    # 中转会话中有该链接已经生成的卡片时，直接转发到目标会话
+    def _forward_cached_link_card(self, link: str, to_conversation: str) -> Control | None:
+        if not self.forward_sources.get(link_source_key(link)):
+            return None
+        self._search_switch_conversation(TEMP_CONVERSATION)
+        card_controls = self._find_forward_sources([link_source_key(link)])
+        if not card_controls:
+            return None
+        card_control = card_controls[0]
+        if to_conversation == TEMP_CONVERSATION:
+            return card_control
+        if to_conversation not in self._batch_forward_message(TEMP_CONVERSATION, [to_conversation], [card_control]):
+            return None
+        self._search_switch_conversation(to_conversation)
+        check_message_controls = self._get_last_message_item_controls(1)
+        if not check_message_controls or check_message_controls[0].Name != '[链接]':
+            return None
+        return check_message_controls[0]
+
     def send_link_card_message(self, link: str, to_conversation: str) -> Control:
         logger.info('发送连接卡片. link: {}, to_conversation: {}'.format(link, to_conversation))
-        link_browser_window = self._open_link_browser_by_link(link)
-        time.sleep(2)
-
-        # 点击转发按钮
-        more_menu_control = link_browser_window.MenuItemControl(Name='更多')
+        card_control = self._forward_cached_link_card(link, to_conversation)
+        if card_control:
+            logger.info('转发已经生成的链接卡片. link: {}'.format(link))
+            return card_control
+        link_browser_window = self._get_link_browser(link)
+
+        # 点击转发按钮，等待页面加载出【更多】菜单
+        more_menu_control = wait_until(control_in_tree(link_browser_window, 'MenuItemControl', '更多', LINK_BROWSER_SEARCH_DEPTH),
+                                       timeout=5, name='link_browser_more_menu')
         control_click(more_menu_control, with_exception_message='未找到微信内置浏览器中的【更多】菜单按钮')
 
         # 点击转发按钮
@@ -799,43 +1300,109 @@ class WechatApp(object):
         send_button_control = select_contact_window.ButtonControl(RegexName='分别发送')
         control_click(send_button_control, with_exception_message='未找到【分别发送】按钮')
 
-        # 关闭窗口
-        link_browser_window.SendKeys('{Ctrl}w')
+        # 不关闭窗口，下一个链接直接在该窗口中打开，切回微信主窗口继续操作
+        self.active(force=True)
         self._search_switch_conversation(to_conversation)
 
-        check_message_control = self._get_message_item_controls()[-1]
-        if check_message_control.Name != '[链接]':
+        check_message_controls = self._get_last_message_item_controls(1)
+        check_message_control = check_message_controls[0] if check_message_controls else None
+        if not check_message_control or check_message_control.Name != '[链接]':
             raise MessageSendException('转发链接失败： {}'.format(link))
+        if to_conversation == TEMP_CONVERSATION:
+            # 中转会话中的卡片可以被后续相同链接直接转发
+            card_text = link_card_text(check_message_control)
+            if card_text:
+                self.forward_sources.put(link_source_key(link), 'link', card_text)
         return check_message_control
 
+    # 等待文件上传完成，并更新上传速度估计
+    def _wait_file_upload(self, upload_message_controls: List[Control], upload_filepaths: list, begin_time: float):
+        total_file_size = sum(os.path.getsize(x) for x in upload_filepaths)
+        timeout = self.upload_estimator.timeout_seconds(total_file_size)
+        logger.info('批量转发文件，文件数：{}，总大小：{}，等待上传完成超时秒：{:.1f}'
+                    .format(len(upload_filepaths), total_file_size, timeout))
+        # 没有看到上传中状态时，至少等待按上传速度估计的时长
+        min_seconds = self.upload_estimator.estimate_seconds(total_file_size) - (time.time() - begin_time)
+        is_completed = wait_until(file_upload_completed(upload_message_controls, min_seconds), timeout=timeout,
+                                  interval=0.2, max_interval=1, name='file_upload')
+        upload_seconds = time.time() - begin_time
+        self.upload_estimator.observe(total_file_size, upload_seconds, bool(is_completed))
+        if not is_completed:
+            logger.warning('等待文件上传完成超时，继续转发。耗时：{:.1f}'.format(upload_seconds))
+
+    def _find_forward_sources(self, source_keys: list) -> List[Control] | None:
+        """
+        在中转会话最近的消息中查找可以复用的转发源消息
+        只复用消息列表中当前可见的消息，否则右键和多选会点击到旧位置上的其他消息
+        所有key都找到并且消息顺序和source_keys一致时才复用，转发时按消息在会话中的顺序发送
+        :return: 按source_keys顺序的消息控件，不能全部复用时返回None
+        """
+        forward_sources = [self.forward_sources.get(x) for x in source_keys]
+        if not source_keys or not all(forward_sources):
+            return None
+        list_rect = self._search_control(ControlTag.MESSAGE_LIST).BoundingRectangle
+        find_controls = [None] * len(source_keys)
+        find_index = len(source_keys) - 1   # 从最新的消息向前查找，最后一个key对应最新的消息
+        for message_control in self._get_last_message_item_controls(FORWARD_SOURCE_TAIL_SIZE):
+            if find_index < 0:
+                break
+            forward_source = forward_sources[find_index]
+            message_info = MessageInfo(message_control)
+            if forward_source.message_type == 'link':
+                match_value = link_card_text(message_control) if message_info.content == '[链接]' else None
+            elif forward_source.message_type == 'file':
+                match_value = message_info.filepath
+            else:
+                match_value = message_info.content.rstrip('\n')
+            if match_value != forward_source.match_value.rstrip('\n'):
+                continue
+            message_rect = message_control.BoundingRectangle
+            if message_rect.top < list_rect.top or message_rect.bottom > list_rect.bottom:
+                logger.info('转发源消息不在可见区域，重新发送: {}'.format(source_keys[find_index]))
+                return None
+            find_controls[find_index] = message_control
+            find_index -= 1
+        if find_index >= 0:
+            self.forward_sources.invalidate(source_keys[find_index])
+            return None
+        for source_key in source_keys:
+            self.forward_sources.hit(source_key)
+        return find_controls
+
     # 点击单条消息转发按钮
     def _click_one_forward_message(self, forward_message_control):
         # 右键转发消息，注意需要点击到消息体部分
         select_control(forward_message_control, 'pane>pane:1').RightClick()
         logger.info('右键要转发的消息，呼出转发菜单.')
-        time.sleep(1)
 
-        # 查找转发按钮
+        # 查找转发按钮，菜单弹出后立即继续
         # 如果是文件，需要上传完后才能进行转发，需要等一会儿
         logger.info('点击【转发...】按钮进行转发')
-        forward_button_control = self.main_window.MenuItemControl(Name='转发...')
-        if not check_control_exist(forward_button_control):
+        forward_button_control = self._wait_menu_item('转发...', name='forward_menu')
+        if not forward_button_control:
             error_message = '未找到消息【转发】按钮，可能消息不能转发，请稍后重试'
             logger.error(error_message)
             # 可能窗口卡住，需要关闭一下提示框
             self.close_alter_window()
             raise ControlInvalidException(error_message)
 
+    # 等待右键菜单中出现菜单项，只在主窗口下一层的菜单窗口中查找，不抓取整个主窗口
+    def _wait_menu_item(self, item_name: str, name: str, timeout: float = 2) -> Control | None:
+        def predicate():
+            menu_node = self._capture_snapshot(self.main_window, max_depth=1).index.lookup('MenuControl', class_name='CMenuWnd')
+            return control_in_tree(menu_node.control, 'MenuItemControl', item_name, MENU_ITEM_SEARCH_DEPTH)() \
+                if menu_node else None
+        return wait_until(predicate, timeout=timeout, name=name)
+
     # 选中需要转发的消息列表
     def _select_multi_forward_message(self, forward_message_controls):
         # 右键任意一条消息，点击多选按钮
         select_control(forward_message_controls[0], 'pane>pane:1').RightClick()
         logger.info('右键其中一条需要转发的消息')
-        time.sleep(1)
 
         # 点击多选按钮
         logger.info('点击【多选】菜单按钮')
-        multi_button_control = self.main_window.MenuItemControl(Name='多选')
+        multi_button_control = self._wait_menu_item('多选', name='multi_select_menu')
         control_click(multi_button_control, with_exception_message='未找到消息【多选】按钮，请稍后重试')
 
         # 逐条消息点击选中
@@ -866,34 +1433,44 @@ class WechatApp(object):
         # self.main_window.SendKeys('{Ctrl}f', waitTime=1)
         real_forward_conversations = []   # 记录实际转发成功的会话列表
         search_anchor_control = multi_select_button_control
+        search_list_control = None   # 搜索结果列表在窗口关闭前不会变化，只定位一次
         for to_conversation in forward_conversations:
             self._send_search_shortcut(search_anchor_control)
-            win32_clipboard_text(to_conversation)
-            search_anchor_control.SendKeys('{Ctrl}a')  # 避免还有旧的搜索
-            search_anchor_control.SendKeys('{Ctrl}v')
+            win32_paste_text(search_anchor_control, to_conversation, clear=True)  # 全选替换，避免还有旧的搜索
             logger.info('选择搜索结果中的会话: {}'.format(to_conversation))
 
-            search_list_control = select_contact_window.ListControl(Name='请勾选需要添加的联系人')
-            if not check_control_exist(search_list_control):
-                logger.warning('未搜索到任何会话： {}'.format(to_conversation))
-                continue
-            logger.info('搜索会话数量: {}'.format(len(search_list_control.GetChildren())))
-            for search_item_control in search_list_control.GetChildren():
-                # 过滤“群聊”或者“联系人”
-                if not search_item_control.Name or search_item_control.Name != to_conversation:
+            if not search_list_control or not read_runtime_id(search_list_control):
+                search_list_control = select_contact_window.ListControl(Name='请勾选需要添加的联系人')
+                if not check_control_exist(search_list_control):
+                    logger.warning('未搜索到任何会话： {}'.format(to_conversation))
+                    search_list_control = None
                     continue
+            # 搜索结果列表可能还是上一次搜索的结果，等待出现匹配项
+            search_item_nodes = []   # 最后一次读取的搜索结果节点
 
-                # 选中群聊
-                logger.info('选中会话： {}'.format(search_item_control.Name))
-                control_click(search_item_control)
-                real_forward_conversations.append(to_conversation)
+            def find_search_item_node():
+                snapshot = self._capture_snapshot(search_list_control, max_depth=1)
+                search_item_nodes[:] = snapshot.root.children if snapshot else []
+                # 过滤“群聊”或者“联系人”
+                return next((x for x in search_item_nodes if x.Name == to_conversation), None)
+            search_item_node = wait_until(find_search_item_node, timeout=1, name='forward_search_item')
+            if not search_item_node:
+                if search_item_nodes:
+                    # 等待后搜索结果已经显示但没有匹配项，确认搜索不到，结果为空时可能还没显示，不记录
+                    self._add_unknown_conversation(to_conversation, '未搜索到该群聊: ' + to_conversation)
+                continue
+
+            # 选中群聊
+            logger.info('选中会话： {}'.format(search_item_node.Name))
+            control_click(search_item_node.control)
+            real_forward_conversations.append(to_conversation)
         # 留言处理，如果包含换行，则只能取第一行的内容
         if append_text:
             if '\n' in append_text:
                 raise MessageSendException('转发留言不能包含换行: {}'.format(append_text))
             append_text_control = select_contact_window.EditControl(Name='给朋友留言')
             control_click(append_text_control)
-            win32_clipboard_text(append_text)
+            win32_paste_text(append_text_control, append_text)
         return real_forward_conversations
 
     def batch_send_message(self, to_conversations: list, text='', filepaths=None,
@@ -908,11 +1485,23 @@ class WechatApp(object):
         :param check_pre_message: 检查前置消息
         :return:
         """
+        try:
+            return self._batch_send_message(to_conversations, text, filepaths, share_link)
+        finally:
+            if share_link:
+                # 批次结束后关闭内置浏览器，生成的卡片已经记录在转发源中，之后通过转发复用
+                self._close_link_browser()
+
+    def _batch_send_message(self, to_conversations: list, text: str, filepaths: list,
+                            share_link: str) -> List[SendResult]:
         filepaths = filepaths if filepaths else []
         logger.info('批量发送消息。发送到: {}，文本: {}，文件: {}，链接：{}'.format(to_conversations, text, filepaths, share_link))
         if not text and not filepaths and not share_link:
             raise MessageSendException('发送内容为空，请检查参数')
-        send_results = []
+        send_results, to_conversations = self._filter_unknown_conversations(to_conversations)
+        if not to_conversations:
+            raise MessageSendException('全部消息发送失败：{}...'
+                                       .format('、'.join([x.error_message for x in send_results[:2]])))
         self.active(force=True)
         if len(to_conversations) >= BATCH_SEND_WITH_FORWARD_COUNT:
             # 超过 use_batch_send_min_count 个群使用批量转发
@@ -922,22 +1511,27 @@ class WechatApp(object):
             # 先发连接消息，因为会多发一条连接文本
             if share_link:
                 send_message_controls.append(self.send_link_card_message(share_link, TEMP_CONVERSATION))
-            # 先发文件再发文本消息
-            if filepaths:
-                # 发送文件
-                send_message_controls.extend(self.send_file_message(filepaths))
-                # 发送文件比较慢，需要等一下全部上传以后才能转发
-                total_file_size = 0
-                for filepath in filepaths:
-                    total_file_size += os.path.getsize(filepath)
-                # 基础3秒，500K多1秒
-                wait_file_upload_seconds = 3 + total_file_size // 1024 // 500
-                logger.info('批量转发文件，文件数：{}，总大小：{}，等待秒：{}'
-                            .format(len(filepaths), total_file_size, wait_file_upload_seconds))
-                time.sleep(wait_file_upload_seconds)
-            if text:
-                # 发送文本消息
-                send_message_controls.extend(self.send_text_message(text))
+            # 先发文件再发文本消息，最近发送过的文件和文本全部可以复用时直接复用，否则全部重新发送，保持先文件后文本的顺序
+            # 有链接卡片时新卡片在最后，复用的消息会排在卡片前面，所以不复用
+            source_keys = [file_source_key(x) for x in filepaths] + ([text_source_key(text)] if text else [])
+            reuse_controls = None if share_link else self._find_forward_sources(source_keys)
+            if reuse_controls:
+                logger.info('复用中转会话中的消息进行转发: {}'.format(source_keys))
+                send_message_controls.extend(reuse_controls)
+            else:
+                if filepaths:
+                    # 发送文件
+                    upload_begin_time = time.time()
+                    upload_message_controls = self.send_file_message(filepaths)
+                    send_message_controls.extend(upload_message_controls)
+                    for filepath in filepaths:
+                        self.forward_sources.put(file_source_key(filepath), 'file', os.path.basename(filepath))
+                    # 发送文件比较慢，需要等全部上传以后才能转发，超时时间根据估计的上传速度计算
+                    self._wait_file_upload(upload_message_controls, filepaths, upload_begin_time)
+                if text:
+                    # 发送文本消息
+                    send_message_controls.extend(self.send_text_message(text))
+                    self.forward_sources.put(text_source_key(text), 'text', text)
 
             # ----> 微信批量转发一次只能转发9个群，所以要分批处理，转发成功后，会停留在 TEMP_CONVERSATION 会话
             page_size = FORWARD_MAX_CONVERSATION_COUNT
@@ -962,29 +1556,27 @@ class WechatApp(object):
                     for to_conversation in page_to_conversations:
                         send_results.append(SendResult.fail(to_conversation, f'{exception.message}:{to_conversation}'))
         else:
-            # 逐个发送，如果有一个发送失败，则全失败
+            # 逐个发送，发送后只读取消息列表尾部，不等待逐条匹配，所有会话发送完成后再统一检查
+            pending_results = []   # SendResult 或者 SendVerification，保持会话顺序
             for to_conversation in to_conversations:
                 try:
                     self._search_switch_conversation(to_conversation)
-                    send_message_controls = []
                     if share_link:
-                        send_message_controls.append(self.send_link_card_message(share_link, to_conversation))
+                        # 链接卡片通过转发发送，转发时已经严格检查
+                        self.send_link_card_message(share_link, to_conversation)
                     if filepaths:
-                        send_message_controls.extend(self.send_file_message(filepaths))
-                    if text:
-                        send_message_controls.extend(self.send_text_message(text))
-
-                    # 严格判断是否发送成功
-                    if send_message_controls:
-                        send_results.append(SendResult.success(to_conversation))
-                    else:
-                        send_results.append(SendResult.fail(to_conversation, '未发送成功需重试'))
+                        # 文件和附加文本一次粘贴发送
+                        self.send_file_message(filepaths, defer_check=True, append_text=text)
+                    elif text:
+                        self.send_text_message(text, defer_check=True)
+                    pending_results.append(self._capture_send_verification(to_conversation, text, filepaths))
                 except ControlInvalidException as exception:
                     logger.warning('conversation send exception. conversation: {}'.format(to_conversation), stack_info=True)
-                    send_results.append(SendResult.fail(to_conversation, exception.message))
+                    pending_results.append(SendResult.fail(to_conversation, exception.message))
+            send_results.extend(self._resolve_send_verifications(pending_results))
 
         send_fail_results = [x for x in send_results if not x.is_success]
-        if send_fail_results and len(send_fail_results) == len(to_conversations):
+        if send_fail_results and len(send_fail_results) == len(send_results):
             # 全部发送失败，则直接抛出异常结束
             raise MessageSendException('全部消息发送失败：{}...'
                                        .format('、'.join([x.error_message for x in send_fail_results[:2]])))
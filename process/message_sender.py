@@ -3,7 +3,10 @@
 """
 import json
 import os
+import queue
 import time
+import uuid
+from collections import OrderedDict
 from typing import List
 
 import cptools
@@ -44,6 +47,9 @@ CONFIG = {
     # 是否启用在会话窗口中搜索，会更快一些单可能会有问题
     "qq_is_search_in_conversation_window": False,
 
+    # QQ批量转发的中转会话，为空时QQ批量发送逐个发送
+    "qq_forward_relay_conversation": "",
+
     # 微信安装目录
     "wechat_path": r"D:\Program Files (x86)\Tencent\WeChat\WeChat.exe",
 
@@ -60,7 +66,10 @@ CONFIG = {
     "wecom_agent_id": "3010041",
 
     # 推送应用名称
-    "wecom_corp_name": "RPA助手"
+    "wecom_corp_name": "RPA助手",
+
+    # 相同发送主体、相同内容的发送请求合并等待秒数，只有相同内容正在发送时才等待，合并后只需要发送一次到文件助手再转发，0表示不合并
+    "broadcast_coalesce_seconds": 0.5
 }
 load_config(CONFIG)
 
@@ -95,6 +104,265 @@ class Message(object):
         return json.dumps(self.__dict__, ensure_ascii=False)
 
 
+class BroadcastGroup(object):
+    """
+    合并中的发送请求，第一个请求负责发送，其他请求等待发送完成后按各自的会话取结果
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.messages: List[Message] = []
+        self.done = threading.Event()
+        self.results: List[dict] = []
+        self.exception: Exception | None = None
+        self.is_closed = False   # 已经开始发送
+
+    def merge_message(self) -> Message:
+        # 合并所有请求的会话，保持顺序并去重
+        merged_message = Message({})
+        merged_message.__dict__.update(self.messages[0].__dict__)
+        merged_message.to_conversations = list(dict.fromkeys(
+            conversation for message in self.messages for conversation in message.to_conversations))
+        return merged_message
+
+    def fan_out(self, message: Message) -> List[dict]:
+        if self.exception:
+            raise self.exception
+        results = [x for x in self.results if x['toConversation'] in message.to_conversations]
+        if len(self.messages) > 1 and not [x for x in results if x['isSuccess']]:
+            # 和单独发送保持一致，全部发送失败时抛出异常
+            raise MessageSendException('全部消息发送失败：{}...'
+                                       .format('、'.join([x['errorMessage'] for x in results[:2]])))
+        return results
+
+
+class BroadcastCoalescer(object):
+    """
+    合并相同发送主体、相同内容的发送请求，合并窗口从第一个请求到开始发送为止，包括等待屏幕锁的时间
+    第一个请求只有在相同key的请求正在发送时才额外等待 window_seconds，单个请求不会增加延迟
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self.groups = {}   # key -> BroadcastGroup，还没开始发送的请求
+        self.sending_counts = {}   # key -> 正在发送的组数量
+        self.lock = threading.Lock()
+        self.send_count = 0   # 实际发送次数
+        self.request_count = 0   # 请求次数
+        self.wait_count = 0   # 第一个请求等待合并的次数
+
+    def submit(self, key, message: Message, execute) -> List[dict]:
+        """
+        提交发送请求
+        :param key: 合并key，相同key的请求合并发送
+        :param message: 发送消息
+        :param execute: 实际发送方法，参数为获取合并消息的方法，需要在获取屏幕锁以后再调用获取合并消息
+        :return: 当前请求会话的发送结果
+        """
+        with self.lock:
+            self.request_count += 1
+            group = self.groups.get(key)
+            is_leader = group is None
+            if is_leader:
+                group = self.groups[key] = BroadcastGroup(key)
+                # 相同内容正在发送，说明是连续的广播请求，等待后续请求合并
+                is_wait = key in self.sending_counts
+                self.wait_count += is_wait
+            group.messages.append(message)
+        if not is_leader:
+            logger.info('合并发送请求，等待发送完成。messageId: {}'.format(message.message_id))
+            group.done.wait()
+            return group.fan_out(message)
+
+        if is_wait:
+            time.sleep(self.window_seconds)
+        try:
+            group.results = execute(lambda: self._close(group))
+        except Exception as exception:
+            group.exception = exception
+        finally:
+            with self.lock:
+                if self.groups.get(key) is group:
+                    self.groups.pop(key)
+                if group.is_closed:
+                    self.sending_counts[key] -= 1
+                    if not self.sending_counts[key]:
+                        self.sending_counts.pop(key)
+            group.done.set()
+        return group.fan_out(message)
+
+    def _close(self, group: BroadcastGroup) -> Message:
+        # 开始发送，之后的请求不再合并到该组
+        with self.lock:
+            if self.groups.get(group.key) is group:
+                self.groups.pop(group.key)
+            group.is_closed = True
+            self.sending_counts[group.key] = self.sending_counts.get(group.key, 0) + 1
+            self.send_count += 1
+        merged_message = group.merge_message()
+        if len(group.messages) > 1:
+            logger.info('合并发送请求数量: {}, 会话数量: {}'.format(len(group.messages), len(merged_message.to_conversations)))
+        return merged_message
+
+    def to_dict(self) -> dict:
+        return {
+            'windowSeconds': self.window_seconds,
+            'requestCount': self.request_count,
+            'sendCount': self.send_count,
+            'waitCount': self.wait_count,
+            'pendingCount': len(self.groups),
+        }
+
+
+class SendJob(object):
+    """
+    异步发送任务，接口入队后立即返回任务id，通过任务id查询结果或者完成后回调
+    """
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    SUCCESS = 'SUCCESS'
+    FAIL = 'FAIL'
+
+    def __init__(self, message: Message, callback_url=''):
+        self.job_id = uuid.uuid4().hex
+        self.message = message
+        self.callback_url = callback_url
+        self.status = SendJob.PENDING
+        self.results: List[dict] | None = None
+        self.exception: Exception | None = None
+        self.error_message = ''
+        self.create_time = time.time()
+        self.start_time = 0
+        self.finish_time = 0
+
+    def is_finished(self):
+        return self.status in [SendJob.SUCCESS, SendJob.FAIL]
+
+    def to_dict(self) -> dict:
+        return {
+            'jobId': self.job_id,
+            'messageId': self.message.message_id,
+            'status': self.status,
+            'results': self.results,
+            'errorMessage': self.error_message,
+            'queueSeconds': round((self.start_time or time.time()) - self.create_time, 3),
+            'sendSeconds': round((self.finish_time or time.time()) - self.start_time, 3) if self.start_time else 0,
+        }
+
+
+class SendJobQueue(object):
+    """
+    异步发送任务队列，每个发送器一个队列和一个工作线程，界面操作的耗时和HTTP请求的并发数量无关
+    工作线程每次取出队列中所有等待的任务，按合并key分组，组之间按入队顺序依次执行，只有同一组的任务同时提交给合并器合并发送
+    """
+
+    def __init__(self, sender_manager: 'MessageSenderManager', on_finish=None, retain_count=1000):
+        self.sender_manager = sender_manager
+        self.on_finish = on_finish   # 任务完成后的回调，参数为任务
+        self.retain_count = retain_count
+        self.queues = {}   # (channel, from_subject) -> queue.Queue
+        self.jobs = OrderedDict()   # job_id -> SendJob
+        self.lock = threading.Lock()
+        self.submit_count = 0
+        self.finish_count = 0
+
+    def submit(self, message: Message, callback_url='') -> SendJob:
+        """
+        检查参数并入队，参数不合法或者没有匹配的发送器时直接抛出异常，不会入队
+        """
+        message_sender = self.sender_manager.get_message_sender(message)
+        message_sender.check_valid(message)
+        job = SendJob(message, callback_url)
+        queue_key = (message_sender.get_channel(), message_sender.get_from_subject())
+        with self.lock:
+            self.submit_count += 1
+            self.jobs[job.job_id] = job
+            self._evict_jobs()
+            job_queue = self.queues.get(queue_key)
+            if job_queue is None:
+                job_queue = self.queues[queue_key] = queue.Queue()
+                threading.Thread(target=self._worker_loop, args=(job_queue,), name='send-job-{}'.format(queue_key[1]),
+                                 daemon=True).start()
+        job_queue.put(job)
+        logger.info('submit send job: {}, messageId: {}'.format(job.job_id, message.message_id))
+        return job
+
+    def get(self, job_id: str) -> SendJob | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _evict_jobs(self):
+        # 只淘汰已经完成的任务，未完成的任务一直保留
+        finished_job_ids = [job_id for job_id, job in self.jobs.items() if job.is_finished()]
+        for job_id in finished_job_ids[:max(len(finished_job_ids) - self.retain_count, 0)]:
+            self.jobs.pop(job_id)
+
+    def _worker_loop(self, job_queue: queue.Queue):
+        while True:
+            jobs = [job_queue.get()]
+            while not job_queue.empty():
+                jobs.append(job_queue.get_nowait())
+            # 屏幕锁不保证先到先得，不同组依次执行，保持入队顺序
+            for group_jobs in self._group_jobs(jobs):
+                if len(group_jobs) == 1:
+                    self._run_job(group_jobs[0])
+                    continue
+                threads = [threading.Thread(target=self._run_job, args=(job,), daemon=True) for job in group_jobs]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+    def _group_jobs(self, jobs: List[SendJob]) -> List[List[SendJob]]:
+        # 合并key相同的任务分为一组，组按第一个任务的入队顺序排列，不能合并的任务单独一组
+        groups = OrderedDict()
+        for job in jobs:
+            groups.setdefault(self._get_coalesce_key(job) or job.job_id, []).append(job)
+        return list(groups.values())
+
+    def _get_coalesce_key(self, job: SendJob):
+        if self.sender_manager.broadcast_coalescer.window_seconds <= 0:
+            return None
+        try:
+            message_sender = self.sender_manager.get_message_sender(job.message)
+        except MessageSendException:
+            # 发送器已经重新初始化，执行任务时再抛出异常
+            return None
+        coalesce_key = message_sender.get_coalesce_key(job.message)
+        return (id(message_sender), coalesce_key) if coalesce_key else None
+
+    def _run_job(self, job: SendJob):
+        job.status = SendJob.RUNNING
+        job.start_time = time.time()
+        try:
+            job.results = self.sender_manager.send_message_with_exception(job.message)
+            job.status = SendJob.SUCCESS
+        except Exception as exception:
+            logger.error('send job exception: {}'.format(job.job_id), exc_info=True)
+            job.exception = exception
+            job.error_message = getattr(exception, 'message', '') or '服务未知异常：{}'.format(exception)
+            job.status = SendJob.FAIL
+        job.finish_time = time.time()
+        with self.lock:
+            self.finish_count += 1
+            self._evict_jobs()
+        logger.info('send job finished: {}'.format(job.to_dict()))
+        if self.on_finish:
+            try:
+                self.on_finish(job)
+            except Exception:
+                logger.error('send job finish callback exception: {}'.format(job.job_id), exc_info=True)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'submitCount': self.submit_count,
+                'finishCount': self.finish_count,
+                'pendingCount': sum(x.qsize() for x in self.queues.values()),
+                'queues': {'{}:{}'.format(*key): x.qsize() for key, x in self.queues.items()},
+            }
+
+
 # 抽象消息发送类
 class MessageSender(object):
 
@@ -120,6 +388,10 @@ class MessageSender(object):
         """是否独占屏幕"""
         return True
 
+    def get_coalesce_key(self, message: Message):
+        """相同key的发送请求可以合并发送，返回None不合并"""
+        return None
+
     def send(self, message: Message):
         """处理发送"""
         pass
@@ -155,6 +427,10 @@ class WechatTextMessageSender(MessageSender):
                                                           message.message_data.get('content'), [])
         return [x.to_dict() for x in send_results]
 
+    def get_coalesce_key(self, message: Message):
+        # 相同的消息类型和内容，只需要发送一次到文件助手再转发
+        return message.message_type, json.dumps(message.message_data, ensure_ascii=False, sort_keys=True)
+
     def exec_command(self, command: str):
         if command == 'active':
             self.wechat_app.active(force=True)
@@ -346,6 +622,7 @@ class MessageSenderManager(object):
         self.qq_apps: List[QQApp] = []
         self.wecom_corp_app = None
         self.message_senders: List[MessageSender] = []
+        self.broadcast_coalescer = BroadcastCoalescer(CONFIG.get('broadcast_coalesce_seconds', 0))
         self.ready_message_senders()
 
     def ready_message_senders(self):
@@ -385,7 +662,8 @@ class MessageSenderManager(object):
         if qq_app_count:
             logger.info('配置启动QQ客户端数量: {}'.format(qq_app_count))
             self.qq_apps = QQApp.build_all_qq_apps(CONFIG['qq_is_retain_conversation_window'],
-                                                   CONFIG['qq_is_search_in_conversation_window'])
+                                                   CONFIG['qq_is_search_in_conversation_window'],
+                                                   CONFIG.get('qq_forward_relay_conversation', ''))
             if not self.qq_apps:
                 logger.info('启动QQ客户端，数量: {}'.format(qq_app_count))
                 open_multi_app(CONFIG.get('qq_path'), qq_app_count)
@@ -405,15 +683,23 @@ class MessageSenderManager(object):
     def send_message_with_exception(self, message: Message):
         message_sender = self.get_message_sender(message)
         message_sender.check_valid(message)
+        coalesce_key = message_sender.get_coalesce_key(message)
+        if coalesce_key and self.broadcast_coalescer.window_seconds > 0:
+            return self.broadcast_coalescer.submit((id(message_sender), coalesce_key), message,
+                                                   lambda build_message: self._send(message_sender, build_message))
+        return self._send(message_sender, lambda: message)
+
+    @staticmethod
+    def _send(message_sender: MessageSender, build_message):
         logger.info('send message with: {}'.format(message_sender.__class__.__name__))
         if message_sender.lock_screen():
             try:
                 SCREEN_LOCK.acquire(timeout=3600)
-                return message_sender.send(message)
+                return message_sender.send(build_message())
             finally:
                 SCREEN_LOCK.release()
         else:
-            return message_sender.send(message)
+            return message_sender.send(build_message())
 
     def senders_to_dict(self):
         senders = []
@@ -10,12 +10,15 @@ import requests
 from flask import request, send_file
 
 from base.config import load_config
+from base.control_snapshot import get_control_index_stats
+from base.metrics import histograms_to_dict
+from base.window_registry import get_window_registry
 from base.exception import ParamInvalidException, ControlInvalidException, MessageSendException
 from base.log import logger, get_last_n_logs
-from base.util import get_save_file_path, get_screenshot, get_localhost_ip
+from base.util import get_save_file_path, get_screenshot, get_localhost_ip, clipboard_service
 from apscheduler.schedulers.gevent import GeventScheduler
 from process.message_sender import MessageSenderManager, Message, WechatTextMessageSender, WecomGroupBotMessageSender, \
-    QQTextMessageSender
+    QQTextMessageSender, SendJob, SendJobQueue
 
 sender_manager = MessageSenderManager()
 
@@ -41,6 +44,9 @@ CONFIG = {
         # "http://10.201.5.46:10169/api/chat-message/worker-heartbeat",  # 生产
         # "http://10.202.5.45:10169/api/chat-message/worker-heartbeat",  # 生产
     ],
+
+    # 异步发送任务保留的已完成任务数量，超过时淘汰最早完成的任务
+    "send_job_retain_count": 1000,
 }
 load_config(CONFIG)
 error_message_sender = WecomGroupBotMessageSender()
@@ -69,6 +75,22 @@ def error_notification(message):
     return True
 
 
+# 异步发送任务完成，失败时通知，有回调地址时回调发送结果
+def send_job_finished(job: SendJob):
+    if job.status == SendJob.FAIL and not isinstance(job.exception, ParamInvalidException):
+        error_notification(job.error_message)
+    if not job.callback_url:
+        return
+    try:
+        response = requests.post(job.callback_url, json=job.to_dict(), timeout=10)
+        logger.info('send job callback: {}, status code: {}'.format(job.callback_url, response.status_code))
+    except:
+        logger.error('send job callback exception. callback_url: {}'.format(job.callback_url), exc_info=True)
+
+
+send_job_queue = SendJobQueue(sender_manager, send_job_finished, CONFIG.get('send_job_retain_count', 1000))
+
+
 # 检查是否有强制更新对话框，登录状态等
 def state_check():
     for message_sender in sender_manager.message_senders:
@@ -134,6 +156,49 @@ class Api:
             'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
 
+    # 查询性能统计信息
+    @staticmethod
+    @api.route("/api/stats", methods=['GET'])
+    def query_stats():
+        return Response.success({
+            'controlIndex': get_control_index_stats(),
+            'latency': histograms_to_dict(request.values.get('prefix', '')),
+            'windowRegistry': get_window_registry().to_dict(),
+            'clipboard': clipboard_service.to_dict(),
+            'broadcastCoalescer': sender_manager.broadcast_coalescer.to_dict(),
+            'sendJobs': send_job_queue.to_dict(),
+            'apps': [{
+                'loginUserName': app.login_user_name,
+                'controlCache': app.control_cache.to_dict(),
+                'locator': app.locator_profiler.to_dict(),
+                'historyStore': app.history_store.to_dict(),
+                'forwardSources': app.forward_sources.to_dict(),
+                'upload': app.upload_estimator.to_dict(),
+                'unknownConversations': app.unknown_conversations.to_dict(),
+                'conversationIndex': app.conversation_index.to_dict(),
+            } for app in sender_manager.wechat_apps + sender_manager.qq_apps],
+            'qqApps': [{
+                'loginUserName': app.login_user_name,
+                'conversationPool': app.conversation_pool.to_dict(),
+                'identityStore': app.identity_store.to_dict() if app.identity_store else None,
+            } for app in sender_manager.qq_apps],
+        })
+
+    # 清除搜索不到的会话缓存，群改名后调用，不传会话列表时清除全部
+    @staticmethod
+    @api.route("/api/admin/unknown-conversation/invalidate", methods=['POST'])
+    def invalidate_unknown_conversations():
+        data = request.get_json(silent=True) or {}
+        from_subject = data.get('fromSubject', '')
+        conversations = data.get('conversations', [])
+        invalidate_count = 0
+        for app in sender_manager.wechat_apps + sender_manager.qq_apps:
+            if not from_subject or app.login_user_name == from_subject:
+                invalidate_count += app.unknown_conversations.invalidate(conversations)
+        logger.info('清除搜索不到的会话缓存. fromSubject: {}, conversations: {}, count: {}'
+                    .format(from_subject, conversations, invalidate_count))
+        return Response.success({'invalidateCount': invalidate_count})
+
     @staticmethod
     @api.route("/api/tail-log", methods=['GET'])
     def get_latest_log():
@@ -201,6 +266,14 @@ class Api:
         data = request.get_json()
         # json.loads(request.get_data())
         logger.info('receive send message request. params: {}'.format(json.dumps(data, ensure_ascii=False)))
+        if data.get('async'):
+            # 异步发送，检查参数后入队并返回任务id，通过任务查询接口或者回调地址获取发送结果
+            try:
+                job = send_job_queue.submit(Message(data), data.get('callbackUrl', ''))
+            except (ParamInvalidException, MessageSendException) as exception:
+                logger.error('消息发送参数检查异常', stack_info=True)
+                return Response.fail(exception.message)
+            return Response.success({'jobId': job.job_id, 'status': job.status})
         try:
             message = Message(data)
             send_results = sender_manager.send_message_with_exception(message)
@@ -222,6 +295,15 @@ class Api:
         logger.info('send message success. message: {}, send_result: {}'.format(message, send_results))
         return Response.success(send_results)
 
+    # 查询异步发送任务的状态和结果
+    @staticmethod
+    @api.route("/api/bot/chat/job/<job_id>", methods=['GET'])
+    def query_send_job(job_id):
+        job = send_job_queue.get(job_id)
+        if not job:
+            return Response.fail('发送任务不存在或者已经过期：{}'.format(job_id))
+        return Response.success(job.to_dict())
+
     @staticmethod
     @api.route('/api/file/upload', methods=['POST'])
     def upload_file():
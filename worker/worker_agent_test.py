@@ -3,11 +3,19 @@
 """
 import datetime
 import json
+import queue
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import requests
 
 
 CHAT_MESSAGE_SEND_API = 'http://10.191.0.114/api/bot/chat/send'
+CHAT_SEND_JOB_API = 'http://10.191.0.114/api/bot/chat/job/{}'
+SEND_JOB_TIMEOUT_SECONDS = 120  # 异步任务等待完成的超时时间
+CALLBACK_PORT = 18080  # 接收异步任务回调的本机端口，需要服务能访问到本机
 WECHAT_FROM_SUBJECT = 'Ray'
 NOW_TIME_STR = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
 MESSAGE_CASES = [
@@ -66,6 +74,42 @@ def request_agent(message):
     return json.loads(response.text)
 
 
+def submit_send_job(message, callback_url=''):
+    # 异步提交发送任务，返回任务id
+    result = request_agent({**message, 'async': True, 'callbackUrl': callback_url})
+    assert result['code'] == 0
+    assert result['data']['status'] in ['PENDING', 'RUNNING']
+    return result['data']['jobId']
+
+
+def wait_send_job(job_id, timeout=SEND_JOB_TIMEOUT_SECONDS):
+    # 轮询任务查询接口，直到任务完成
+    begin_time = time.time()
+    while time.time() - begin_time < timeout:
+        response = requests.get(CHAT_SEND_JOB_API.format(job_id))
+        assert response.status_code == 200
+        result = json.loads(response.text)
+        assert result['code'] == 0
+        if result['data']['status'] in ['SUCCESS', 'FAIL']:
+            return result['data']
+        time.sleep(1)
+    raise AssertionError('发送任务超时未完成：{}'.format(job_id))
+
+
+def start_callback_server(callback_jobs: queue.Queue) -> HTTPServer:
+    # 启动本机回调服务，收到的任务结果放入队列
+    class CallbackHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            callback_jobs.put(json.loads(body))
+            self.send_response(200)
+            self.end_headers()
+
+    server = HTTPServer(('0.0.0.0', CALLBACK_PORT), CallbackHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
 def message_send_test():
     for message in MESSAGE_CASES:
         result = request_agent(message)
@@ -102,12 +146,46 @@ def message_send_wecom_app_push_message_test():
     assert result['code'] == 0
 
 
+# 测试异步发送，提交任务后轮询任务查询接口获取发送结果
+def message_send_wechat_text_async_test():
+    job_id = submit_send_job(MESSAGE_CASES[0])
+    job = wait_send_job(job_id)
+    assert job['jobId'] == job_id
+    assert job['status'] == 'SUCCESS'
+    assert job['results']
+
+
+# 测试异步发送参数错误时直接返回失败，不会入队
+def message_send_wechat_text_async_invalid_test():
+    result = request_agent({**MESSAGE_CASES[0], 'async': True, 'messageData': {'content': ''}})
+    assert result['code'] != 0
+
+
+# 测试异步发送完成后回调发送结果
+def message_send_wechat_text_async_callback_test():
+    callback_jobs = queue.Queue()
+    server = start_callback_server(callback_jobs)
+    try:
+        callback_url = 'http://{}:{}/callback'.format(socket.gethostbyname(socket.gethostname()), CALLBACK_PORT)
+        job_id = submit_send_job(MESSAGE_CASES[0], callback_url)
+        job = callback_jobs.get(timeout=SEND_JOB_TIMEOUT_SECONDS)
+        assert job['jobId'] == job_id
+        assert job['status'] == 'SUCCESS'
+        # 回调的结果和任务查询接口一致
+        assert wait_send_job(job_id)['status'] == job['status']
+    finally:
+        server.shutdown()
+
+
 def run_all_test():
     message_send_wechat_text_test()
     message_send_wechat_file_test()
     message_send_wechat_file_test_of_multi()
     message_send_wecom_group_bot_test()
     message_send_wecom_app_push_message_test()
+    message_send_wechat_text_async_test()
+    message_send_wechat_text_async_invalid_test()
+    message_send_wechat_text_async_callback_test()
 
 
 if __name__ == '__main__':